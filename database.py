@@ -1,75 +1,1628 @@
 """
 TerraSync Database Manager
 Quản lý database thống nhất cho toàn bộ ứng dụng
-(Phiên bản JSON - Tối ưu cho demo)
+(Backend JSON mặc định; SQLite tùy chọn qua create_db)
 """
+import bisect
+import functools
+import heapq
 import json
+import math
 import os
-from typing import Dict, List, Any, Optional
-from datetime import datetime
+import re
+import shutil
+import threading
+import time
+from contextlib import contextmanager, ExitStack
+from itertools import count, islice
+from typing import (Dict, List, Any, Optional, Tuple, Iterable, Iterator,
+                    Callable)
+from datetime import date, datetime, timedelta, timezone
 import uuid
+import toml
 from filelock import FileLock
 
+try:
+    import fcntl
+except ImportError:  # Windows: không có flock, dùng khóa loại trừ của filelock
+    fcntl = None
 
-class JsonDB:
+try:
+    import orjson
+except ImportError:  # orjson là tùy chọn, mặc định dùng json chuẩn
+    orjson = None
+
+# Mức độ bền vững khi ghi xuống đĩa:
+#   "fast": ghi tệp tạm rồi đổi tên (an toàn khi tiến trình chết, không fsync)
+#   "safe": thêm fsync tệp chính và thư mục (an toàn khi mất điện)
+#   "full": thêm fsync sau mỗi lần ghi nối tiếp nhật ký
+DURABILITY_LEVELS = ("fast", "safe", "full")
+
+
+class CorruptTableError(ValueError):
+    """Tệp bảng tồn tại nhưng không giải mã được."""
+
+
+def _json_default(value: Any) -> Any:
+    """date/datetime thành chuỗi ISO 8601, giống cách orjson mã hóa."""
+    if isinstance(value, date):
+        return value.isoformat()
+    raise TypeError(f"Object of type {type(value).__name__} "
+                    f"is not JSON serializable")
+
+
+class JsonSerializer:
+    """Mã hóa JSON bằng thư viện chuẩn; ``indent`` chỉ dùng khi xuất tệp."""
+    name = "json"
+
+    def __init__(self, indent: Optional[int] = None):
+        self.indent = indent
+
+    def dumps(self, value: Any) -> bytes:
+        if self.indent:
+            text = json.dumps(value, ensure_ascii=False, indent=self.indent,
+                              default=_json_default)
+        else:
+            text = json.dumps(value, ensure_ascii=False,
+                              separators=(",", ":"), default=_json_default)
+        return text.encode("utf-8")
+
+    def loads(self, data: bytes) -> Any:
+        return json.loads(data)
+
+
+class OrjsonSerializer:
+    """Mã hóa JSON bằng ``orjson`` (nhanh hơn nhiều lần, cùng định dạng)."""
+    name = "orjson"
+
+    def __init__(self, indent: Optional[int] = None):
+        if orjson is None:
+            raise ImportError("Cần cài đặt orjson: pip install orjson")
+        self.option = orjson.OPT_INDENT_2 if indent else 0
+
+    def dumps(self, value: Any) -> bytes:
+        return orjson.dumps(value, option=self.option)
+
+    def loads(self, data: bytes) -> Any:
+        return orjson.loads(data)
+
+
+SERIALIZERS = {"json": JsonSerializer, "orjson": OrjsonSerializer}
+
+
+def get_serializer(name: str = "auto", indent: Optional[int] = None):
     """
-    Một lớp cơ sở để quản lý dữ liệu trong một tệp JSON.
-    Cung cấp các hoạt động CRUD cơ bản với cơ chế khóa tệp để đảm bảo an toàn cho luồng.
+    Tạo bộ mã hóa theo tên: ``"json"``, ``"orjson"`` hoặc ``"auto"`` (orjson
+    nếu đã cài, ngược lại json). Mọi bộ mã hóa đều ghi JSON hợp lệ (datetime
+    thành chuỗi ISO 8601) nên đọc được tệp của nhau.
     """
-    def __init__(self, db_file: str):
-        self.db_file = db_file
-        self.lock_file = f"{db_file}.lock"
-        self.lock = FileLock(self.lock_file)
-        # Không tải dữ liệu ở đây nữa, sẽ tải bên trong ngữ cảnh khóa
+    if name == "auto":
+        name = "orjson" if orjson is not None else "json"
+    if name not in SERIALIZERS:
+        raise ValueError(f"Bộ mã hóa không hợp lệ: {name!r}")
+    return SERIALIZERS[name](indent=indent)
+
+
+def _fsync_dir(path: str):
+    """Đồng bộ mục thư mục để phép đổi tên tồn tại sau khi mất điện."""
+    if os.name == "nt":
+        return  # Windows không cho mở thư mục để fsync
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def _copy_file(src, dest: str, limit: Optional[int] = None,
+               chunk_size: int = 1 << 20) -> int:
+    """
+    Chép từng khối từ tệp đã mở ``src`` (tối đa ``limit`` byte) sang
+    ``dest`` rồi fsync, nên bộ nhớ dùng không phụ thuộc kích thước tệp.
+    Trả về số byte đã chép.
+    """
+    copied = 0
+    with open(dest, "wb") as out:
+        while limit is None or copied < limit:
+            size = chunk_size if limit is None else min(chunk_size,
+                                                        limit - copied)
+            block = src.read(size)
+            if not block:
+                break
+            out.write(block)
+            copied += len(block)
+        out.flush()
+        os.fsync(out.fileno())
+    return copied
+
+
+def _open_existing(path: str):
+    """Mở ``path`` để đọc nhị phân; None nếu tệp không tồn tại."""
+    try:
+        return open(path, "rb")
+    except FileNotFoundError:
+        return None
+
+
+def _write_atomic(path: str, data: bytes, durable: bool = True):
+    """
+    Ghi ``data`` vào ``path`` một cách nguyên tử: ghi tệp tạm bên cạnh rồi
+    ``os.replace``. Người đọc chỉ thấy tệp cũ hoặc tệp mới hoàn chỉnh.
+    Cần giữ khóa ghi vì tên tệp tạm là cố định.
+    """
+    tmp_path = f"{path}.tmp"
+    try:
+        with open(tmp_path, "wb") as f:
+            f.write(data)
+            if durable:
+                f.flush()
+                os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    except BaseException:
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+        raise
+    if durable:
+        _fsync_dir(os.path.dirname(os.path.abspath(path)))
+
+
+def _read_only(self, *args, **kwargs):
+    raise TypeError("Bản ghi chỉ đọc: sửa dữ liệu qua db.update(), "
+                    "hoặc dùng dict(bản_ghi) để có bản sao sửa được")
+
+
+class FrozenDict(dict):
+    """
+    ``dict`` chỉ đọc dùng cho các bản ghi trả về từ database.
+
+    Các hàm đọc trả về chính đối tượng trong bộ nhớ đệm (không sao chép
+    theo từng lần gọi), nên mọi thao tác sửa tại chỗ đều báo ``TypeError``.
+    Vẫn là ``dict`` nên ``json``/``orjson``, pandas và FastAPI dùng được
+    trực tiếp; ``dict(rec)``/``rec.copy()`` cho bản sao nông sửa được,
+    ``copy.deepcopy(rec)`` cho bản sao sâu sửa được.
+    """
+
+    __slots__ = ()
+
+    __setitem__ = __delitem__ = __ior__ = _read_only
+    clear = pop = popitem = setdefault = update = _read_only
+
+    def copy(self) -> Dict[str, Any]:
+        return dict(self)
+
+    __copy__ = copy
+
+    def __deepcopy__(self, memo) -> Dict[str, Any]:
+        return thaw(self)
+
+    def __reduce_ex__(self, protocol):
+        # pickle (vd. st.cache_data) khôi phục lại đúng một bản chỉ đọc
+        return (FrozenDict, (dict(self),))
+
+
+class FrozenList(list):
+    """``list`` chỉ đọc, dùng cho các mảng lồng trong bản ghi."""
+
+    __slots__ = ()
+
+    __setitem__ = __delitem__ = __iadd__ = __imul__ = _read_only
+    append = extend = insert = remove = pop = clear = _read_only
+    sort = reverse = _read_only
+
+    def copy(self) -> List[Any]:
+        return list(self)
+
+    __copy__ = copy
+
+    def __deepcopy__(self, memo) -> List[Any]:
+        return thaw(self)
+
+    def __reduce_ex__(self, protocol):
+        return (FrozenList, (list(self),))
+
+
+def freeze(value: Any) -> Any:
+    """
+    Bản chỉ đọc (sâu) của một giá trị JSON. Các phần đã chỉ đọc được dùng
+    lại nguyên vẹn, nên đóng băng lại một bản ghi đã cập nhật chỉ tốn chi
+    phí cho các trường mới.
+    """
+    if isinstance(value, (FrozenDict, FrozenList)):
+        return value
+    if isinstance(value, dict):
+        return FrozenDict({k: freeze(v) for k, v in value.items()})
+    if isinstance(value, list):
+        return FrozenList([freeze(v) for v in value])
+    return value
+
+
+def thaw(value: Any) -> Any:
+    """Bản sao sâu, sửa được, của một giá trị JSON (kể cả bản ghi chỉ đọc)."""
+    if isinstance(value, dict):
+        return {k: thaw(v) for k, v in value.items()}
+    if isinstance(value, list):
+        return [thaw(v) for v in value]
+    return value
+
+
+def _project(rec: Dict[str, Any], fields: Optional[Iterable[str]]
+             ) -> Dict[str, Any]:
+    """Bản ghi (chỉ đọc), chỉ gồm các trường ``fields`` (nếu có)."""
+    if fields is None:
+        return rec
+    return FrozenDict({f: rec[f] for f in fields if f in rec})
+
+
+# Toán tử so sánh trong bộ lọc, vd. {"timestamp": {"$gte": "2025-01-01"}}
+_OPERATORS = {
+    "$gt": lambda a, b: a > b,
+    "$gte": lambda a, b: a >= b,
+    "$lt": lambda a, b: a < b,
+    "$lte": lambda a, b: a <= b,
+    "$ne": lambda a, b: a != b,
+    "$in": lambda a, b: a in b,
+    "$nin": lambda a, b: a not in b,
+}
+
+
+def _is_operator(cond: Any) -> bool:
+    """Điều kiện dạng {"$toán_tử": giá trị} (ngược lại là so sánh bằng)."""
+    return (isinstance(cond, dict) and bool(cond)
+            and all(isinstance(k, str) and k.startswith("$") for k in cond))
+
+
+def _operand(value: Any) -> Any:
+    """datetime được so sánh như chuỗi ISO 8601 đã lưu trong bản ghi."""
+    if isinstance(value, datetime):
+        return value.isoformat()
+    if isinstance(value, (list, tuple, set)):
+        return [_operand(v) for v in value]
+    return value
+
+
+def _check_operators(cond: Dict[str, Any]):
+    for op in cond:
+        if op not in _OPERATORS:
+            raise ValueError(f"Toán tử lọc không hỗ trợ: {op!r}")
+
+
+def _expiry(cutoff: str) -> Tuple[Callable[[Any], bool], str]:
+    """
+    Hàm kiểm tra một thời điểm đã lưu (chuỗi ISO 8601) có trước ``cutoff``
+    không, kèm cận trên theo thứ tự từ điển của các chuỗi cần kiểm tra.
+
+    Bản ghi lưu thời gian ở hai dạng: có múi giờ (iotAPI ghi giờ UTC,
+    ``+00:00``) và không múi giờ, là giờ địa phương (``datetime.now()``
+    mặc định của ``add``). Mỗi dạng được so sánh như chuỗi với mốc viết
+    cùng dạng; múi giờ khác được phân tích rồi so sánh. Chuỗi từ cận trên
+    trở đi không cần kiểm tra, trừ giờ có múi giờ dương lớn hơn giờ địa
+    phương: bản ghi đó hết hạn muộn hơn tối đa độ lệch ấy, không sớm hơn.
+    """
+    at = datetime.fromisoformat(cutoff)
+    if at.tzinfo is None:
+        at = at.astimezone()
+    utc = at.astimezone(timezone.utc).isoformat()
+    local = at.astimezone().replace(tzinfo=None).isoformat()
+
+    def expired(value: Any) -> bool:
+        if not isinstance(value, str):
+            return False
+        if value.endswith("+00:00"):
+            return value < utc
+        if "+" not in value and "Z" not in value and value.count("-") == 2:
+            return value < local
+        try:
+            other = datetime.fromisoformat(value)
+        except ValueError:
+            return False
+        return (other if other.tzinfo else other.astimezone()) < at
+
+    return expired, max(utc, local)
+
+
+def _match_operators(value: Any, cond: Dict[str, Any]) -> bool:
+    """Giá trị thỏa mọi toán tử; so sánh khác kiểu được coi là không khớp."""
+    for op, operand in cond.items():
+        try:
+            if not _OPERATORS[op](value, _operand(operand)):
+                return False
+        except TypeError:
+            return False
+    return True
+
+
+def _sort_key(value: Any) -> Tuple[int, Any]:
+    """Khóa sắp xếp so sánh được giữa mọi kiểu giá trị JSON."""
+    if value is None:
+        return (0, 0)
+    if isinstance(value, bool):
+        return (1, int(value))
+    if isinstance(value, (int, float)):
+        return (2, value)
+    if isinstance(value, str):
+        return (3, value)
+    if isinstance(value, datetime):
+        return (3, value.isoformat())
+    return (4, json.dumps(value, sort_keys=True, default=str))
+
+
+class DBMetrics:
+    """
+    Số liệu đo của một đối tượng CSDL trong tiến trình hiện tại:
+
+    - theo (bảng, thao tác): số lần gọi, số lỗi, tổng/lớn nhất thời gian,
+      biểu đồ độ trễ theo các ô ``BUCKETS`` (kèm p50/p95/p99 ước lượng),
+      thời gian chờ khóa (``lock_wait``), số bản ghi đã duyệt (``scanned``)
+      và trả về/ghi (``returned``). Duyệt nhiều hơn hẳn số trả về nghĩa là
+      truy vấn không dùng được chỉ mục;
+    - theo bảng (``io``): số lần và số byte đọc/ghi, thời gian đọc, phân
+      tích (parse), mã hóa (serialize) và ghi xuống đĩa.
+
+    Thao tác lồng nhau (vd. ``get`` -> ``query``) chỉ được tính một lần
+    ở lớp ngoài cùng. ``query`` của MongoDB trả về con trỏ lười nên chỉ đo
+    được phần tạo con trỏ. Đọc bằng ``snapshot()``, xóa bằng ``reset()``.
+    """
+    # Cận trên (giây) của các ô biểu đồ độ trễ; ô cuối chứa phần còn lại
+    BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025,
+               0.05, 0.1, 0.25, 0.5, 1.0, 2.5)
+    _IO_FIELDS = ("reads", "bytes_read", "read_time", "parse_time",
+                  "writes", "bytes_written", "serialize_time", "write_time")
+
+    def __init__(self):
+        self._mutex = threading.Lock()
+        self._local = threading.local()
+        self.reset()
+
+    def reset(self):
+        """Xóa mọi số liệu đã đo."""
+        with self._mutex:
+            self._ops: Dict[Tuple[str, str], Dict[str, Any]] = {}
+            self._io: Dict[str, Dict[str, float]] = {}
+
+    def begin(self) -> bool:
+        """Bắt đầu đo một thao tác; False nếu đang ở trong thao tác khác."""
+        local = self._local
+        if getattr(local, "active", False):
+            return False
+        local.active = True
+        local.scanned = 0
+        local.returned = None
+        local.lock_wait = 0.0
+        return True
+
+    def end(self, table: str, op: str, elapsed: float, ok: bool,
+            returned: Optional[int]):
+        """Kết thúc thao tác đã ``begin()`` và ghi lại số liệu."""
+        local = self._local
+        local.active = False
+        if local.returned is not None:
+            returned = local.returned
+        with self._mutex:
+            stats = self._ops.get((table, op))
+            if stats is None:
+                stats = self._ops[(table, op)] = {
+                    "count": 0, "errors": 0, "total": 0.0, "max": 0.0,
+                    "lock_wait": 0.0, "scanned": 0, "returned": 0,
+                    "buckets": [0] * (len(self.BUCKETS) + 1)}
+            stats["count"] += 1
+            stats["errors"] += not ok
+            stats["total"] += elapsed
+            stats["max"] = max(stats["max"], elapsed)
+            stats["buckets"][bisect.bisect_left(self.BUCKETS, elapsed)] += 1
+            stats["lock_wait"] += local.lock_wait
+            stats["scanned"] += local.scanned
+            stats["returned"] += returned or 0
+
+    def note(self, scanned: int = 0, returned: Optional[int] = None,
+             lock_wait: float = 0.0):
+        """
+        Ghi số bản ghi đã duyệt/trả về và thời gian chờ khóa cho thao tác
+        đang đo của luồng hiện tại (không làm gì nếu không có).
+        """
+        local = self._local
+        if getattr(local, "active", False):
+            local.scanned += scanned
+            local.lock_wait += lock_wait
+            if returned is not None:
+                local.returned = returned
+
+    def io(self, table: str, **values: float):
+        """Cộng dồn số liệu I/O của bảng (các khóa trong ``_IO_FIELDS``)."""
+        with self._mutex:
+            stats = self._io.get(table)
+            if stats is None:
+                stats = self._io[table] = dict.fromkeys(self._IO_FIELDS, 0)
+            for key, value in values.items():
+                stats[key] += value
+
+    def _percentile(self, buckets: List[int], count: int, q: float,
+                    observed_max: float) -> float:
+        """Cận trên của ô chứa phân vị ``q`` (ô cuối: thời gian lớn nhất)."""
+        rank = q * count
+        seen = 0
+        for i, n in enumerate(buckets):
+            seen += n
+            if seen >= rank and n:
+                if i < len(self.BUCKETS):
+                    return min(self.BUCKETS[i], observed_max)
+                break
+        return observed_max
+
+    def snapshot(self) -> Dict[str, Any]:
+        """
+        ``{"operations": {bảng: {thao tác: {...}}}, "io": {bảng: {...}},
+        "buckets": BUCKETS}``; thời gian tính bằng giây.
+        """
+        with self._mutex:
+            ops = {key: {**stats, "buckets": list(stats["buckets"])}
+                   for key, stats in self._ops.items()}
+            io = {table: dict(stats) for table, stats in self._io.items()}
+        operations: Dict[str, Dict[str, Any]] = {}
+        for (table, op), stats in sorted(ops.items()):
+            count = stats["count"]
+            for name, q in (("p50", 0.5), ("p95", 0.95), ("p99", 0.99)):
+                stats[name] = self._percentile(stats["buckets"], count, q,
+                                               stats["max"])
+            stats["avg"] = stats["total"] / count if count else 0.0
+            operations.setdefault(table, {})[op] = stats
+        return {"operations": operations, "io": io,
+                "buckets": list(self.BUCKETS)}
+
+
+def _result_size(result: Any) -> Optional[int]:
+    """Số bản ghi trả về/bị ảnh hưởng suy từ kết quả của một thao tác."""
+    if isinstance(result, bool):
+        return int(result)
+    if isinstance(result, int):
+        return result
+    if isinstance(result, (list, tuple)):
+        return len(result)
+    if isinstance(result, dict):
+        return 1
+    return 0 if result is None else None
 
-    def _load_unsafe(self) -> Dict[str, List[Dict[str, Any]]]:
-        """Tải dữ liệu từ tệp mà không cần khóa (chỉ sử dụng nội bộ)."""
-        if os.path.exists(self.db_file):
+
+def _instrumented(op: str, method):
+    """Bọc một thao tác ``method(self, table, ...)`` để đo bằng DBMetrics."""
+    @functools.wraps(method)
+    def wrapper(self, table, *args, **kwargs):
+        metrics = self.metrics
+        if not metrics.begin():
+            return method(self, table, *args, **kwargs)
+        start = time.perf_counter()
+        result = None
+        ok = False
+        try:
+            result = method(self, table, *args, **kwargs)
+            ok = True
+            return result
+        finally:
+            metrics.end(table, op, time.perf_counter() - start, ok,
+                        _result_size(result))
+    wrapper._instrumented = True
+    return wrapper
+
+
+class _RWFileLock:
+    """
+    Khóa đọc/ghi liên tiến trình dựa trên ``flock``: nhiều tiến trình/luồng
+    có thể cùng đọc (LOCK_SH), người ghi giữ độc quyền (LOCK_EX).
+
+    Chống đói người ghi bằng một tệp "cổng" (``<path>.gate``): người đọc phải
+    đi qua cổng trước khi lấy khóa chia sẻ, còn người ghi giữ cổng trong lúc
+    chờ các người đọc hiện tại xong, nên người đọc mới phải xếp hàng sau.
+    Khóa có thể lồng nhau trong cùng một luồng (nhưng không nâng đọc lên ghi).
+    Thời gian chờ khóa được ghi lại trong ``stats``.
+    """
+    def __init__(self, path: str):
+        self.path = path
+        self.gate_path = f"{path}.gate"
+        self._local = threading.local()
+        self._fallback = FileLock(path) if fcntl is None else None
+        self._stats_mutex = threading.Lock()
+        self.stats = {mode: {"count": 0, "wait_total": 0.0, "wait_max": 0.0}
+                      for mode in ("shared", "exclusive")}
+
+    def shared(self):
+        """Ngữ cảnh giữ khóa đọc."""
+        return self._hold(exclusive=False)
+
+    def exclusive(self):
+        """Ngữ cảnh giữ khóa ghi."""
+        return self._hold(exclusive=True)
+
+    @contextmanager
+    def _hold(self, exclusive: bool):
+        local = self._local
+        if getattr(local, "depth", 0):
+            if exclusive and not local.exclusive:
+                raise RuntimeError(
+                    f"Không thể nâng khóa đọc lên khóa ghi: {self.path}")
+            local.depth += 1
             try:
-                with open(self.db_file, "r", encoding="utf-8") as f:
-                    return json.load(f)
-            except (json.JSONDecodeError, FileNotFoundError):
-                return {}
-        return {}
+                yield
+            finally:
+                local.depth -= 1
+            return
 
-    def _save_unsafe(self, data: Dict[str, List[Dict[str, Any]]]):
-        """Lưu dữ liệu vào tệp mà không cần khóa (chỉ sử dụng nội bộ)."""
+        start = time.perf_counter()
+        fd = self._acquire(exclusive)
+        self._record_wait(exclusive, time.perf_counter() - start)
+        local.depth, local.exclusive = 1, exclusive
         try:
-            with open(self.db_file, "w", encoding="utf-8") as f:
-                json.dump(data, f, indent=2, ensure_ascii=False)
+            yield
+        finally:
+            local.depth = 0
+            self._release(fd)
+
+    def _acquire(self, exclusive: bool) -> Optional[int]:
+        if self._fallback is not None:
+            self._fallback.acquire()
+            return None
+        # Mỗi lần giữ khóa dùng một file descriptor riêng, nên các luồng
+        # trong cùng tiến trình cũng loại trừ nhau như các tiến trình khác
+        gate = os.open(self.gate_path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(gate, fcntl.LOCK_EX)
+            fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+            except BaseException:
+                os.close(fd)
+                raise
+        finally:
+            os.close(gate)  # Đóng fd cũng nhả khóa cổng
+        return fd
+
+    def _release(self, fd: Optional[int]):
+        if self._fallback is not None:
+            self._fallback.release()
+        else:
+            os.close(fd)
+
+    def _record_wait(self, exclusive: bool, waited: float):
+        with self._stats_mutex:
+            stats = self.stats["exclusive" if exclusive else "shared"]
+            stats["count"] += 1
+            stats["wait_total"] += waited
+            stats["wait_max"] = max(stats["wait_max"], waited)
+
+
+class _TableStore:
+    """
+    Lưu trữ một bảng trong tệp riêng (``<data_dir>/<table>.json``) với
+    khóa riêng, bộ nhớ đệm riêng và nhật ký ghi nối tiếp riêng.
+
+    Dữ liệu đã parse được giữ trong bộ nhớ và chỉ tải lại khi tệp thực sự
+    thay đổi (so sánh inode/kích thước/mtime). Các bản ghi thêm mới được ghi
+    nối tiếp vào nhật ký JSON-lines (``<table>.json.log``); nhật ký được gộp
+    vào tệp chính khi lớn hơn một tỉ lệ của tệp chính, hoặc mỗi khi bảng
+    bị ghi lại toàn bộ (update/delete/overwrite). Bản ghi hết hạn (TTL) được
+    xóa bằng dòng bia mộ trong nhật ký nên không phải ghi lại cả bảng.
+
+    Trong bộ nhớ, bản ghi được lưu theo rowid (tăng dần theo thứ tự chèn)
+    kèm các chỉ mục băm ``{trường: {giá trị: {rowid: None}}}`` cho các trường
+    đã khai báo, nên lọc bằng phép so sánh bằng chỉ tốn O(k) thay vì quét
+    toàn bảng.
+
+    Bảng có thể khai báo thêm một chỉ mục có thứ tự ``(trường phân nhóm,
+    trường thời gian)``, vd. ``("hub_id", "timestamp")`` cho telemetry: mỗi
+    nhóm giữ một danh sách ``(thời gian, rowid)`` đã sắp xếp, để lấy bản ghi
+    mới nhất, N bản ghi cuối hoặc một khoảng thời gian trong O(log n + k).
+
+    Tệp chính được ghi nguyên tử (tệp tạm + ``os.replace``) dưới dạng
+    ``{"log":"<mã>","rows":[...]}``; dòng đầu của nhật ký ghi lại cùng mã
+    đó. Nếu tiến trình chết sau khi thay tệp chính nhưng trước khi làm mới
+    nhật ký, mã không khớp và nhật ký cũ (đã nằm trong tệp chính) bị bỏ qua
+    thay vì áp dụng lại. Tệp chính dạng mảng và nhật ký không có dòng đầu
+    của phiên bản trước vẫn đọc được.
+    """
+    # Gộp nhật ký khi kích thước >= max(MIN_BYTES, RATIO * kích thước tệp chính)
+    LOG_COMPACT_MIN_BYTES = 1 << 20
+    LOG_COMPACT_RATIO = 1.0
+    _SNAPSHOT_PREFIX = b'{"log":"'
+    _LOG_HEADER_PREFIX = b'{"$log":"'
+    # Dòng bia mộ trong nhật ký: {"$del": [id, ...]} xóa các bản ghi đó
+    _TOMBSTONE = "$del"
+
+    def __init__(self, path: str, index_fields: Iterable[str] = (),
+                 ordered_index: Optional[Tuple[str, str]] = None,
+                 serializer=None, durability: str = "safe",
+                 metrics: Optional[DBMetrics] = None):
+        if durability not in DURABILITY_LEVELS:
+            raise ValueError(f"Mức độ bền vững không hợp lệ: {durability!r}")
+        self.path = path
+        self.name = os.path.basename(path)[:-len(".json")]
+        self.metrics = metrics
+        self.log_file = f"{path}.log"
+        self.version_file = f"{path}.version"
+        self.lock = _RWFileLock(f"{path}.lock")
+        self.serializer = serializer or get_serializer()
+        self.durability = durability
+        # Bảo vệ bộ nhớ đệm khi nhiều luồng cùng giữ khóa đọc
+        self.mutex = threading.RLock()
+        self.index_fields = ["id"] + [f for f in index_fields if f != "id"]
+        self.ordered_index = ordered_index
+        # Bộ nhớ đệm: bản ghi theo rowid, chỉ mục và chữ ký tệp tương ứng
+        self._rows: Optional[Dict[int, Dict[str, Any]]] = None
+        self._indexes: Dict[str, Dict[Any, Dict[int, None]]] = {}
+        self._ordered: Dict[Any, List[Tuple[str, int]]] = {}
+        self._next_rowid = 0
+        self._sig: Optional[Tuple[int, int, int]] = None
+        # Mã nhật ký ghi trong tệp chính đang nằm trong cache
+        self._log_id: Optional[str] = None
+        # Số byte và inode của nhật ký đã được áp dụng vào cache
+        self._log_offset = 0
+        self._log_ino: Optional[int] = None
+        # (chữ ký tệp chính, inode nhật ký) đã kiểm tra khớp mã gần nhất
+        self._log_checked: Optional[Tuple[Any, int]] = None
+
+    @contextmanager
+    def reading(self):
+        """Giữ khóa đọc (chia sẻ giữa các tiến trình) và khóa bộ nhớ đệm."""
+        start = time.perf_counter()
+        with self.lock.shared(), self.mutex:
+            self._note(lock_wait=time.perf_counter() - start)
+            yield
+
+    @contextmanager
+    def writing(self):
+        """Giữ khóa ghi (độc quyền) và khóa bộ nhớ đệm."""
+        start = time.perf_counter()
+        with self.lock.exclusive(), self.mutex:
+            self._note(lock_wait=time.perf_counter() - start)
+            yield
+
+    def _note(self, **values):
+        """Ghi số liệu cho thao tác đang đo (xem ``DBMetrics.note``)."""
+        if self.metrics is not None:
+            self.metrics.note(**values)
+
+    def _io(self, **values):
+        """Cộng dồn số liệu I/O của bảng (xem ``DBMetrics.io``)."""
+        if self.metrics is not None:
+            self.metrics.io(self.name, **values)
+
+    def exists(self) -> bool:
+        """Bảng đã có tệp trên đĩa chưa."""
+        return os.path.exists(self.path)
+
+    @property
+    def loaded(self) -> bool:
+        """Bảng đang nằm trong bộ nhớ đệm."""
+        return self._rows is not None
+
+    def version(self) -> int:
+        """Phiên bản hiện tại của bảng (đọc không cần khóa)."""
+        try:
+            with open(self.version_file, "rb") as f:
+                return int(f.read() or 0)
+        except (FileNotFoundError, ValueError):
+            return 0
+
+    def bump_version_unsafe(self):
+        """
+        Tăng phiên bản sau một lần ghi đã lưu xuống đĩa. Người gọi giữ khóa
+        ghi nên không tiến trình nào tăng cùng lúc; số được ghi đè tại chỗ
+        với độ rộng cố định nên người đọc không bao giờ thấy tệp rỗng.
+        """
+        fd = os.open(self.version_file, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            try:
+                current = int(os.read(fd, 32) or 0)
+            except ValueError:
+                current = 0
+            os.lseek(fd, 0, os.SEEK_SET)
+            os.write(fd, b"%020d" % (current + 1))
+        finally:
+            os.close(fd)
+
+    def _signature(self) -> Optional[Tuple[int, int, int]]:
+        """Chữ ký (inode, kích thước, mtime_ns) của tệp, None nếu chưa có."""
+        try:
+            st = os.stat(self.path)
+        except FileNotFoundError:
+            return None
+        return (st.st_ino, st.st_size, st.st_mtime_ns)
+
+    # --- Bộ nhớ đệm và chỉ mục ---
+
+    def reset_unsafe(self, records: List[Dict[str, Any]]):
+        """Nạp lại toàn bộ bản ghi vào bộ nhớ và xây lại chỉ mục."""
+        self._rows = {}
+        self._indexes = {f: {} for f in self.index_fields}
+        self._ordered = {}
+        self._next_rowid = 0
+        for rec in records:
+            self.insert_unsafe(rec)
+
+    def insert_unsafe(self, rec: Dict[str, Any]):
+        """Thêm một bản ghi vào bộ nhớ và các chỉ mục."""
+        rowid = self._next_rowid
+        self._next_rowid += 1
+        rec = freeze(rec)
+        self._rows[rowid] = rec
+        for f, index in self._indexes.items():
+            self._index_add(index, rec.get(f), rowid)
+        if self.ordered_index:
+            self._ordered_add(rec, rowid)
+
+    @staticmethod
+    def _index_add(index: Dict[Any, Dict[int, None]], value: Any, rowid: int):
+        try:
+            index.setdefault(value, {})[rowid] = None
+        except TypeError:
+            # Giá trị không băm được (list/dict) không bao giờ bằng một giá trị
+            # băm được trong bộ lọc, nên bỏ qua khỏi chỉ mục là an toàn
+            pass
+
+    @staticmethod
+    def _index_remove(index: Dict[Any, Dict[int, None]], value: Any,
+                      rowid: int):
+        try:
+            bucket = index.get(value)
+        except TypeError:
+            return
+        if bucket is not None:
+            bucket.pop(rowid, None)
+            if not bucket:
+                del index[value]
+
+    @staticmethod
+    def _order_value(value: Any) -> str:
+        """Khóa sắp xếp: chuỗi ISO 8601 so sánh được theo thứ tự từ điển."""
+        if isinstance(value, datetime):
+            return value.isoformat()
+        return value if isinstance(value, str) else ""
+
+    def _ordered_entry(self, rec: Dict[str, Any], rowid: int
+                       ) -> Tuple[Any, Tuple[str, int]]:
+        part_field, order_field = self.ordered_index
+        return (rec.get(part_field),
+                (self._order_value(rec.get(order_field)), rowid))
+
+    def _ordered_add(self, rec: Dict[str, Any], rowid: int):
+        part, entry = self._ordered_entry(rec, rowid)
+        try:
+            entries = self._ordered.setdefault(part, [])
+        except TypeError:
+            return
+        # Bản ghi đến trễ (timestamp cũ hơn) vẫn được chèn đúng vị trí
+        if not entries or entries[-1] <= entry:
+            entries.append(entry)
+        else:
+            bisect.insort(entries, entry)
+
+    def _ordered_remove(self, rec: Dict[str, Any], rowid: int):
+        part, entry = self._ordered_entry(rec, rowid)
+        try:
+            entries = self._ordered.get(part)
+        except TypeError:
+            return
+        if not entries:
+            return
+        pos = bisect.bisect_left(entries, entry)
+        if pos < len(entries) and entries[pos] == entry:
+            del entries[pos]
+            if not entries:
+                del self._ordered[part]
+
+    def ordered_unsafe(self, key: Any, since: Any = None, until: Any = None,
+                       last: Optional[int] = None) -> List[Dict[str, Any]]:
+        """
+        Các bản ghi (tham chiếu tới cache) của nhóm ``key`` trong khoảng
+        ``since <= thời gian < until``, theo thứ tự thời gian tăng dần;
+        ``last`` giới hạn ở N bản ghi cuối của khoảng.
+        """
+        try:
+            entries = self._ordered.get(key, [])
+        except TypeError:
+            return []
+        lo = 0 if since is None else bisect.bisect_left(
+            entries, (self._order_value(since),))
+        hi = len(entries) if until is None else bisect.bisect_left(
+            entries, (self._order_value(until),))
+        if last is not None:
+            lo = max(lo, hi - last)
+        self._note(scanned=max(hi - lo, 0))
+        rows = self._rows
+        return [rows[rowid] for _, rowid in entries[lo:hi]]
+
+    def latest_unsafe(self, key: Any = None) -> Optional[Dict[str, Any]]:
+        """Bản ghi mới nhất của nhóm ``key`` (hoặc của mọi nhóm nếu None)."""
+        if key is None:
+            tails = [entries[-1] for entries in self._ordered.values()]
+            return self._rows[max(tails)[1]] if tails else None
+        try:
+            entries = self._ordered.get(key)
+        except TypeError:
+            return None
+        return self._rows[entries[-1][1]] if entries else None
+
+    def create_index(self, field: str):
+        """Khai báo chỉ mục băm cho một trường (xây ngay nếu đã tải bảng)."""
+        if field in self.index_fields:
+            return
+        self.index_fields.append(field)
+        if self._rows is not None:
+            index: Dict[Any, Dict[int, None]] = {}
+            for rowid, rec in self._rows.items():
+                self._index_add(index, rec.get(field), rowid)
+            self._indexes[field] = index
+
+    @staticmethod
+    def _predicate(filter_dict: Dict[str, Any]):
+        """Hàm kiểm tra một bản ghi có thỏa mọi điều kiện của bộ lọc."""
+        checks = []
+        for k, v in filter_dict.items():
+            is_op = _is_operator(v)
+            if is_op:
+                _check_operators(v)
+            checks.append((k, v, is_op))
+
+        def match(rec: Dict[str, Any]) -> bool:
+            return all(_match_operators(rec.get(k), v) if is_op
+                       else rec.get(k) == v for k, v, is_op in checks)
+        return match
+
+    def match_unsafe(self, filter_dict: Optional[Dict[str, Any]]
+                     ) -> List[int]:
+        """
+        Tìm rowid của các bản ghi khớp bộ lọc (theo thứ tự chèn). Điều kiện
+        là một giá trị (so sánh bằng) hoặc toán tử như ``{"$gt": 5}``.
+        Dùng chỉ mục có ít ứng viên nhất (so sánh bằng hoặc ``$in``), rồi
+        kiểm tra các điều kiện còn lại.
+        """
+        if not filter_dict:
+            self._note(scanned=len(self._rows))
+            return list(self._rows)
+
+        best_field, best_bucket = None, None
+        for k, v in filter_dict.items():
+            index = self._indexes.get(k)
+            if index is None:
+                continue
+            try:
+                if not _is_operator(v):
+                    bucket = index.get(v, {})
+                elif set(v) == {"$in"}:
+                    bucket = {}
+                    for value in _operand(v["$in"]):
+                        bucket.update(index.get(value, {}))
+                else:
+                    continue
+            except TypeError:
+                continue
+            if best_bucket is None or len(bucket) < len(best_bucket):
+                best_field, best_bucket = k, bucket
+
+        if best_bucket is None:
+            candidates = list(self._rows)
+        else:
+            # Bản ghi đổi giá trị trường có chỉ mục bị chuyển xuống cuối
+            # nhóm, nên sắp xếp lại để giữ đúng thứ tự chèn
+            candidates = sorted(best_bucket)
+        self._note(scanned=len(candidates))
+        rest = {k: v for k, v in filter_dict.items() if k != best_field}
+        if not rest:
+            return candidates
+        match = self._predicate(rest)
+        rows = self._rows
+        return [rowid for rowid in candidates if match(rows[rowid])]
+
+    def count_unsafe(self, filter_dict: Optional[Dict[str, Any]]) -> int:
+        """Số bản ghi khớp bộ lọc; một điều kiện bằng có chỉ mục tốn O(1)."""
+        if not filter_dict:
+            return len(self._rows)
+        if len(filter_dict) == 1:
+            (k, v), = filter_dict.items()
+            index = self._indexes.get(k)
+            if index is not None and not _is_operator(v):
+                try:
+                    n = len(index.get(v, ()))
+                    self._note(scanned=n)
+                    return n
+                except TypeError:
+                    pass
+        return len(self.match_unsafe(filter_dict))
+
+    def select_unsafe(self, filter_dict: Optional[Dict[str, Any]] = None,
+                      order_by: Optional[str] = None, offset: int = 0,
+                      limit: Optional[int] = None, after: Any = None
+                      ) -> List[Dict[str, Any]]:
+        """
+        Các bản ghi (tham chiếu tới cache) khớp bộ lọc, sắp theo
+        ``order_by`` (``"-trường"``: giảm dần), bỏ qua ``offset`` bản ghi
+        đầu và lấy tối đa ``limit`` bản ghi.
+
+        ``after`` tiếp tục từ sau một vị trí theo thứ tự sắp xếp: một giá trị
+        của trường sắp xếp, hoặc cặp ``(giá trị, id)`` của bản ghi cuối trang
+        trước (không bỏ sót bản ghi trùng giá trị).
+
+        Sắp theo trường thời gian của chỉ mục có thứ tự khi bộ lọc cố định
+        nhóm (bằng hoặc ``$in``) chỉ duyệt đúng các bản ghi trả về:
+        O(log n + offset + limit). Các trường hợp khác lọc qua chỉ mục băm
+        rồi chọn ``offset + limit`` bản ghi đầu bằng heap.
+        """
+        filter_dict = dict(filter_dict or {})
+        if offset < 0 or (limit is not None and limit < 0):
+            raise ValueError("offset và limit không được âm")
+        desc = bool(order_by) and order_by.startswith("-")
+        order_field = order_by[1:] if desc else order_by
+        if after is not None and not order_field:
+            raise ValueError("after chỉ dùng được cùng order_by")
+        stop = None if limit is None else offset + limit
+        rows = self._rows
+
+        scan = None
+        if (order_field and self.ordered_index
+                and order_field == self.ordered_index[1]):
+            scan = self._ordered_scan(filter_dict, desc, after)
+        if scan is not None:
+            rowids, rest = scan
+            # zip lấy rowid trước rồi mới đếm, nên ``tally`` chỉ đếm các
+            # rowid thực sự đã duyệt qua chỉ mục có thứ tự
+            tally = count()
+            rowids = (rowid for rowid, _ in zip(rowids, tally))
+            if rest:
+                match = self._predicate(rest)
+                rowids = (rowid for rowid in rowids if match(rows[rowid]))
+            selected = [rows[rowid] for rowid in islice(rowids, offset, stop)]
+            self._note(scanned=next(tally))
+            return selected
+
+        rowids = self.match_unsafe(filter_dict)
+        if order_field:
+            def key(rowid: int) -> Tuple[Tuple[int, Any], float]:
+                return (_sort_key(rows[rowid].get(order_field)), rowid)
+
+            if after is not None:
+                bound = self._after_bound(after, desc, _sort_key)
+                rowids = [rowid for rowid in rowids
+                          if (key(rowid) < bound if desc
+                              else key(rowid) > bound)]
+            if stop is not None:
+                pick = heapq.nlargest if desc else heapq.nsmallest
+                rowids = pick(stop, rowids, key=key)
+            else:
+                rowids = sorted(rowids, key=key, reverse=desc)
+        return [rows[rowid] for rowid in islice(rowids, offset, stop)]
+
+    def _after_bound(self, after: Any, desc: bool, convert
+                     ) -> Tuple[Any, float]:
+        """
+        Khóa ``(giá trị, rowid)`` của vị trí ``after``: cặp ``(giá trị, id)``
+        trỏ đúng bản ghi đó; nếu chỉ có giá trị (hoặc bản ghi đã bị xóa) thì
+        bỏ qua mọi bản ghi mang giá trị đó.
+        """
+        record_id = None
+        if isinstance(after, (list, tuple)) and len(after) == 2:
+            after, record_id = after
+        bucket = self._indexes["id"].get(record_id) if record_id else None
+        if bucket:
+            return (convert(after), next(iter(bucket)))
+        return (convert(after), -1 if desc else math.inf)
+
+    def _ordered_scan(self, filter_dict: Dict[str, Any], desc: bool,
+                      after: Any):
+        """
+        Duyệt chỉ mục có thứ tự cho ``select_unsafe``: trả về (dãy rowid đã
+        sắp xếp, các điều kiện còn phải kiểm tra), hoặc None nếu bộ lọc
+        không cố định được nhóm.
+        """
+        part_field, order_field = self.ordered_index
+        rest = dict(filter_dict)
+        cond = rest.pop(part_field, None)
+        try:
+            if part_field not in filter_dict:
+                # Mọi nhóm, nếu không có bản ghi nào nằm ngoài chỉ mục
+                if sum(map(len, self._ordered.values())) != len(self._rows):
+                    return None
+                groups = list(self._ordered.values())
+            elif not _is_operator(cond):
+                groups = [self._ordered[cond]] if cond in self._ordered else []
+            elif set(cond) == {"$in"}:
+                keys = dict.fromkeys(_operand(cond["$in"]))
+                groups = [self._ordered[k] for k in keys if k in self._ordered]
+            else:
+                return None
+        except TypeError:
+            return None
+
+        # Điều kiện khoảng trên trường thời gian được giải bằng tìm nhị phân
+        bounds = rest.get(order_field)
+        pushed: Dict[str, Any] = {}
+        if _is_operator(bounds):
+            _check_operators(bounds)
+            pushed = {op: self._order_value(v) for op, v in bounds.items()
+                      if op in ("$gt", "$gte", "$lt", "$lte")
+                      and isinstance(v, (str, datetime))}
+            remaining = {op: v for op, v in bounds.items() if op not in pushed}
+            if remaining:
+                rest[order_field] = remaining
+            else:
+                del rest[order_field]
+        after_bound = (self._after_bound(after, desc, self._order_value)
+                       if after is not None else None)
+
+        runs = []
+        for entries in groups:
+            lo, hi = 0, len(entries)
+            if pushed:
+                # Bản ghi thiếu trường thời gian (khóa "") không thỏa khoảng nào
+                lo = bisect.bisect_right(entries, ("", math.inf))
+            for op, v in pushed.items():
+                if op == "$gte":
+                    lo = max(lo, bisect.bisect_left(entries, (v,)))
+                elif op == "$gt":
+                    lo = max(lo, bisect.bisect_right(entries, (v, math.inf)))
+                elif op == "$lt":
+                    hi = min(hi, bisect.bisect_left(entries, (v,)))
+                else:
+                    hi = min(hi, bisect.bisect_right(entries, (v, math.inf)))
+            if after_bound is not None:
+                if desc:
+                    hi = min(hi, bisect.bisect_left(entries, after_bound))
+                else:
+                    lo = max(lo, bisect.bisect_right(entries, after_bound))
+            if lo >= hi:
+                continue
+            positions = range(hi - 1, lo - 1, -1) if desc else range(lo, hi)
+            runs.append(map(entries.__getitem__, positions))
+
+        if len(runs) == 1:
+            merged = runs[0]
+        else:
+            merged = heapq.merge(*runs, reverse=desc)
+        return (rowid for _, rowid in merged), rest
+
+    def find_unsafe(self, filter_dict: Optional[Dict[str, Any]]
+                    ) -> List[Dict[str, Any]]:
+        """Các bản ghi (tham chiếu tới cache) khớp bộ lọc."""
+        rows = self._rows
+        return [rows[rowid] for rowid in self.match_unsafe(filter_dict)]
+
+    def update_unsafe(self, rowid: int, update_data: Dict[str, Any]):
+        """Cập nhật một bản ghi trong bộ nhớ và giữ chỉ mục đồng bộ."""
+        rec = self._rows[rowid]
+        for f, index in self._indexes.items():
+            if f in update_data and update_data[f] != rec.get(f):
+                self._index_remove(index, rec.get(f), rowid)
+                self._index_add(index, update_data[f], rowid)
+        reorder = self.ordered_index and any(
+            f in update_data and update_data[f] != rec.get(f)
+            for f in self.ordered_index)
+        if reorder:
+            self._ordered_remove(rec, rowid)
+        # Thay bản ghi thay vì sửa tại chỗ, để các tham chiếu mà query() đã
+        # lấy ra vẫn là một ảnh chụp nhất quán
+        rec = freeze({**rec, **update_data})
+        self._rows[rowid] = rec
+        if reorder:
+            self._ordered_add(rec, rowid)
+
+    def delete_unsafe(self, rowids: List[int]):
+        """Xóa các bản ghi khỏi bộ nhớ và khỏi chỉ mục."""
+        for rowid in rowids:
+            rec = self._rows.pop(rowid)
+            for f, index in self._indexes.items():
+                self._index_remove(index, rec.get(f), rowid)
+            if self.ordered_index:
+                self._ordered_remove(rec, rowid)
+
+    def expired_unsafe(self, field: str, cutoff: str,
+                       limit: int) -> List[int]:
+        """
+        rowid của tối đa ``limit`` bản ghi có ``field`` trước ``cutoff``
+        (chuỗi ISO 8601; giờ không múi giờ là giờ địa phương, xem
+        ``_expiry``), cũ nhất trước. Nếu ``field`` là trường thời gian của
+        chỉ mục có thứ tự thì chỉ đọc đầu danh sách của mỗi nhóm thay vì
+        quét bảng. Bản ghi thiếu thời gian hoặc sai kiểu được giữ lại.
+        """
+        is_expired, bound = _expiry(cutoff)
+        if self.ordered_index and self.ordered_index[1] == field:
+            candidates: List[Tuple[str, int]] = []
+            for entries in self._ordered.values():
+                # Bỏ qua các bản ghi không có thời gian (khóa sắp xếp "")
+                lo = bisect.bisect_left(entries, ("\0",))
+                hi = bisect.bisect_left(entries, (bound,), lo)
+                found = 0
+                for i in range(lo, hi):
+                    if is_expired(entries[i][0]):
+                        candidates.append(entries[i])
+                        found += 1
+                        if found >= limit:
+                            break
+            return [rowid for _, rowid in heapq.nsmallest(limit, candidates)]
+        expired = []
+        for rowid, rec in self._rows.items():
+            if is_expired(rec.get(field)):
+                expired.append(rowid)
+                if len(expired) >= limit:
+                    break
+        return expired
+
+    def tombstone_unsafe(self, rowids: List[int]):
+        """
+        Xóa các bản ghi bằng một dòng bia mộ ghi nối vào nhật ký (chỉ sử
+        dụng nội bộ, cache phải vừa được tải dưới khóa ghi): chi phí tỉ lệ
+        với số bản ghi bị xóa thay vì kích thước bảng; lần gộp nhật ký sau
+        loại hẳn chúng khỏi tệp chính.
+        """
+        ids = [self._rows[rowid].get("id") for rowid in rowids]
+        self.delete_unsafe(rowids)
+        if None in ids:
+            # Bản ghi không có id thì không ghi bia mộ được
+            self.flush_unsafe()
+        else:
+            self._append_entry_unsafe({self._TOMBSTONE: ids}, applied=True)
+
+    def _apply_tombstone_unsafe(self, ids: List[Any]):
+        index = self._indexes["id"]
+        rowids: Dict[int, None] = {}
+        for record_id in ids:
+            try:
+                rowids.update(index.get(record_id, {}))
+            except TypeError:
+                continue
+        self.delete_unsafe(list(rowids))
+
+    # --- Đọc/ghi tệp ---
+
+    def load_unsafe(self):
+        """
+        Đảm bảo bộ nhớ đệm khớp với đĩa (chỉ sử dụng nội bộ, cần giữ khóa).
+        Không làm gì nếu tệp chưa bị tiến trình khác thay đổi, ngoài việc
+        đọc thêm phần đuôi mới của nhật ký.
+        """
+        sig = self._signature()
+        if self._rows is not None and sig == self._sig:
+            if self._replay_log_unsafe():
+                return
+
+        records: List[Dict[str, Any]] = []
+        log_id = None
+        if sig is not None:
+            records, log_id = self._read_snapshot()
+        self.reset_unsafe(records)
+        self._sig = sig
+        self._log_id = log_id
+        self._log_offset = 0
+        self._log_ino = None
+        # Sau khi tải lại toàn bộ, nhật ký có thể chứa bản ghi đã nằm trong
+        # tệp chính (nếu lần gộp trước bị ngắt giữa chừng) nên cần lọc trùng
+        self._replay_log_unsafe(dedupe=True)
+
+    def _read_snapshot(self) -> Tuple[List[Dict[str, Any]], Optional[str]]:
+        """Đọc tệp chính, trả về (bản ghi, mã nhật ký)."""
+        try:
+            start = time.perf_counter()
+            with open(self.path, "rb") as f:
+                data = f.read()
+            read = time.perf_counter()
+            value = self.serializer.loads(data)
+            self._io(reads=1, bytes_read=len(data), read_time=read - start,
+                     parse_time=time.perf_counter() - read)
+        except FileNotFoundError:
+            return [], None
+        except ValueError as e:
+            raise CorruptTableError(
+                f"Không đọc được bảng {self.path}: {e}") from e
+        if isinstance(value, list):
+            return value, None  # Định dạng cũ: chỉ là một mảng bản ghi
+        if isinstance(value, dict) and isinstance(value.get("rows"), list):
+            return value["rows"], value.get("log")
+        raise CorruptTableError(f"Sai định dạng bảng {self.path}")
+
+    def _encode_snapshot(self, log_id: str) -> bytes:
+        """Mã hóa bảng trong cache; mã nhật ký đứng đầu để đọc nhanh."""
+        rows = self.serializer.dumps(list(self._rows.values()))
+        return b"".join((self._SNAPSHOT_PREFIX, log_id.encode("ascii"),
+                         b'","rows":', rows, b"}"))
+
+    def _snapshot_log_id(self) -> Optional[str]:
+        """Mã nhật ký của tệp chính, chỉ đọc vài byte đầu tệp."""
+        if self._rows is not None and self._signature() == self._sig:
+            return self._log_id
+        try:
+            with open(self.path, "rb") as f:
+                head = f.read(64)
+        except FileNotFoundError:
+            return None
+        return self._parse_id(head, self._SNAPSHOT_PREFIX)
+
+    @staticmethod
+    def _parse_id(head: bytes, prefix: bytes) -> Optional[str]:
+        if not head.startswith(prefix):
+            return None
+        return head[len(prefix):].split(b'"', 1)[0].decode("ascii")
+
+    def _replay_log_unsafe(self, dedupe: bool = False) -> bool:
+        """
+        Áp dụng phần nhật ký chưa đọc vào cache.
+        Trả về False nếu nhật ký bị cắt ngắn hoặc bị thay thế và cache cần
+        tải lại từ đầu.
+        """
+        start = time.perf_counter()
+        try:
+            f = open(self.log_file, "rb")
+        except FileNotFoundError:
+            return self._log_offset == 0
+        with f:
+            st = os.fstat(f.fileno())
+            if self._log_offset and st.st_ino != self._log_ino:
+                return False
+            self._log_ino = st.st_ino
+            size = st.st_size
+            if size < self._log_offset:
+                return False
+            if size == self._log_offset:
+                return True
+            f.seek(self._log_offset)
+            chunk = f.read(size - self._log_offset)
+        read = time.perf_counter()
+        # Chỉ xử lý các dòng hoàn chỉnh; dòng ghi dở sẽ được đọc ở lần sau
+        end = chunk.rfind(b"\n") + 1
+        if end == 0:
+            return True
+        lines = chunk[:end].splitlines()
+        if self._log_offset == 0:
+            header_id = self._parse_id(lines[0], self._LOG_HEADER_PREFIX)
+            if header_id != self._log_id:
+                # Nhật ký của tệp chính trước (đã được gộp): bỏ qua toàn bộ
+                self._log_offset = size
+                return True
+            if header_id is not None:
+                lines = lines[1:]
+        self._log_offset += end
+
+        ids = self._indexes["id"]
+        for line in lines:
+            if not line.strip():
+                continue
+            try:
+                entry = self.serializer.loads(line)
+            except ValueError:
+                print(f"Bỏ qua dòng nhật ký hỏng trong {self.log_file}")
+                continue
+            if isinstance(entry, dict) and self._TOMBSTONE in entry:
+                self._apply_tombstone_unsafe(entry[self._TOMBSTONE])
+                continue
+            # Một dòng là một bản ghi, hoặc một mảng bản ghi của cả một lô
+            for record in (entry if isinstance(entry, list) else [entry]):
+                if dedupe and record.get("id") in ids:
+                    continue
+                self.insert_unsafe(record)
+        self._io(reads=1, bytes_read=len(chunk), read_time=read - start,
+                 parse_time=time.perf_counter() - read)
+        return True
+
+    def append_unsafe(self, records: List[Dict[str, Any]],
+                      applied: bool = False):
+        """
+        Ghi nối tiếp các bản ghi vào nhật ký (chỉ sử dụng nội bộ), rồi gộp
+        nhật ký nếu nó đã đủ lớn. Nhiều bản ghi được ghi thành một dòng duy
+        nhất (mảng JSON) nên cả lô hoặc được áp dụng hết, hoặc không.
+
+        ``applied=True``: các bản ghi đã có sẵn trong bộ nhớ (giao dịch), nên
+        không đọc lại chúng từ nhật ký.
+        """
+        if not records:
+            return
+        self._append_entry_unsafe(records[0] if len(records) == 1
+                                  else records, applied)
+
+    def _append_entry_unsafe(self, entry: Any, applied: bool):
+        """Ghi nối một dòng nhật ký (xem ``append_unsafe``)."""
+        if not self.exists():
+            if applied:
+                self.flush_unsafe()
+                return
+            self.replace_unsafe([])
+        self._check_log_unsafe()
+        start = time.perf_counter()
+        payload = self.serializer.dumps(entry) + b"\n"
+        encoded = time.perf_counter()
+        with open(self.log_file, "a+b") as f:
+            end = f.seek(0, os.SEEK_END)
+            if end:
+                # Tách dòng ghi dở (nếu tiến trình trước bị ngắt) khỏi dòng mới
+                f.seek(end - 1)
+                if f.read(1) != b"\n":
+                    payload = b"\n" + payload
+            f.write(payload)
+            log_size = f.tell()
+            if self.durability == "full":
+                f.flush()
+                os.fsync(f.fileno())
+            log_ino = os.fstat(f.fileno()).st_ino
+        self._io(writes=1, bytes_written=len(payload),
+                 serialize_time=encoded - start,
+                 write_time=time.perf_counter() - encoded)
+        if applied:
+            # Đang giữ khóa ghi từ lúc tải nên không có dòng nào khác chen vào
+            self._log_offset = log_size
+            self._log_ino = log_ino
+
+        sig = self._signature()
+        snapshot_size = sig[1] if sig else 0
+        if log_size >= max(self.LOG_COMPACT_MIN_BYTES,
+                           self.LOG_COMPACT_RATIO * snapshot_size):
+            self.load_unsafe()
+            self.flush_unsafe()
+
+    def _check_log_unsafe(self):
+        """
+        Đảm bảo nhật ký thuộc về tệp chính hiện tại trước khi ghi nối; nếu
+        không (lần gộp trước bị ngắt giữa chừng) thì làm mới nhật ký.
+        """
+        try:
+            log_ino = os.stat(self.log_file).st_ino
+        except FileNotFoundError:
+            log_ino = None
+        checked = (self._signature(), log_ino)
+        if checked == self._log_checked:
+            return
+        log_id = self._snapshot_log_id()
+        if log_id is None:
+            return  # Tệp chính định dạng cũ: nhật ký không có dòng đầu
+        head = b""
+        if log_ino is not None:
+            with open(self.log_file, "rb") as f:
+                head = f.readline(128)
+        if self._parse_id(head, self._LOG_HEADER_PREFIX) != log_id:
+            self._reset_log_unsafe(log_id)
+            checked = (checked[0], os.stat(self.log_file).st_ino)
+        self._log_checked = checked
+
+    def _reset_log_unsafe(self, log_id: str):
+        """Thay nhật ký bằng một nhật ký rỗng mang mã ``log_id``."""
+        header = b"".join((self._LOG_HEADER_PREFIX, log_id.encode("ascii"),
+                           b'"}\n'))
+        _write_atomic(self.log_file, header, self.durability != "fast")
+
+    def invalidate(self):
+        """Bỏ bộ nhớ đệm để lần đọc sau tải lại từ đĩa."""
+        self._rows = None
+        self._sig = None
+
+    def replace_unsafe(self, records: List[Dict[str, Any]]):
+        """Thay toàn bộ nội dung bảng rồi lưu xuống đĩa."""
+        self.reset_unsafe(records)
+        self.flush_unsafe()
+
+    def flush_unsafe(self):
+        """
+        Lưu toàn bộ bảng trong bộ nhớ vào tệp chính mà không cần khóa (chỉ
+        sử dụng nội bộ), sau đó làm mới nhật ký vì nội dung đã được gộp vào.
+        Tệp chính được thay nguyên tử nên lỗi giữa chừng không làm hỏng dữ
+        liệu cũ; lỗi được báo lại cho người gọi.
+        """
+        prev_sig = self._signature()
+        log_id = uuid.uuid4().hex
+        try:
+            start = time.perf_counter()
+            data = self._encode_snapshot(log_id)
+            encoded = time.perf_counter()
+            _write_atomic(self.path, data, self.durability != "fast")
+            self._io(writes=1, bytes_written=len(data),
+                     serialize_time=encoded - start,
+                     write_time=time.perf_counter() - encoded)
+            self._sig = self._bump_mtime(prev_sig)
+            self._log_id = log_id
+            self._reset_log_unsafe(log_id)
+            self._log_offset = os.path.getsize(self.log_file)
+            self._log_ino = os.stat(self.log_file).st_ino
         except Exception as e:
-            print(f"Lỗi khi lưu cơ sở dữ liệu: {e}")
+            # Cache có thể đã bị sửa dở, buộc tải lại từ tệp ở lần sau
+            self.invalidate()
+            print(f"Lỗi khi lưu bảng {self.path}: {e}")
+            raise
+
+    def _bump_mtime(self, prev_sig: Optional[Tuple[int, int, int]]
+                    ) -> Optional[Tuple[int, int, int]]:
+        """
+        Đảm bảo mtime tăng nghiêm ngặt sau mỗi lần ghi, để tiến trình khác
+        không bỏ lỡ thay đổi khi hai lần ghi rơi vào cùng một tick đồng hồ.
+        """
+        sig = self._signature()
+        if sig is not None and prev_sig is not None and sig[2] <= prev_sig[2]:
+            mtime_ns = prev_sig[2] + 1
+            os.utime(self.path, ns=(mtime_ns, mtime_ns))
+            sig = self._signature()
+        return sig
+
+
+class _Transaction:
+    """
+    Trạng thái của một giao dịch đang mở: các bảng đã khóa ghi, các bản ghi
+    thêm mới đang chờ ghi nối tiếp và các bảng cần ghi lại toàn bộ.
+    """
+    def __init__(self, stores: Dict[str, "_TableStore"]):
+        self.stores = stores
+        self.appends: Dict[str, List[Dict[str, Any]]] = {t: [] for t in stores}
+        self.dirty: set = set()
+
+    def commit(self) -> bool:
+        """
+        Ghi mỗi bảng đúng một lần: ghi lại toàn bộ hoặc nối một lô. Trả về
+        True nếu có bảng nào được ghi.
+        """
+        changed = False
+        for table, store in self.stores.items():
+            if table in self.dirty:
+                store.flush_unsafe()
+            elif self.appends[table]:
+                store.append_unsafe(self.appends[table], applied=True)
+            else:
+                continue
+            store.bump_version_unsafe()
+            changed = True
+        return changed
+
+    def rollback(self):
+        """Bỏ bộ nhớ đệm đã sửa; lần đọc sau tải lại từ đĩa."""
+        for store in self.stores.values():
+            store.invalidate()
+
+
+class StorageBackend:
+    """
+    Giao diện chung của các backend lưu trữ. ``TerraSyncDB``, ``crop_db``
+    và mọi nơi gọi chỉ dùng các phương thức dưới đây nên có thể đổi backend
+    (``JsonDB``, ``database_sqlite.SQLiteDB``) qua ``create_db()`` mà không
+    sửa mã gọi.
+
+    Bản ghi là dict JSON; ``add``/``add_many`` tự gán ``id`` và
+    ``created_at`` nếu thiếu. Bộ lọc nhận giá trị (so sánh bằng) hoặc toán
+    tử ``$gt``/``$gte``/``$lt``/``$lte``/``$ne``/``$in``/``$nin``.
+
+    Bản ghi trả về là chỉ đọc (``FrozenDict``): mọi thay đổi đi qua
+    ``update()``; cần một bản sửa được thì dùng ``dict(rec)``.
+
+    ``INDEXES`` khai báo chỉ mục theo bảng và ``ORDERED_INDEXES`` chỉ mục
+    có thứ tự ``(trường nhóm, trường thời gian)`` cho ``latest()``,
+    ``range()`` và ``tail()``; ``data_dir`` là thư mục cho dữ liệu phụ
+    (vd. kho cột telemetry).
+
+    Mỗi bảng có một phiên bản tăng sau mỗi lần ghi, kể cả từ tiến trình
+    khác; ``wait_for_changes()``/``subscribe()`` dựa vào đó để chỉ thức
+    dậy khi bảng thực sự thay đổi thay vì đọc lại theo chu kỳ.
+
+    ``TTL`` (hoặc ``set_ttl()``) đặt thời hạn giữ bản ghi theo bảng, tính
+    trên trường thời gian của chỉ mục có thứ tự (mặc định ``created_at``);
+    ``expire_step()`` xóa dần từng lô nhỏ bản ghi đã hết hạn.
+
+    Các thao tác trong ``_INSTRUMENTED`` của mọi lớp con được tự động đo
+    (thời gian, số bản ghi duyệt/trả về) vào ``metrics``; ``stats()`` trả
+    về số liệu đó cùng thời gian chờ khóa.
+    """
+    _TABLE_NAME_RE = re.compile(r"^[A-Za-z0-9_\-]+$")
+    # {bảng: (các trường cần chỉ mục)}
+    INDEXES: Dict[str, Tuple[str, ...]] = {}
+    # {bảng: (trường nhóm, trường thời gian)}
+    ORDERED_INDEXES: Dict[str, Tuple[str, str]] = {}
+    # {bảng: số giây giữ bản ghi}
+    TTL: Dict[str, int] = {}
+    # Số bản ghi hết hạn tối đa mỗi bảng xóa trong một lần expire_step()
+    EXPIRE_BATCH = 1000
+    SERIALIZER = "auto"
+    DURABILITY = "safe"
+    # Chu kỳ (giây) kiểm tra phiên bản khi chờ thay đổi từ tiến trình khác;
+    # thay đổi trong cùng tiến trình đánh thức người chờ ngay lập tức
+    CHANGE_POLL_INTERVAL = 0.25
+    # Các thao tác được đo tự động (xem DBMetrics)
+    _INSTRUMENTED = ("get", "query", "count", "latest", "range", "tail",
+                     "add_many", "update", "delete", "overwrite_table")
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        for op in cls._INSTRUMENTED:
+            method = cls.__dict__.get(op)
+            if method is not None and not getattr(method, "_instrumented",
+                                                  False):
+                setattr(cls, op, _instrumented(op, method))
+
+    def __init__(self, db_file: str,
+                 indexes: Optional[Dict[str, Iterable[str]]] = None,
+                 ordered_indexes: Optional[Dict[str, Tuple[str, str]]] = None,
+                 serializer=None, durability: Optional[str] = None,
+                 ttl: Optional[Dict[str, int]] = None):
+        self.db_file = db_file
+        self.metrics = DBMetrics()
+        serializer = serializer or self.SERIALIZER
+        self.serializer = (get_serializer(serializer)
+                           if isinstance(serializer, str) else serializer)
+        self.durability = durability or self.DURABILITY
+        if self.durability not in DURABILITY_LEVELS:
+            raise ValueError(
+                f"Mức độ bền vững không hợp lệ: {self.durability!r}")
+        self.ordered_indexes = {**self.ORDERED_INDEXES,
+                                **(ordered_indexes or {})}
+        self.ttl = {**self.TTL, **(ttl or {})}
+        self.indexes: Dict[str, List[str]] = {
+            table: list(fields) for table, fields in self.INDEXES.items()}
+        for table, fields in (indexes or {}).items():
+            self.indexes.setdefault(table, [])
+            self.indexes[table] += [
+                f for f in fields if f not in self.indexes[table]]
+        base, ext = os.path.splitext(db_file)
+        self.data_dir = base if ext else f"{db_file}.d"
+        self._tx_local = threading.local()
+        self._changed = threading.Condition()
+        self._change_seq = 0
+
+    @property
+    def location(self) -> str:
+        """Nơi lưu dữ liệu chính (thư mục hoặc tệp), để hiển thị."""
+        return self.data_dir
+
+    def stats(self) -> Dict[str, Any]:
+        """
+        Số liệu đo của tiến trình này (xem ``DBMetrics.snapshot()``) kèm
+        ``"locks"``: số lần lấy khóa và thời gian chờ theo bảng.
+        """
+        return {**self.metrics.snapshot(), "locks": self.lock_stats()}
+
+    def reset_stats(self):
+        """Xóa số liệu đo (kể cả thời gian chờ khóa) của tiến trình này."""
+        self.metrics.reset()
+
+    def lock_stats(self) -> Dict[str, Dict[str, Dict[str, float]]]:
+        """Thời gian chờ khóa theo bảng (rỗng nếu backend không đo)."""
+        return {}
+
+    def _check_table_name(self, table: str):
+        """Tên bảng được dùng làm tên tệp nên chỉ cho phép ký tự an toàn."""
+        if not self._TABLE_NAME_RE.match(table):
+            raise ValueError(f"Tên bảng không hợp lệ: {table!r}")
+
+    def transaction(self, *tables: str):
+        """Context manager gom các thao tác ghi trên ``tables``."""
+        raise NotImplementedError
+
+    def batch(self, *tables: str):
+        """Tên khác của ``transaction()``."""
+        return self.transaction(*tables)
+
+    def ensure_table(self, table: str):
+        """Tạo bảng rỗng nếu chưa tồn tại."""
+        raise NotImplementedError
+
+    def create_index(self, table: str, field: str):
+        """Khai báo thêm một chỉ mục cho ``table.field``."""
+        raise NotImplementedError
+
+    def compact(self, table: Optional[str] = None):
+        """Thu gọn dữ liệu trên đĩa của một hoặc mọi bảng."""
+        raise NotImplementedError
+
+    def tables(self) -> List[str]:
+        """Lấy danh sách các bảng."""
+        raise NotImplementedError
+
+    def backup(self, dest: str) -> Dict[str, int]:
+        """
+        Sao lưu nhất quán tại một thời điểm trong khi các tiến trình khác
+        vẫn ghi. Trả về ``{tệp/bảng: số byte đã chép}``.
+        """
+        raise NotImplementedError
 
     def add(self, table: str, data: Dict[str, Any]) -> bool:
         """Thêm một bản ghi vào một bảng một cách an toàn."""
-        with self.lock:
-            db_data = self._load_unsafe()
-            if table not in db_data:
-                db_data[table] = []
+        return self.add_many(table, [data]) == 1
 
-            if "id" not in data:
-                data["id"] = str(uuid.uuid4())
-            if "created_at" not in data:
-                data["created_at"] = datetime.now().isoformat()
-
-            db_data[table].append(data)
-            self._save_unsafe(db_data)
-        return True
+    def add_many(self, table: str, records: List[Dict[str, Any]]) -> int:
+        """Thêm nhiều bản ghi trong một lần ghi. Trả về số bản ghi đã thêm."""
+        raise NotImplementedError
 
     def get(self, table: str,
             filter_dict: Optional[Dict[str, Any]] = None
             ) -> List[Dict[str, Any]]:
-        """Lấy các bản ghi từ một bảng một cách an toàn."""
-        with self.lock:
-            db_data = self._load_unsafe()
-            if table not in db_data:
-                return []
-
-            records = db_data[table]
-            if filter_dict:
-                return [rec for rec in records
-                        if all(rec.get(k) == v for k, v in filter_dict.items())]
-            return records.copy()
+        """Lấy (bản sao) các bản ghi khớp bộ lọc."""
+        raise NotImplementedError
 
     def get_by_id(self, table: str,
                   record_id: str) -> Optional[Dict[str, Any]]:
@@ -77,70 +1630,716 @@ class JsonDB:
         records = self.get(table, {"id": record_id})
         return records[0] if records else None
 
+    def query(self, table: str,
+              filter_dict: Optional[Dict[str, Any]] = None,
+              fields: Optional[Iterable[str]] = None,
+              order_by: Optional[str] = None,
+              limit: Optional[int] = None, offset: int = 0,
+              after: Any = None) -> Iterator[Dict[str, Any]]:
+        """Truy vấn có chiếu trường, sắp xếp và phân trang (xem ``JsonDB``)."""
+        raise NotImplementedError
+
+    def scan(self, table: str, batch_size: int = 1000,
+             after: Optional[str] = None) -> Iterator[List[Dict[str, Any]]]:
+        """
+        Duyệt cả bảng theo thứ tự ``id`` thành từng lô tối đa ``batch_size``
+        bản ghi, bắt đầu sau bản ghi có id ``after`` (để tiếp tục một lần
+        duyệt dở). Vị trí là khóa chứ không phải số thứ tự, nên bản ghi bị
+        xóa giữa hai lần chạy không làm lệch phần còn lại; bản ghi cũ thiếu
+        id đứng đầu thứ tự. Dùng cho xuất/chuyển dữ liệu hàng loạt: backend
+        chỉ giữ một lô trong bộ nhớ khi có thể.
+        """
+        rows = self.query(table, order_by="id", after=after)
+        while True:
+            batch = list(islice(rows, batch_size))
+            if not batch:
+                return
+            yield batch
+
+    def count(self, table: str,
+              filter_dict: Optional[Dict[str, Any]] = None) -> int:
+        """Đếm số bản ghi khớp bộ lọc."""
+        raise NotImplementedError
+
+    def latest(self, table: str,
+               key: Any = None) -> Optional[Dict[str, Any]]:
+        """Bản ghi mới nhất của nhóm ``key`` theo chỉ mục có thứ tự."""
+        raise NotImplementedError
+
+    def range(self, table: str, key: Any, since: Any = None,
+              until: Any = None) -> List[Dict[str, Any]]:
+        """Các bản ghi của nhóm ``key`` có ``since <= thời gian < until``."""
+        raise NotImplementedError
+
+    def tail(self, table: str, key: Any, n: int) -> List[Dict[str, Any]]:
+        """N bản ghi mới nhất của nhóm ``key``, theo thời gian tăng dần."""
+        raise NotImplementedError
+
     def update(self, table: str, filter_dict: Dict[str, Any],
                update_data: Dict[str, Any]) -> int:
-        """Cập nhật các bản ghi dựa trên một bộ lọc một cách an toàn."""
+        """Cập nhật các bản ghi khớp bộ lọc. Trả về số bản ghi đã sửa."""
+        raise NotImplementedError
+
+    def delete(self, table: str,
+               filter_dict: Optional[Dict[str, Any]] = None) -> int:
+        """Xóa các bản ghi khớp bộ lọc. Trả về số bản ghi đã xóa."""
+        raise NotImplementedError
+
+    def overwrite_table(self, table: str, data: List[Dict[str, Any]]):
+        """Ghi đè toàn bộ dữ liệu của một bảng."""
+        raise NotImplementedError
+
+    # --- Luồng thay đổi ---
+
+    def version(self, table: str) -> int:
+        """
+        Phiên bản của bảng: tăng mỗi khi một lần ghi trên bảng được lưu
+        (từ bất kỳ tiến trình nào); 0 nếu bảng chưa từng được ghi.
+        """
+        raise NotImplementedError
+
+    def versions(self, *tables: str) -> Dict[str, int]:
+        """Phiên bản hiện tại của các bảng ``tables``."""
+        return {table: self.version(table) for table in tables}
+
+    def _notify_change(self):
+        """Đánh thức các luồng đang chờ sau một lần ghi của tiến trình này."""
+        with self._changed:
+            self._change_seq += 1
+            self._changed.notify_all()
+
+    def wait_for_changes(self, since: Dict[str, int],
+                         timeout: Optional[float] = None) -> Dict[str, int]:
+        """
+        Chờ tới khi một trong các bảng của ``since`` (``{bảng: phiên bản đã
+        thấy}``) đổi phiên bản. Trả về ``{bảng: phiên bản mới}`` của các
+        bảng đã đổi, hoặc ``{}`` nếu hết ``timeout`` giây.
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            seq = self._change_seq
+            changed = {table: version for table, version
+                       in self.versions(*since).items()
+                       if version != since[table]}
+            if changed:
+                return changed
+            wait = self.CHANGE_POLL_INTERVAL
+            if deadline is not None:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return {}
+                wait = min(wait, remaining)
+            with self._changed:
+                if self._change_seq == seq:
+                    self._changed.wait(wait)
+
+    def subscribe(self, *tables: str, since: Optional[Dict[str, int]] = None,
+                  timeout: Optional[float] = None
+                  ) -> Iterator[Dict[str, int]]:
+        """
+        Luồng thay đổi của ``tables``: mỗi lần có bảng được ghi, sinh ra
+        ``{bảng: phiên bản mới}``::
+
+            for changed in db.subscribe("telemetry", "alerts"):
+                if "alerts" in changed:
+                    ...
+
+        ``since``: các phiên bản đã xử lý (vd. lưu từ lần chạy trước) để
+        nhận cả những thay đổi đã lỡ; mặc định chỉ nhận thay đổi từ lúc
+        gọi. ``timeout``: kết thúc khi không có thay đổi trong ngần ấy giây.
+        """
+        seen = self.versions(*tables)
+        seen.update({t: v for t, v in (since or {}).items() if t in seen})
+        while True:
+            changed = self.wait_for_changes(seen, timeout)
+            if not changed:
+                return
+            seen.update(changed)
+            yield changed
+
+    # --- Thời hạn giữ bản ghi (TTL) ---
+
+    def set_ttl(self, table: str, seconds: Optional[int]):
+        """Đặt thời hạn giữ bản ghi (giây) của bảng; ``None`` để bỏ."""
+        self._check_table_name(table)
+        if seconds:
+            self.ttl[table] = int(seconds)
+        else:
+            self.ttl.pop(table, None)
+
+    def ttl_field(self, table: str) -> str:
+        """Trường thời gian dùng để tính hạn của bản ghi trong bảng."""
+        ordered = self.ordered_indexes.get(table)
+        return ordered[1] if ordered else "created_at"
+
+    def expire_step(self, table: Optional[str] = None,
+                    limit: Optional[int] = None) -> int:
+        """
+        Xóa một lô nhỏ (tối đa ``limit`` bản ghi mỗi bảng, mặc định
+        ``EXPIRE_BATCH``) các bản ghi đã quá hạn ``ttl`` của một hoặc mọi
+        bảng. Gọi lặp lại thường xuyên (vd. mỗi phút) thay vì dọn cả bảng
+        một lần: mỗi lần chỉ giữ khóa ghi trong thời gian ngắn nên không
+        chặn việc ghi dữ liệu mới. Trả về số bản ghi đã xóa.
+        """
+        now = datetime.now(timezone.utc)
+        removed = 0
+        for name in ([table] if table else sorted(self.ttl)):
+            seconds = self.ttl.get(name)
+            if not seconds:
+                continue
+            cutoff = (now - timedelta(seconds=seconds)).isoformat()
+            removed += self._expire(name, self.ttl_field(name), cutoff,
+                                    limit or self.EXPIRE_BATCH)
+        return removed
+
+    def _expire(self, table: str, field: str, cutoff: str,
+                limit: int) -> int:
+        """
+        Xóa tối đa ``limit`` bản ghi có ``field`` trước ``cutoff`` (chuỗi
+        ISO 8601 UTC); giờ không múi giờ đã lưu là giờ địa phương.
+        """
+        raise NotImplementedError
+
+    def export_json(self, table: str, dest: str, indent: int = 2) -> int:
+        """
+        Xuất một bảng ra tệp JSON dễ đọc (một mảng bản ghi, thụt lề
+        ``indent``), vd. để kiểm tra bằng mắt hoặc sửa tay. Trả về số bản ghi.
+        """
+        rows = list(self.query(table))
+        _write_atomic(dest, JsonSerializer(indent=indent).dumps(rows),
+                      durable=False)
+        return len(rows)
+
+
+class JsonDB(StorageBackend):
+    """
+    Một lớp cơ sở để quản lý dữ liệu dạng JSON.
+    Cung cấp các hoạt động CRUD cơ bản với cơ chế khóa tệp để đảm bảo an toàn cho luồng.
+
+    Mỗi bảng nằm trong một tệp riêng với khóa riêng trong thư mục
+    ``<db_file không đuôi>/`` (vd. ``terrasync_db/telemetry.json``), nên ghi
+    vào một bảng nóng như ``telemetry`` không chặn việc đọc ``users`` hay
+    ``fields``. Tệp một-khối cũ (``db_file``) được tự động tách thành các
+    bảng ở lần khởi tạo đầu tiên và đổi tên thành ``<db_file>.migrated``.
+
+    Chỉ mục băm phụ được khai báo theo bảng qua ``INDEXES`` (của lớp) hoặc
+    tham số ``indexes``; trường ``id`` luôn có chỉ mục. ``get()`` tự chọn
+    chỉ mục chọn lọc nhất trong bộ lọc.
+
+    ``ORDERED_INDEXES`` khai báo chỉ mục có thứ tự ``(trường nhóm, trường
+    thời gian)`` cho ``latest()``, ``range()`` và ``tail()``, và cho
+    ``query()`` khi sắp xếp theo trường thời gian đó.
+
+    ``transaction()`` (hay ``batch()``) gom nhiều thao tác add/update/delete
+    trên các bảng đã khai báo: tải một lần, áp dụng trong bộ nhớ và ghi mỗi
+    bảng đúng một lần khi thoát khối ``with``.
+
+    Tệp được ghi dạng JSON gọn bằng ``serializer`` (``"auto"``: orjson nếu
+    đã cài) và thay thế nguyên tử; ``durability`` chọn mức fsync (xem
+    ``DURABILITY_LEVELS``). ``export_json()`` xuất bản dễ đọc khi cần.
+    """
+    def __init__(self, db_file: str,
+                 indexes: Optional[Dict[str, Iterable[str]]] = None,
+                 ordered_indexes: Optional[Dict[str, Tuple[str, str]]] = None,
+                 serializer=None, durability: Optional[str] = None,
+                 ttl: Optional[Dict[str, int]] = None):
+        super().__init__(db_file, indexes, ordered_indexes, serializer,
+                         durability, ttl)
+        # Khóa của tệp một-khối cũ, chỉ dùng khi chuyển đổi định dạng
+        self.lock_file = f"{db_file}.lock"
+        self.lock = FileLock(self.lock_file)
+        self._stores: Dict[str, _TableStore] = {}
+        self._stores_mutex = threading.Lock()
+        self._migrate_single_file()
+
+    def _migrate_single_file(self):
+        """Tách tệp một-khối cũ thành các tệp theo bảng (chỉ chạy một lần)."""
+        if not os.path.isfile(self.db_file):
+            return
         with self.lock:
-            db_data = self._load_unsafe()
-            if table not in db_data or not db_data[table]:
-                return 0
+            if not os.path.isfile(self.db_file):
+                return  # Tiến trình khác đã chuyển đổi xong
+            if not os.path.isdir(self.data_dir):
+                # Tệp cũ là một dict {bảng: [bản ghi]}; nhật ký cũ (nếu có)
+                # chứa các dòng {"table": ..., "record": ...}
+                try:
+                    with open(self.db_file, "rb") as f:
+                        db_data = self.serializer.loads(f.read())
+                except ValueError as e:
+                    # Không đổi tên tệp hỏng thành .migrated (sẽ mất dữ liệu)
+                    raise CorruptTableError(
+                        f"Không đọc được {self.db_file}: {e}") from e
+                self._merge_legacy_log(f"{self.db_file}.log", db_data)
+
+                tmp_dir = f"{self.data_dir}.tmp"
+                shutil.rmtree(tmp_dir, ignore_errors=True)
+                os.makedirs(tmp_dir)
+                for table, records in db_data.items():
+                    self._check_table_name(table)
+                    _TableStore(os.path.join(tmp_dir, f"{table}.json"),
+                                serializer=self.serializer,
+                                durability=self.durability
+                                ).replace_unsafe(records)
+                os.rename(tmp_dir, self.data_dir)
+                print(f"Đã tách {self.db_file} thành {len(db_data)} bảng "
+                      f"trong {self.data_dir}/")
+            os.replace(self.db_file, f"{self.db_file}.migrated")
+            if os.path.exists(f"{self.db_file}.log"):
+                os.replace(f"{self.db_file}.log",
+                           f"{self.db_file}.log.migrated")
+
+    @staticmethod
+    def _merge_legacy_log(log_file: str, db_data: Dict[str, List[Any]]):
+        """Gộp nhật ký của định dạng một-khối vào dữ liệu đã tải."""
+        if not os.path.exists(log_file):
+            return
+        seen: Dict[str, set] = {}
+        with open(log_file, "rb") as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                    table, record = entry["table"], entry["record"]
+                except (ValueError, KeyError, TypeError):
+                    continue
+                records = db_data.setdefault(table, [])
+                if table not in seen:
+                    seen[table] = {rec.get("id") for rec in records}
+                if record.get("id") not in seen[table]:
+                    seen[table].add(record.get("id"))
+                    records.append(record)
+
+    def _store(self, table: str) -> _TableStore:
+        """Lấy (hoặc tạo) đối tượng lưu trữ của một bảng."""
+        store = self._stores.get(table)
+        if store is None:
+            self._check_table_name(table)
+            with self._stores_mutex:
+                store = self._stores.get(table)
+                if store is None:
+                    os.makedirs(self.data_dir, exist_ok=True)
+                    store = _TableStore(
+                        os.path.join(self.data_dir, f"{table}.json"),
+                        self.indexes.get(table, ()),
+                        self.ordered_indexes.get(table),
+                        self.serializer, self.durability, self.metrics)
+                    self._stores[table] = store
+        return store
+
+    @contextmanager
+    def transaction(self, *tables: str):
+        """
+        Mở một giao dịch trên các bảng ``tables``::
+
+            with db.transaction("telemetry", "alerts"):
+                db.add("telemetry", record)
+                for alert in alerts:
+                    db.add("alerts", alert)
+
+        Các bảng được khóa ghi theo thứ tự tên (tránh deadlock giữa các
+        tiến trình) và tải một lần. Trong khối ``with``, các thao tác của
+        luồng hiện tại trên các bảng này chỉ sửa bộ nhớ (và thấy được thay
+        đổi của nhau). Khi thoát, mỗi bảng được ghi một lần; nếu có ngoại lệ
+        thì mọi thay đổi bị hủy. Truy cập bảng chưa khai báo trong giao dịch
+        sẽ báo ``ValueError``. Tính nguyên tử được đảm bảo trong từng bảng,
+        không xuyên suốt nhiều tệp bảng.
+        """
+        current = getattr(self._tx_local, "tx", None)
+        if current is not None:
+            # Giao dịch lồng nhau nhập vào giao dịch ngoài cùng
+            missing = set(tables) - set(current.stores)
+            if missing:
+                raise ValueError(
+                    f"Giao dịch lồng nhau dùng bảng chưa khai báo: {missing}")
+            yield self
+            return
+
+        stores = {t: self._store(t) for t in sorted(set(tables))}
+        with ExitStack() as stack:
+            for store in stores.values():
+                stack.enter_context(store.writing())
+                store.load_unsafe()
+            tx = _Transaction(stores)
+            self._tx_local.tx = tx
+            try:
+                yield self
+                if tx.commit():
+                    self._notify_change()
+            except BaseException:
+                tx.rollback()
+                raise
+            finally:
+                self._tx_local.tx = None
+
+    def _active_tx(self, table: str) -> Optional[_Transaction]:
+        """Giao dịch đang mở của luồng hiện tại (nếu có) chứa ``table``."""
+        tx = getattr(self._tx_local, "tx", None)
+        if tx is not None and table not in tx.stores:
+            raise ValueError(
+                f"Bảng {table!r} chưa được khai báo trong giao dịch")
+        return tx
+
+    def create_index(self, table: str, field: str):
+        """Khai báo thêm một chỉ mục băm cho ``table.field``."""
+        fields = self.indexes.setdefault(table, [])
+        if field not in fields:
+            fields.append(field)
+        store = self._store(table)
+        with store.reading():
+            store.create_index(field)
+
+    def ensure_table(self, table: str):
+        """Tạo tệp bảng rỗng nếu chưa tồn tại."""
+        store = self._store(table)
+        if store.exists():
+            return
+        with store.writing():
+            if not store.exists():
+                store.replace_unsafe([])
+
+    def compact(self, table: Optional[str] = None):
+        """
+        Gộp nhật ký ghi nối tiếp (kể cả bia mộ) vào tệp chính của một hoặc
+        mọi bảng, lần lượt từng bảng. Bảng chưa có trong bộ nhớ đệm được
+        bỏ khỏi bộ nhớ ngay sau khi gộp, nên bộ nhớ dùng chỉ cỡ bảng lớn
+        nhất chứ không phải cả CSDL.
+        """
+        for name in ([table] if table else self.tables()):
+            store = self._store(name)
+            with store.writing():
+                cached = store.loaded
+                store.load_unsafe()
+                store.flush_unsafe()
+                if not cached:
+                    store.invalidate()
+
+    def backup(self, dest: str) -> Dict[str, int]:
+        """
+        Sao lưu mọi bảng vào thư mục ``dest`` (cùng bố cục với
+        ``data_dir``) trong khi các tiến trình khác vẫn ghi.
+
+        Tệp chính chỉ được thay nguyên tử và nhật ký chỉ được ghi nối, nên
+        tệp chính đã mở cùng độ dài nhật ký tại lúc mở là một ảnh chụp
+        nhất quán của bảng. Mọi bảng được khóa đọc cùng lúc (theo thứ tự
+        tên) chỉ trong lúc mở tệp, nên các bảng cùng một thời điểm và người
+        ghi gần như không phải chờ; việc chép diễn ra sau khi nhả khóa,
+        từng khối một. Khôi phục: dừng các tiến trình rồi thay ``data_dir``
+        bằng ``dest``.
+        """
+        if os.path.abspath(dest) == os.path.abspath(self.data_dir):
+            raise ValueError("Thư mục sao lưu trùng với thư mục dữ liệu")
+        names = self.tables()
+        stores = [self._store(name) for name in names]
+        opened = []
+        try:
+            with ExitStack() as locks:
+                for store in stores:
+                    locks.enter_context(store.reading())
+                for store in stores:
+                    snapshot = _open_existing(store.path)
+                    log = _open_existing(store.log_file)
+                    log_size = os.fstat(log.fileno()).st_size if log else 0
+                    opened.append((store, snapshot, log, log_size))
+            os.makedirs(dest, exist_ok=True)
+            copied = {}
+            for store, snapshot, log, log_size in opened:
+                base = os.path.basename(store.path)
+                if snapshot is not None:
+                    copied[base] = _copy_file(
+                        snapshot, os.path.join(dest, base))
+                if log is not None:
+                    log_base = os.path.basename(store.log_file)
+                    copied[log_base] = _copy_file(
+                        log, os.path.join(dest, log_base), log_size)
+            _fsync_dir(dest)
+            return copied
+        finally:
+            for _, snapshot, log, _ in opened:
+                for f in (snapshot, log):
+                    if f is not None:
+                        f.close()
+
+    def add_many(self, table: str, records: List[Dict[str, Any]]) -> int:
+        """
+        Thêm nhiều bản ghi trong một lần ghi nối tiếp duy nhất (cả lô được
+        áp dụng nguyên tử). Trả về số bản ghi đã thêm.
+        """
+        store = self._store(table)
+        with store.writing():
+            tx = self._active_tx(table)
+            now = datetime.now().isoformat()
+            for data in records:
+                if "id" not in data:
+                    data["id"] = str(uuid.uuid4())
+                if "created_at" not in data:
+                    data["created_at"] = now
+
+            if tx is not None:
+                store.load_unsafe()
+                for data in records:
+                    record = freeze(data)
+                    store.insert_unsafe(record)
+                    tx.appends[table].append(record)
+            elif records:
+                store.append_unsafe(records)
+                store.bump_version_unsafe()
+                self._notify_change()
+        return len(records)
+
+    def get(self, table: str,
+            filter_dict: Optional[Dict[str, Any]] = None
+            ) -> List[Dict[str, Any]]:
+        """
+        Lấy các bản ghi từ một bảng một cách an toàn. Bộ lọc nhận giá trị
+        (so sánh bằng) hoặc toán tử ``$gt``/``$gte``/``$lt``/``$lte``/
+        ``$ne``/``$in``/``$nin``, vd. ``{"level": {"$in": ["critical"]}}``.
+        """
+        store = self._store(table)
+        with store.reading():
+            self._active_tx(table)
+            # Bản ghi trong cache là chỉ đọc nên trả về thẳng, không sao chép
+            store.load_unsafe()
+            return store.find_unsafe(filter_dict)
+
+    def query(self, table: str,
+              filter_dict: Optional[Dict[str, Any]] = None,
+              fields: Optional[Iterable[str]] = None,
+              order_by: Optional[str] = None,
+              limit: Optional[int] = None, offset: int = 0,
+              after: Any = None) -> Iterator[Dict[str, Any]]:
+        """
+        Truy vấn một bảng, trả về iterator các bản ghi::
+
+            db.query("telemetry", {"hub_id": hub_id},
+                     fields=["timestamp", "data"],
+                     order_by="-timestamp", limit=50)
+
+        - ``filter_dict``: như ``get()``, gồm cả các toán tử so sánh.
+        - ``fields``: chỉ lấy các trường này (mặc định: cả bản ghi).
+        - ``order_by``: tên trường, thêm ``-`` phía trước để giảm dần;
+          mặc định theo thứ tự chèn.
+        - ``limit``/``offset``: phân trang; ``after``: phân trang theo khóa
+          (xem ``_TableStore.select_unsafe``).
 
-            updated_count = 0
-            for rec in db_data[table]:
-                if all(rec.get(k) == v for k, v in filter_dict.items()):
-                    rec.update(update_data)
-                    rec["updated_at"] = datetime.now().isoformat()
-                    updated_count += 1
+        Việc chọn bản ghi diễn ra trong lúc giữ khóa đọc, còn việc cắt
+        trường (nếu có ``fields``) diễn ra dần khi duyệt iterator, nên chi
+        phí tỉ lệ với số bản ghi trả về thay vì kích thước bảng.
+        """
+        fields = list(fields) if fields is not None else None
+        store = self._store(table)
+        with store.reading():
+            self._active_tx(table)
+            store.load_unsafe()
+            # Bản ghi trong cache được thay chứ không sửa tại chỗ, nên các
+            # tham chiếu này vẫn nhất quán sau khi nhả khóa
+            records = store.select_unsafe(filter_dict, order_by, offset,
+                                          limit, after)
+        self.metrics.note(returned=len(records))
+        return (_project(rec, fields) for rec in records)
 
-            if updated_count > 0:
-                self._save_unsafe(db_data)
-            return updated_count
+    def scan(self, table: str, batch_size: int = 1000,
+             after: Optional[str] = None) -> Iterator[List[Dict[str, Any]]]:
+        """
+        Duyệt cả bảng thành từng lô (xem ``StorageBackend.scan``). Cả bảng
+        nằm trong một tệp nên vẫn phải tải một lần và sắp theo id một lần;
+        bảng chưa có trong bộ nhớ đệm được bỏ khỏi đó ngay sau khi chọn bản
+        ghi, nên duyệt lần lượt mọi bảng chỉ giữ một bảng trong bộ nhớ.
+        """
+        store = self._store(table)
+        with store.reading():
+            cached = store.loaded
+            self._active_tx(table)
+            store.load_unsafe()
+            records = store.select_unsafe(order_by="id", after=after)
+        if not cached:
+            with store.writing():
+                store.invalidate()
+        for i in range(0, len(records), batch_size):
+            yield records[i:i + batch_size]
+
+    def count(self, table: str,
+              filter_dict: Optional[Dict[str, Any]] = None) -> int:
+        """Đếm số bản ghi khớp bộ lọc mà không sao chép bản ghi nào."""
+        store = self._store(table)
+        with store.reading():
+            self._active_tx(table)
+            store.load_unsafe()
+            return store.count_unsafe(filter_dict)
+
+    def _ordered_store(self, table: str) -> _TableStore:
+        store = self._store(table)
+        if not store.ordered_index:
+            raise ValueError(f"Bảng {table!r} không có chỉ mục có thứ tự")
+        return store
+
+    def latest(self, table: str,
+               key: Any = None) -> Optional[Dict[str, Any]]:
+        """
+        Bản ghi mới nhất của nhóm ``key`` theo chỉ mục có thứ tự của bảng
+        (vd. telemetry mới nhất của một hub). ``key=None``: mới nhất toàn bảng.
+        """
+        store = self._ordered_store(table)
+        with store.reading():
+            self._active_tx(table)
+            store.load_unsafe()
+            return store.latest_unsafe(key)
+
+    def range(self, table: str, key: Any, since: Any = None,
+              until: Any = None) -> List[Dict[str, Any]]:
+        """
+        Các bản ghi của nhóm ``key`` có ``since <= thời gian < until``
+        (chuỗi ISO 8601 hoặc datetime), theo thứ tự thời gian tăng dần.
+        """
+        store = self._ordered_store(table)
+        with store.reading():
+            self._active_tx(table)
+            store.load_unsafe()
+            return list(store.ordered_unsafe(key, since, until))
+
+    def tail(self, table: str, key: Any, n: int) -> List[Dict[str, Any]]:
+        """N bản ghi mới nhất của nhóm ``key``, theo thứ tự thời gian tăng dần."""
+        store = self._ordered_store(table)
+        with store.reading():
+            self._active_tx(table)
+            if n <= 0:
+                return []
+            store.load_unsafe()
+            return list(store.ordered_unsafe(key, last=n))
+
+    def update(self, table: str, filter_dict: Dict[str, Any],
+               update_data: Dict[str, Any]) -> int:
+        """Cập nhật các bản ghi dựa trên một bộ lọc một cách an toàn."""
+        store = self._store(table)
+        with store.writing():
+            tx = self._active_tx(table)
+            store.load_unsafe()
+            rowids = store.match_unsafe(filter_dict)
+            for rowid in rowids:
+                changes = dict(update_data)
+                changes["updated_at"] = datetime.now().isoformat()
+                store.update_unsafe(rowid, changes)
+
+            if rowids:
+                self._write_back(store, table, tx)
+            return len(rowids)
 
     def delete(self, table: str,
                filter_dict: Optional[Dict[str, Any]] = None) -> int:
         """Xóa các bản ghi dựa trên một bộ lọc một cách an toàn."""
-        with self.lock:
-            db_data = self._load_unsafe()
-            if table not in db_data:
-                return 0
+        store = self._store(table)
+        with store.writing():
+            tx = self._active_tx(table)
+            store.load_unsafe()
+            rowids = store.match_unsafe(filter_dict)
+            if rowids:
+                store.delete_unsafe(rowids)
+                self._write_back(store, table, tx)
+            return len(rowids)
+
+    def overwrite_table(self, table: str, data: List[Dict[str, Any]]):
+        """Ghi đè toàn bộ dữ liệu của một bảng một cách an toàn."""
+        store = self._store(table)
+        with store.writing():
+            tx = self._active_tx(table)
+            store.reset_unsafe(data)
+            self._write_back(store, table, tx)
 
-            if filter_dict is None:
-                deleted_count = len(db_data[table])
-                db_data[table] = []
+    def _expire(self, table: str, field: str, cutoff: str,
+                limit: int) -> int:
+        """Xóa bản ghi hết hạn bằng bia mộ trong nhật ký (xem _TableStore)."""
+        store = self._store(table)
+        if not store.exists():
+            return 0
+        with store.writing():
+            tx = self._active_tx(table)
+            store.load_unsafe()
+            rowids = store.expired_unsafe(field, cutoff, limit)
+            if not rowids:
+                return 0
+            if tx is not None:
+                store.delete_unsafe(rowids)
+                tx.dirty.add(table)
             else:
-                original_count = len(db_data[table])
-                db_data[table] = [
-                    rec for rec in db_data[table]
-                    if not all(rec.get(k) == v for k, v in filter_dict.items())
-                ]
-                deleted_count = original_count - len(db_data[table])
+                store.tombstone_unsafe(rowids)
+                store.bump_version_unsafe()
+                self._notify_change()
+        return len(rowids)
 
-            if deleted_count > 0:
-                self._save_unsafe(db_data)
-            return deleted_count
+    def _write_back(self, store: _TableStore, table: str,
+                    tx: Optional[_Transaction]):
+        """Ghi lại toàn bộ bảng, hoặc hoãn tới lúc giao dịch kết thúc."""
+        if tx is not None:
+            tx.dirty.add(table)
+        else:
+            store.flush_unsafe()
+            store.bump_version_unsafe()
+            self._notify_change()
 
-    def overwrite_table(self, table: str, data: List[Dict[str, Any]]):
-        """Ghi đè toàn bộ dữ liệu của một bảng một cách an toàn."""
-        with self.lock:
-            db_data = self._load_unsafe()
-            db_data[table] = data
-            self._save_unsafe(db_data)
+    def version(self, table: str) -> int:
+        """Phiên bản của bảng, lưu trong tệp ``<bảng>.json.version``."""
+        return self._store(table).version()
+
+    def lock_stats(self) -> Dict[str, Dict[str, Dict[str, float]]]:
+        """Số lần lấy khóa và thời gian chờ (giây) theo bảng và chế độ khóa."""
+        result = {}
+        for table, store in list(self._stores.items()):
+            with store.lock._stats_mutex:
+                result[table] = {mode: dict(stats) for mode, stats
+                                 in store.lock.stats.items()}
+        return result
+
+    def reset_stats(self):
+        super().reset_stats()
+        for store in list(self._stores.values()):
+            with store.lock._stats_mutex:
+                for stats in store.lock.stats.values():
+                    stats.update(count=0, wait_total=0.0, wait_max=0.0)
 
     def tables(self) -> List[str]:
-        """Lấy danh sách các bảng một cách an toàn."""
-        with self.lock:
-            db_data = self._load_unsafe()
-            return list(db_data.keys())
+        """Lấy danh sách các bảng (mỗi bảng là một tệp .json)."""
+        if not os.path.isdir(self.data_dir):
+            return []
+        return sorted(name[:-len(".json")]
+                      for name in os.listdir(self.data_dir)
+                      if name.endswith(".json"))
 
 
-class TerraSyncDB(JsonDB):
+class TerraSyncMixin:
     """
-    Một lớp cơ sở dữ liệu cụ thể cho TerraSync, kế thừa từ JsonDB.
-    Bao gồm các phương thức để quản lý người dùng, vườn và lịch sử trò chuyện.
+    Các phương thức nghiệp vụ của TerraSync (người dùng, vườn, ...), chỉ
+    dùng giao diện ``StorageBackend`` nên ghép được với mọi backend, vd.
+    ``class TerraSyncDB(TerraSyncMixin, JsonDB)``.
     """
-    def __init__(self, db_file: str = "terrasync_db.json"):
-        super().__init__(db_file)
+    # Các trường được lọc thường xuyên trong ứng dụng
+    INDEXES = {
+        "users": ("email",),
+        "fields": ("user_email",),
+        "iot_hubs": ("hub_id", "user_email", "field_id"),
+        "sensors": ("hub_id", "node_id"),
+        "alerts": ("hub_id",),
+        "telemetry": ("hub_id",),
+        "chat_history": ("user_email",),
+        "iot_settings": ("user_email",),
+        "disease_diagnoses": ("user_email",),
+    }
+    ORDERED_INDEXES = {
+        "telemetry": ("hub_id", "timestamp"),
+        "alerts": ("hub_id", "created_at"),
+    }
+    # Khớp ALERT_RETENTION_DAYS/TELEMETRY_RETENTION_DAYS của iotAPI
+    TTL = {
+        "alerts": 30 * 24 * 3600,
+        "telemetry": 90 * 24 * 3600,
+    }
+
+    def __init__(self, db_file: str = "terrasync_db.json", **options):
+        super().__init__(db_file, **options)
+        # Bộ nhớ đệm fields_by_user: {email: vườn} ứng với một phiên bản
+        # của bảng fields, bỏ toàn bộ khi phiên bản đổi
+        self._fields_cache: Dict[str, List[Dict[str, Any]]] = {}
+        self._fields_cache_version: Optional[int] = None
+        self._fields_cache_lock = threading.Lock()
         self._ensure_default_tables()
+        self._migrate_embedded_fields()
 
     def _init_default_data(self) -> Dict[str, List[Dict[str, Any]]]:
         """Khởi tạo dữ liệu mặc định."""
@@ -151,50 +2350,71 @@ class TerraSyncDB(JsonDB):
         }
 
     def _ensure_default_tables(self):
-        """Đảm bảo các bảng mặc định tồn tại trong dữ liệu đã tải."""
-        with self.lock:
-            db_data = self._load_unsafe()
-            defaults = self._init_default_data()
-            needs_save = False
-            for table_name in defaults.keys():
-                if table_name not in db_data:
-                    db_data[table_name] = []
-                    needs_save = True
-            if needs_save:
-                self._save_unsafe(db_data)
-
+        """Đảm bảo các bảng mặc định tồn tại trên đĩa."""
+        for table_name in self._init_default_data():
+            self.ensure_table(table_name)
 
     def get_user_by_email(self, email: str) -> Optional[Dict[str, Any]]:
         """Lấy người dùng theo email."""
         users = self.get("users", {"email": email})
         return users[0] if users else None
 
+    def _migrate_embedded_fields(self):
+        """
+        Bỏ bản sao ``users[].fields`` của các phiên bản cũ: quyền sở hữu vườn
+        chỉ còn nằm ở ``fields.user_email``. Vườn chỉ có trong bản sao
+        (không còn trong bảng fields) được chuyển sang bảng fields trước.
+        """
+        if not any("fields" in user for user in self.get("users")):
+            return
+        with self.transaction("users", "fields"):
+            users = self.get("users")
+            known = {field["id"] for field in self.get("fields")}
+            orphans = []
+            for user in users:
+                for field in user.get("fields") or []:
+                    if field.get("id") not in known:
+                        orphans.append({**field,
+                                        "user_email": user.get("email")})
+                        known.add(field.get("id"))
+            if orphans:
+                self.add_many("fields", orphans)
+            self.overwrite_table("users", [
+                {key: value for key, value in user.items()
+                 if key != "fields"} for user in users])
+        print(f"Đã bỏ vườn nhúng trong bảng users "
+              f"({len(orphans)} vườn chuyển sang bảng fields)")
+
+    def fields_by_user(self, user_email: str) -> List[Dict[str, Any]]:
+        """
+        Các vườn của người dùng (chỉ đọc), qua chỉ mục ``user_email`` và bộ
+        nhớ đệm theo phiên bản bảng fields: mọi lần ghi vào fields, từ bất
+        kỳ tiến trình nào, đều làm bộ nhớ đệm hết hiệu lực.
+        """
+        version = self.version("fields")
+        with self._fields_cache_lock:
+            if version != self._fields_cache_version:
+                self._fields_cache = {}
+                self._fields_cache_version = version
+            fields = self._fields_cache.get(user_email)
+        if fields is None:
+            # Đọc sau khi lấy phiên bản: lần ghi xen giữa chỉ làm bản lưu
+            # mới hơn phiên bản, lần gọi sau sẽ đọc lại
+            fields = self.get("fields", {"user_email": user_email})
+            with self._fields_cache_lock:
+                if version == self._fields_cache_version:
+                    self._fields_cache[user_email] = fields
+        return list(fields)
+
     def get_fields_by_user(self, user_email: str) -> List[Dict[str, Any]]:
         """Lấy danh sách các vườn của người dùng."""
-        fields = self.get("fields", {"user_email": user_email})
-        if not fields:
-            user = self.get_user_by_email(user_email)
-            if user and "fields" in user:
-                fields = user["fields"]
-        return fields
+        return self.fields_by_user(user_email)
 
     def add_user_field(self, user_email: str,
                        field_data: Dict[str, Any]) -> bool:
         """Thêm một vườn mới cho người dùng."""
         field_data["user_email"] = user_email
-        success = self.add("fields", field_data)
-
-        if success:
-            user = self.get_user_by_email(user_email)
-            if user:
-                if "fields" not in user:
-                    user["fields"] = []
-                new_field_data = self.get_by_id("fields", field_data["id"])
-                if new_field_data:
-                    user["fields"].append(new_field_data)
-                    self.update("users", {"email": user_email},
-                                {"fields": user["fields"]})
-        return success
+        return self.add("fields", field_data)
 
     def update_user_field(self, field_id: str, user_email: str,
                           update_data: Dict[str, Any]) -> bool:
@@ -211,6 +2431,98 @@ class TerraSyncDB(JsonDB):
         return deleted > 0
 
 
+class TerraSyncDB(TerraSyncMixin, JsonDB):
+    """Cơ sở dữ liệu TerraSync trên backend JSON (mỗi bảng một tệp)."""
+
+
+DB_BACKENDS = ("json", "sqlite", "mongodb")
+_CONFIG_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                            ".streamlit", "appcfg.toml")
+
+
+def load_db_config() -> Dict[str, Any]:
+    """Mục ``[database]`` của ``.streamlit/appcfg.toml`` (rỗng nếu thiếu)."""
+    try:
+        return toml.load(_CONFIG_FILE).get("database", {})
+    except (OSError, ValueError) as e:
+        if os.path.exists(_CONFIG_FILE):
+            print(f"Lỗi khi đọc cấu hình database: {e}")
+        return {}
+
+
+def daemon_socket_path(config: Optional[Dict[str, Any]] = None
+                       ) -> Optional[str]:
+    """
+    Đường dẫn Unix socket của daemon dữ liệu (``database_remote``) từ
+    ``TERRASYNC_DB_SOCKET`` hoặc khóa ``daemon_socket`` của mục
+    ``[database]``; đường dẫn tương đối tính từ thư mục dự án. None nếu
+    không cấu hình (các tiến trình tự truy cập kho dữ liệu).
+    """
+    if config is None:
+        config = load_db_config()
+    path = (os.environ.get("TERRASYNC_DB_SOCKET")
+            or config.get("daemon_socket"))
+    if not path:
+        return None
+    return os.path.join(os.path.dirname(os.path.abspath(__file__)), path)
+
+
+def create_db(db_file: str = "terrasync_db.json",
+              backend: Optional[str] = None, terrasync: bool = False,
+              use_daemon: Optional[bool] = None,
+              **options) -> StorageBackend:
+    """
+    Mở cơ sở dữ liệu bằng backend được chọn theo thứ tự: tham số
+    ``backend``, biến môi trường ``TERRASYNC_DB_BACKEND``, khóa ``backend``
+    trong mục ``[database]`` của appcfg.toml, mặc định ``"json"``.
+    ``terrasync=True`` trả về lớp có các phương thức nghiệp vụ TerraSync.
+
+    Backend SQLite/MongoDB chỉ được nạp khi dùng. Lần mở SQLite đầu tiên tự
+    chuyển dữ liệu JSON sẵn có (``db_file`` hoặc thư mục bảng) vào tệp
+    SQLite. MongoDB nhận địa chỉ từ ``TERRASYNC_MONGO_URI`` hoặc
+    ``mongo_uri``, kích thước pool từ ``mongo_max_pool_size``/
+    ``mongo_min_pool_size``.
+
+    Khi có ``daemon_socket`` (xem ``daemon_socket_path``) và không chỉ định
+    ``backend``, trả về ``database_remote.RemoteDB`` dùng chung kho dữ liệu
+    của daemon; ``use_daemon`` (hoặc ``TERRASYNC_DB_DAEMON=0``) buộc
+    bật/tắt.
+    """
+    config = load_db_config()
+    socket_path = daemon_socket_path(config)
+    if use_daemon is None:
+        use_daemon = (socket_path is not None and backend is None
+                      and os.environ.get("TERRASYNC_DB_DAEMON") != "0")
+    if use_daemon:
+        from database_remote import RemoteDB, TerraSyncRemoteDB
+        if socket_path:
+            options.setdefault("socket_path", socket_path)
+        cls = TerraSyncRemoteDB if terrasync else RemoteDB
+        return cls(db_file, **options)
+    backend = (backend or os.environ.get("TERRASYNC_DB_BACKEND")
+               or config.get("backend") or "json").lower()
+    if config.get("durability"):
+        options.setdefault("durability", config["durability"])
+    if backend == "json":
+        cls = TerraSyncDB if terrasync else JsonDB
+    elif backend == "sqlite":
+        from database_sqlite import SQLiteDB, TerraSyncSQLiteDB
+        cls = TerraSyncSQLiteDB if terrasync else SQLiteDB
+    elif backend == "mongodb":
+        from database_new import MongoDB, TerraSyncMongoDB
+        uri = os.environ.get("TERRASYNC_MONGO_URI") or config.get("mongo_uri")
+        if uri:
+            options.setdefault("uri", uri)
+        for key in ("max_pool_size", "min_pool_size"):
+            if f"mongo_{key}" in config:
+                options.setdefault(key, config[f"mongo_{key}"])
+        cls = TerraSyncMongoDB if terrasync else MongoDB
+    else:
+        raise ValueError(f"Backend không hợp lệ: {backend!r} "
+                         f"(hỗ trợ: {', '.join(DB_BACKENDS)})")
+    return cls(db_file, **options)
+
+
 # Khởi tạo các đối tượng cơ sở dữ liệu toàn cục
-db = TerraSyncDB()
-crop_db = JsonDB("cropdb.json")
+db = create_db(terrasync=True)
+crop_db = create_db("cropdb.json")
@@ -1,261 +1,468 @@
 """
-TerraSync Database Manager
-Quản lý database thống nhất cho toàn bộ ứng dụng
-(Phiên bản JSON - Tối ưu cho demo)
+TerraSync MongoDB Backend
+Backend MongoDB cho ``database.StorageBackend`` (cùng API với JsonDB), dùng
+khi chạy iotAPI ở quy mô nhiều hub với một ``mongod`` riêng.
+
+Chọn backend này bằng ``backend = "mongodb"`` trong mục ``[database]`` của
+appcfg.toml (hoặc ``TERRASYNC_DB_BACKEND=mongodb``); địa chỉ lấy từ
+``TERRASYNC_MONGO_URI`` hoặc ``mongo_uri``, mặc định ``MongoDB.URI``
+(mongod chạy cục bộ ở cổng ``MongoDB.PORT``)::
+
+    mongod --dbpath ./mongo_data --port 34278
 """
-import json
 import os
 import uuid
-from typing import Dict, List, Any, Optional
-from datetime import datetime
-from filelock import FileLock
-from pymongo import MongoClient
-
-
-class MongoDB:
-    PORT = 34278
-    URI = f"mongodb://localhost:{PORT}/"
-
-    def __init__(self, uri: str):
-        self.cli = MongoClient(uri)
-        self.db = self.cli["terrasync"]
-        self.collec = None
-
-    def __set_table(self, table: str):
-        if not self.collec or self.collec.name is not table:
-            self.collec = self.db[table]
-    
-    def add(self, table: str, data: Any | list[Any]) -> bool:
-        """Thêm một bản ghi vào một bảng một cách an toàn."""
-        self.__set_table(table)
-        
-        if isinstance(data, list):
-            for e in data:
-                if "id" not in e:
-                    e["id"] = str(uuid.uuid4())
-                if "created_at" not in e:
-                    e["created_at"] = datetime.now().isoformat()
-            self.collec.insert_many(data)
-        else:
-            self.collec.insert_one(data)
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from typing import Dict, List, Any, Optional, Tuple, Iterable, Iterator
+
+try:
+    from pymongo import MongoClient, ASCENDING, DESCENDING, DeleteMany, InsertOne
+    from pymongo.errors import CollectionInvalid, OperationFailure
+    from pymongo.write_concern import WriteConcern
+except ImportError as e:  # pymongo chỉ cần khi dùng backend này
+    raise ImportError("Cần cài đặt pymongo: pip install pymongo") from e
+
+from database import (StorageBackend, TerraSyncMixin, FrozenDict, freeze,
+                      _check_operators, _is_operator, _operand)
+
+# Mức độ bền vững (xem database.DURABILITY_LEVELS) -> write concern
+_WRITE_CONCERNS = {
+    "fast": WriteConcern(w=1, j=False),
+    "safe": WriteConcern(w=1),
+    "full": WriteConcern(w="majority", j=True),
+}
+# Bản sao kiểu Date của trường thời hạn (ttl_field: created_at, hoặc
+# trường thời gian của chỉ mục có thứ tự, vd. timestamp của telemetry) cho
+# chỉ mục TTL: MongoDB chỉ cho hết hạn các trường kiểu Date
+_CREATED = "_created_at"
+_HIDDEN = {"_id": 0, _CREATED: 0}
+# Collection phiên bản cho luồng thay đổi; tên có dấu chấm nên không trùng
+# được với bảng dữ liệu (xem StorageBackend._TABLE_NAME_RE)
+_VERSIONS = "_meta.versions"
+
+
+def _created_date(value: Any) -> datetime:
+    """Giá trị Date của mốc thời gian; giờ không múi giờ là giờ địa phương."""
+    if isinstance(value, datetime):
+        dt = value
+    else:
+        try:
+            dt = datetime.fromisoformat(value)
+        except (TypeError, ValueError):
+            return datetime.now(timezone.utc)
+    return dt if dt.tzinfo else dt.astimezone()
 
-        return True
 
-    def get(self, table: str, filter: Optional[dict] = None, count: int = 1):
-        self.__set_table(table)
+def _mongo_filter(filter_dict: Optional[Dict[str, Any]]) -> Dict[str, Any]:
+    """Bộ lọc của StorageBackend dùng cùng cú pháp toán tử với MongoDB."""
+    result = {}
+    for field, cond in (filter_dict or {}).items():
+        if _is_operator(cond):
+            _check_operators(cond)
+            cond = {op: _operand(v) for op, v in cond.items()}
+        result[field] = cond
+    return result
 
-        find_func = self.collec.find_one if count == 1 else self.collec.find
 
-        if filter:
-            return find_func(filter)
-        else:
-            return find_func()
-        
-    def get_by_id(self, table: str, record_id: str):
-        """Lấy một bản ghi theo ID một cách an toàn."""
-        records = self.get(table, {"id": record_id})
-        return records[0] if records else None
-
-class JsonDB:
+class MongoDB(StorageBackend):
     """
-    Một lớp cơ sở để quản lý dữ liệu trong một tệp JSON.
-    Cung cấp các hoạt động CRUD cơ bản với cơ chế khóa tệp để đảm bảo an toàn cho luồng.
+    Backend MongoDB: mỗi bảng là một collection trong CSDL
+    ``<db_file không đuôi>`` (vd. ``terrasync_db``).
+
+    Chỉ mục được tạo khi khởi động cho mọi bảng đã khai báo: ``id``, các
+    trường trong ``INDEXES``, cặp ``(nhóm, thời gian)`` của
+    ``ORDERED_INDEXES`` và chỉ mục TTL theo ``created_at`` cho các bảng
+    trong ``ttl`` (MongoDB tự xóa bản ghi hết hạn trên server nên
+    ``expire_step()`` không phải làm gì). ``max_pool_size``/
+    ``min_pool_size`` đặt kích thước pool kết nối; ``client`` cho phép
+    truyền sẵn một ``MongoClient``.
+
+    Phiên bản của các bảng nằm trong collection ``_meta.versions`` (change
+    stream cần replica set nên không dùng được với một ``mongod`` đơn lẻ).
+    Bản ghi bị chỉ mục TTL xóa trên server không làm tăng phiên bản.
     """
-    def __init__(self, db_file: str):
-        self.db_file = db_file
-        self.lock_file = f"{db_file}.lock"
-        self.lock = FileLock(self.lock_file)
-        # Không tải dữ liệu ở đây nữa, sẽ tải bên trong ngữ cảnh khóa
-
-    def _load_unsafe(self) -> Dict[str, List[Dict[str, Any]]]:
-        """Tải dữ liệu từ tệp mà không cần khóa (chỉ sử dụng nội bộ)."""
-        if os.path.exists(self.db_file):
-            try:
-                with open(self.db_file, "r", encoding="utf-8") as f:
-                    return json.load(f)
-            except (json.JSONDecodeError, FileNotFoundError):
-                return {}
-        return {}
-
-    def _save_unsafe(self, data: Dict[str, List[Dict[str, Any]]]):
-        """Lưu dữ liệu vào tệp mà không cần khóa (chỉ sử dụng nội bộ)."""
+    PORT = 34278
+    URI = f"mongodb://localhost:{PORT}/"
+    MAX_POOL_SIZE = 100
+
+    def __init__(self, db_file: str = "terrasync_db.json",
+                 indexes: Optional[Dict[str, Iterable[str]]] = None,
+                 ordered_indexes: Optional[Dict[str, Tuple[str, str]]] = None,
+                 serializer=None, durability: Optional[str] = None,
+                 ttl: Optional[Dict[str, int]] = None,
+                 uri: Optional[str] = None, database: Optional[str] = None,
+                 max_pool_size: Optional[int] = None, min_pool_size: int = 0,
+                 client=None):
+        super().__init__(db_file, indexes, ordered_indexes, serializer,
+                         durability, ttl)
+        self.cli = client or MongoClient(
+            uri or self.URI,
+            maxPoolSize=max_pool_size or self.MAX_POOL_SIZE,
+            minPoolSize=min_pool_size)
+        name = database or os.path.basename(self.data_dir)
+        self.db = self.cli.get_database(
+            name, write_concern=_WRITE_CONCERNS[self.durability])
+        self._ready: set = set()
+        for table in sorted({*self.indexes, *self.ordered_indexes,
+                             *self.ttl}):
+            self._coll(table)
+
+    @property
+    def location(self) -> str:
+        return f"mongodb/{self.db.name}"
+
+    def _coll(self, table: str):
+        """Collection của bảng; chỉ mục được đảm bảo ở lần dùng đầu tiên."""
+        if table not in self._ready:
+            self._check_table_name(table)
+            self._create_indexes(table)
+            self._ready.add(table)
+        return self.db[table]
+
+    def _create_indexes(self, table: str):
+        coll = self.db[table]
+        for field in ["id"] + [f for f in self.indexes.get(table, ())
+                               if f != "id"]:
+            coll.create_index([(field, ASCENDING)])
+        ordered = self.ordered_indexes.get(table)
+        if ordered:
+            part_field, order_field = ordered
+            coll.create_index([(part_field, ASCENDING),
+                               (order_field, ASCENDING)])
+            coll.create_index([(order_field, ASCENDING)])
+        if self.ttl.get(table):
+            self._ttl_index(table)
+
+    def _ttl_index(self, table: str):
+        """Tạo (hoặc cập nhật thời hạn của) chỉ mục TTL theo ttl_field."""
+        ttl = self.ttl[table]
         try:
-            with open(self.db_file, "w", encoding="utf-8") as f:
-                json.dump(data, f, indent=2, ensure_ascii=False)
-        except Exception as e:
-            print(f"Lỗi khi lưu cơ sở dữ liệu: {e}")
-
-    def add(self, table: str, data: Dict[str, Any]) -> bool:
-        """Thêm một bản ghi vào một bảng một cách an toàn."""
-        with self.lock:
-            db_data = self._load_unsafe()
-            if table not in db_data:
-                db_data[table] = []
-
-            if "id" not in data:
-                data["id"] = str(uuid.uuid4())
-            if "created_at" not in data:
-                data["created_at"] = datetime.now().isoformat()
-
-            db_data[table].append(data)
-            self._save_unsafe(db_data)
-        return True
+            self.db[table].create_index([(_CREATED, ASCENDING)],
+                                        expireAfterSeconds=ttl)
+        except OperationFailure:
+            # Chỉ mục đã có với thời hạn khác: cập nhật thời hạn
+            self.db.command("collMod", table, index={
+                "keyPattern": {_CREATED: ASCENDING},
+                "expireAfterSeconds": ttl})
+
+    def set_ttl(self, table: str, seconds: Optional[int]):
+        """Đặt thời hạn giữ bản ghi bằng chỉ mục TTL của MongoDB."""
+        super().set_ttl(table, seconds)
+        if seconds:
+            self._ttl_index(table)
+            return
+        try:
+            self.db[table].drop_index([(_CREATED, ASCENDING)])
+        except OperationFailure:
+            pass  # Chưa có chỉ mục TTL
+
+    def _expire(self, table: str, field: str, cutoff: str,
+                limit: int) -> int:
+        """Chỉ mục TTL đã xóa bản ghi hết hạn trên server."""
+        return 0
+
+    # --- Giao dịch ---
+
+    @contextmanager
+    def transaction(self, *tables: str):
+        """
+        Gom các lần ``add``/``add_many`` trên ``tables`` thành một
+        ``insert_many`` mỗi bảng khi thoát khối ``with`` (vd. một bản tin
+        telemetry cùng các cảnh báo của nó). Trước khi đọc, cập nhật hay xóa
+        một bảng, các bản ghi đang chờ của bảng đó được ghi trước nên vẫn
+        đọc được thay đổi của chính mình. Có ngoại lệ thì bỏ các bản ghi
+        chưa ghi; mongod đơn lẻ không có giao dịch nhiều tài liệu nên phần
+        đã ghi không được hoàn tác. Truy cập bảng chưa khai báo sẽ báo
+        ``ValueError``.
+        """
+        current = getattr(self._tx_local, "pending", None)
+        if current is not None:
+            # Giao dịch lồng nhau nhập vào giao dịch ngoài cùng
+            missing = set(tables) - set(current)
+            if missing:
+                raise ValueError(
+                    f"Giao dịch lồng nhau dùng bảng chưa khai báo: {missing}")
+            yield self
+            return
+
+        pending: Dict[str, List[Dict[str, Any]]] = {
+            table: [] for table in tables}
+        for table in tables:
+            self._coll(table)
+        self._tx_local.pending = pending
+        try:
+            yield self
+            for table in sorted(pending):
+                self._flush(table, pending)
+        finally:
+            self._tx_local.pending = None
+
+    def _active_tx(self, table: str, flush: bool = True
+                   ) -> Optional[Dict[str, List[Dict[str, Any]]]]:
+        """Bản ghi đang chờ của giao dịch đang mở (nếu có) của luồng."""
+        pending = getattr(self._tx_local, "pending", None)
+        if pending is None:
+            return None
+        if table not in pending:
+            raise ValueError(
+                f"Bảng {table!r} chưa được khai báo trong giao dịch")
+        if flush:
+            self._flush(table, pending)
+        return pending
+
+    def _flush(self, table: str,
+               pending: Dict[str, List[Dict[str, Any]]]):
+        docs = pending[table]
+        if docs:
+            pending[table] = []
+            self._coll(table).insert_many(docs, ordered=True)
+            self._bump_version(table)
+
+    def _bump_version(self, table: str):
+        """Tăng phiên bản của bảng sau một lần ghi."""
+        self.db[_VERSIONS].update_one({"_id": table},
+                                      {"$inc": {"version": 1}}, upsert=True)
+        self._notify_change()
+
+    # --- Đọc ---
 
     def get(self, table: str,
             filter_dict: Optional[Dict[str, Any]] = None
             ) -> List[Dict[str, Any]]:
-        """Lấy các bản ghi từ một bảng một cách an toàn."""
-        with self.lock:
-            db_data = self._load_unsafe()
-            if table not in db_data:
-                return []
-
-            records = db_data[table]
-            if filter_dict:
-                return [rec for rec in records
-                        if all(rec.get(k) == v for k, v in filter_dict.items())]
-            return records.copy()
-
-    def get_by_id(self, table: str,
-                  record_id: str) -> Optional[Dict[str, Any]]:
-        """Lấy một bản ghi theo ID một cách an toàn."""
-        records = self.get(table, {"id": record_id})
-        return records[0] if records else None
+        """Lấy các bản ghi khớp bộ lọc, theo thứ tự chèn."""
+        return list(self.query(table, filter_dict))
+
+    def query(self, table: str,
+              filter_dict: Optional[Dict[str, Any]] = None,
+              fields: Optional[Iterable[str]] = None,
+              order_by: Optional[str] = None,
+              limit: Optional[int] = None, offset: int = 0,
+              after: Any = None) -> Iterator[Dict[str, Any]]:
+        """
+        Truy vấn một bảng (cùng tham số như ``JsonDB.query``), trả về con
+        trỏ MongoDB: lọc, chiếu trường, sắp xếp và phân trang chạy trên
+        server, bản ghi được tải theo lô khi duyệt.
+        """
+        fields = list(fields) if fields is not None else None
+        if offset < 0 or (limit is not None and limit < 0):
+            raise ValueError("offset và limit không được âm")
+        desc = bool(order_by) and order_by.startswith("-")
+        order_field = order_by[1:] if desc else order_by
+        if after is not None and not order_field:
+            raise ValueError("after chỉ dùng được cùng order_by")
+        self._active_tx(table)
+        coll = self._coll(table)
+
+        flt = _mongo_filter(filter_dict)
+        if order_field:
+            direction = DESCENDING if desc else ASCENDING
+            sort = [(order_field, direction), ("_id", direction)]
+            if after is not None:
+                cond = self._after_filter(coll, order_field, after, desc)
+                flt = {"$and": [flt, cond]} if flt else cond
+        else:
+            sort = [("_id", ASCENDING)]
+        if limit == 0:
+            return iter(())
+        if fields == []:
+            cursor = coll.find(flt, {"_id": 1}, sort=sort, skip=offset,
+                               limit=limit or 0)
+            return (FrozenDict() for _ in cursor)
+        projection = (_HIDDEN if fields is None
+                      else {**{f: 1 for f in fields}, "_id": 0})
+        # Bản ghi chỉ đọc như các backend khác, đóng băng dần khi duyệt
+        return map(freeze, coll.find(flt, projection, sort=sort, skip=offset,
+                                     limit=limit or 0))
+
+    @staticmethod
+    def _after_filter(coll, field: str, after: Any,
+                      desc: bool) -> Dict[str, Any]:
+        """
+        Điều kiện "đứng sau ``after``" cho phân trang theo khóa: cặp
+        ``(giá trị, id)`` trỏ đúng bản ghi đó; nếu chỉ có giá trị (hoặc bản
+        ghi đã bị xóa) thì bỏ qua mọi bản ghi mang giá trị đó.
+        """
+        record_id = None
+        if isinstance(after, (list, tuple)) and len(after) == 2:
+            after, record_id = after
+        value = _operand(after)
+        oid = None
+        if record_id:
+            doc = coll.find_one({"id": record_id}, {"_id": 1})
+            oid = doc["_id"] if doc else None
+        if value is None:
+            # None (hoặc thiếu trường) đứng đầu thứ tự tăng dần
+            strict = ({"_id": {"$in": []}} if desc
+                      else {field: {"$ne": None}})
+        elif desc:
+            strict = {"$or": [{field: {"$lt": value}}, {field: None}]}
+        else:
+            strict = {field: {"$gt": value}}
+        if oid is None:
+            return strict
+        return {"$or": [strict, {field: value,
+                                 "_id": {"$lt" if desc else "$gt": oid}}]}
+
+    def count(self, table: str,
+              filter_dict: Optional[Dict[str, Any]] = None) -> int:
+        """Đếm số bản ghi khớp bộ lọc trên server."""
+        self._active_tx(table)
+        return self._coll(table).count_documents(_mongo_filter(filter_dict))
+
+    def _ordered_fields(self, table: str) -> Tuple[str, str]:
+        ordered = self.ordered_indexes.get(table)
+        if not ordered:
+            raise ValueError(f"Bảng {table!r} không có chỉ mục có thứ tự")
+        self._active_tx(table)
+        return ordered
+
+    def latest(self, table: str,
+               key: Any = None) -> Optional[Dict[str, Any]]:
+        """
+        Bản ghi mới nhất của nhóm ``key`` theo chỉ mục có thứ tự của bảng.
+        ``key=None``: mới nhất toàn bảng.
+        """
+        part_field, order_field = self._ordered_fields(table)
+        flt = {} if key is None else {part_field: key}
+        return freeze(self._coll(table).find_one(
+            flt, _HIDDEN,
+            sort=[(order_field, DESCENDING), ("_id", DESCENDING)]))
+
+    def range(self, table: str, key: Any, since: Any = None,
+              until: Any = None) -> List[Dict[str, Any]]:
+        """
+        Các bản ghi của nhóm ``key`` có ``since <= thời gian < until``
+        (chuỗi ISO 8601 hoặc datetime), theo thứ tự thời gian tăng dần.
+        """
+        part_field, order_field = self._ordered_fields(table)
+        flt: Dict[str, Any] = {part_field: key}
+        bounds = {}
+        if since is not None:
+            bounds["$gte"] = _operand(since)
+        if until is not None:
+            bounds["$lt"] = _operand(until)
+        if bounds:
+            flt[order_field] = bounds
+        return [freeze(doc) for doc in self._coll(table).find(
+            flt, _HIDDEN,
+            sort=[(order_field, ASCENDING), ("_id", ASCENDING)])]
+
+    def tail(self, table: str, key: Any, n: int) -> List[Dict[str, Any]]:
+        """N bản ghi mới nhất của nhóm ``key``, theo thứ tự thời gian tăng dần."""
+        part_field, order_field = self._ordered_fields(table)
+        if n <= 0:
+            return []
+        rows = [freeze(doc) for doc in self._coll(table).find(
+            {part_field: key}, _HIDDEN,
+            sort=[(order_field, DESCENDING), ("_id", DESCENDING)], limit=n)]
+        rows.reverse()
+        return rows
+
+    # --- Ghi ---
+
+    def _document(self, table: str,
+                  data: Dict[str, Any]) -> Dict[str, Any]:
+        """
+        Bản sao để lưu (pymongo gắn ``_id`` vào dict được chèn), kèm bản
+        Date của ``ttl_field`` cho chỉ mục TTL.
+        """
+        doc = dict(data)
+        doc[_CREATED] = _created_date(data.get(self.ttl_field(table)))
+        return doc
+
+    def add_many(self, table: str, records: List[Dict[str, Any]]) -> int:
+        """
+        Thêm nhiều bản ghi bằng một ``insert_many`` (trong giao dịch: gom
+        tới lúc thoát khối ``with``). Trả về số bản ghi đã thêm.
+        """
+        pending = self._active_tx(table, flush=False)
+        coll = self._coll(table)
+        now = datetime.now().isoformat()
+        for data in records:
+            if "id" not in data:
+                data["id"] = str(uuid.uuid4())
+            if "created_at" not in data:
+                data["created_at"] = now
+        docs = [self._document(table, data) for data in records]
+        if pending is not None:
+            pending[table] += docs
+        elif docs:
+            coll.insert_many(docs, ordered=True)
+            self._bump_version(table)
+        return len(docs)
 
     def update(self, table: str, filter_dict: Dict[str, Any],
                update_data: Dict[str, Any]) -> int:
-        """Cập nhật các bản ghi dựa trên một bộ lọc một cách an toàn."""
-        with self.lock:
-            db_data = self._load_unsafe()
-            if table not in db_data or not db_data[table]:
-                return 0
-
-            updated_count = 0
-            for rec in db_data[table]:
-                if all(rec.get(k) == v for k, v in filter_dict.items()):
-                    rec.update(update_data)
-                    rec["updated_at"] = datetime.now().isoformat()
-                    updated_count += 1
-
-            if updated_count > 0:
-                self._save_unsafe(db_data)
-            return updated_count
+        """Cập nhật các bản ghi khớp bộ lọc bằng ``$set`` trên server."""
+        self._active_tx(table)
+        changes = {**update_data, "updated_at": datetime.now().isoformat()}
+        ttl_field = self.ttl_field(table)
+        if ttl_field in update_data:
+            # Giữ bản Date cho chỉ mục TTL khớp với trường thời hạn
+            changes[_CREATED] = _created_date(update_data[ttl_field])
+        result = self._coll(table).update_many(_mongo_filter(filter_dict),
+                                               {"$set": changes})
+        if result.matched_count:
+            self._bump_version(table)
+        return result.matched_count
 
     def delete(self, table: str,
                filter_dict: Optional[Dict[str, Any]] = None) -> int:
-        """Xóa các bản ghi dựa trên một bộ lọc một cách an toàn."""
-        with self.lock:
-            db_data = self._load_unsafe()
-            if table not in db_data:
-                return 0
-
-            if filter_dict is None:
-                deleted_count = len(db_data[table])
-                db_data[table] = []
-            else:
-                original_count = len(db_data[table])
-                db_data[table] = [
-                    rec for rec in db_data[table]
-                    if not all(rec.get(k) == v for k, v in filter_dict.items())
-                ]
-                deleted_count = original_count - len(db_data[table])
-
-            if deleted_count > 0:
-                self._save_unsafe(db_data)
-            return deleted_count
+        """Xóa các bản ghi khớp bộ lọc. Trả về số bản ghi đã xóa."""
+        self._active_tx(table)
+        result = self._coll(table).delete_many(_mongo_filter(filter_dict))
+        if result.deleted_count:
+            self._bump_version(table)
+        return result.deleted_count
 
     def overwrite_table(self, table: str, data: List[Dict[str, Any]]):
-        """Ghi đè toàn bộ dữ liệu của một bảng một cách an toàn."""
-        with self.lock:
-            db_data = self._load_unsafe()
-            db_data[table] = data
-            self._save_unsafe(db_data)
+        """Ghi đè toàn bộ dữ liệu của một bảng bằng một ``bulk_write``."""
+        self._active_tx(table)
+        ops = [DeleteMany({})] + [InsertOne(self._document(table, rec))
+                                  for rec in data]
+        self._coll(table).bulk_write(ops, ordered=True)
+        self._bump_version(table)
+
+    def version(self, table: str) -> int:
+        """Phiên bản của bảng, đọc từ collection ``_meta.versions``."""
+        doc = self.db[_VERSIONS].find_one({"_id": table})
+        return doc["version"] if doc else 0
+
+    # --- Quản trị ---
+
+    def ensure_table(self, table: str):
+        """Tạo collection rỗng (cùng các chỉ mục) nếu chưa tồn tại."""
+        coll = self._coll(table)
+        try:
+            self.db.create_collection(coll.name)
+        except CollectionInvalid:
+            pass  # Đã tồn tại
+
+    def create_index(self, table: str, field: str):
+        """Khai báo thêm một chỉ mục cho ``table.field``."""
+        fields = self.indexes.setdefault(table, [])
+        if field not in fields:
+            fields.append(field)
+        self._coll(table).create_index([(field, ASCENDING)])
+
+    def compact(self, table: Optional[str] = None):
+        """Chạy lệnh ``compact`` của MongoDB cho một hoặc mọi bảng."""
+        for name in ([table] if table else self.tables()):
+            self._check_table_name(name)
+            self.db.command("compact", name)
+
+    def backup(self, dest: str) -> Dict[str, int]:
+        """MongoDB tự có công cụ sao lưu trực tuyến."""
+        raise NotImplementedError(
+            "Dùng `mongodump --uri <mongo_uri> --out <thư mục>` để sao lưu "
+            "MongoDB")
 
     def tables(self) -> List[str]:
-        """Lấy danh sách các bảng một cách an toàn."""
-        with self.lock:
-            db_data = self._load_unsafe()
-            return list(db_data.keys())
+        """Lấy danh sách các bảng (collection)."""
+        return sorted(name for name in self.db.list_collection_names()
+                      if not name.startswith("system.") and name != _VERSIONS)
 
 
-class TerraSyncDB(JsonDB):
-    """
-    Một lớp cơ sở dữ liệu cụ thể cho TerraSync, kế thừa từ JsonDB.
-    Bao gồm các phương thức để quản lý người dùng, vườn và lịch sử trò chuyện.
-    """
-    def __init__(self, db_file: str = "terrasync_db.json"):
-        super().__init__(db_file)
-        self._ensure_default_tables()
-
-    def _init_default_data(self) -> Dict[str, List[Dict[str, Any]]]:
-        """Khởi tạo dữ liệu mặc định."""
-        return {
-            "users": [], "fields": [], "iot_hubs": [], "sensors": [],
-            "alerts": [], "telemetry": [], "chat_history": [],
-            "support_messages": [], "crop_requests": []
-        }
-
-    def _ensure_default_tables(self):
-        """Đảm bảo các bảng mặc định tồn tại trong dữ liệu đã tải."""
-        with self.lock:
-            db_data = self._load_unsafe()
-            defaults = self._init_default_data()
-            needs_save = False
-            for table_name in defaults.keys():
-                if table_name not in db_data:
-                    db_data[table_name] = []
-                    needs_save = True
-            if needs_save:
-                self._save_unsafe(db_data)
-
-
-    def get_user_by_email(self, email: str) -> Optional[Dict[str, Any]]:
-        """Lấy người dùng theo email."""
-        users = self.get("users", {"email": email})
-        return users[0] if users else None
-
-    def get_fields_by_user(self, user_email: str) -> List[Dict[str, Any]]:
-        """Lấy danh sách các vườn của người dùng."""
-        fields = self.get("fields", {"user_email": user_email})
-        if not fields:
-            user = self.get_user_by_email(user_email)
-            if user and "fields" in user:
-                fields = user["fields"]
-        return fields
-
-    def add_user_field(self, user_email: str,
-                       field_data: Dict[str, Any]) -> bool:
-        """Thêm một vườn mới cho người dùng."""
-        field_data["user_email"] = user_email
-        success = self.add("fields", field_data)
-
-        if success:
-            user = self.get_user_by_email(user_email)
-            if user:
-                if "fields" not in user:
-                    user["fields"] = []
-                new_field_data = self.get_by_id("fields", field_data["id"])
-                if new_field_data:
-                    user["fields"].append(new_field_data)
-                    self.update("users", {"email": user_email},
-                                {"fields": user["fields"]})
-        return success
-
-    def update_user_field(self, field_id: str, user_email: str,
-                          update_data: Dict[str, Any]) -> bool:
-        """Cập nhật một vườn của người dùng."""
-        updated = self.update("fields",
-                              {"id": field_id, "user_email": user_email},
-                              update_data)
-        return updated > 0
-
-    def delete_user_field(self, field_id: str, user_email: str) -> bool:
-        """Xóa một vườn của người dùng."""
-        deleted = self.delete("fields",
-                              {"id": field_id, "user_email": user_email})
-        return deleted > 0
-
-
-# Khởi tạo các đối tượng cơ sở dữ liệu toàn cục
-db = TerraSyncDB()
-crop_db = JsonDB("cropdb.json")
+class TerraSyncMongoDB(TerraSyncMixin, MongoDB):
+    """Cơ sở dữ liệu TerraSync trên backend MongoDB."""
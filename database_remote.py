@@ -0,0 +1,545 @@
+"""
+TerraSync Data Daemon
+Tiến trình dữ liệu cục bộ dùng chung: một tiến trình duy nhất giữ kho dữ
+liệu (bộ nhớ đệm các bảng, chỉ mục, khóa) và phục vụ các tiến trình khác
+(streamlit_app, iotAPI, background_job) qua một Unix socket, thay vì mỗi
+tiến trình tự đọc/phân tích tệp và tranh khóa tệp với nhau.
+
+Chạy daemon (đã có trong multiprocess.json)::
+
+    python -m database_remote
+
+rồi bật phía khách bằng ``daemon_socket = "terrasync_db.sock"`` trong mục
+``[database]`` của appcfg.toml (hoặc ``TERRASYNC_DB_SOCKET``): khi đó
+``database.create_db`` trả về ``RemoteDB`` có cùng API với các backend khác.
+Backend thực sự (json/sqlite/mongodb) do daemon chọn theo cấu hình như cũ.
+
+Giao thức: mỗi khung gồm tiêu đề nhị phân 5 byte (mã lệnh 1 byte, độ dài
+thân 4 byte big-endian) và thân là JSON mã hóa bằng bộ mã hóa của
+``database`` (orjson nếu đã cài); datetime được gửi như chuỗi ISO 8601, đúng
+dạng các backend dùng để so sánh trong bộ lọc. Mỗi kết nối bắt đầu bằng
+``HELLO`` (tệp CSDL và chỉ mục của khách; daemon chỉ phục vụ các CSDL đã cấu
+hình), sau đó là các cặp ``CALL`` -> ``OK``/``ERROR``. Chỉ các phương thức
+trong ``_METHODS`` được gọi; không có mã nào được giải tuần tự hóa từ
+socket.
+"""
+import os
+import signal
+import socket
+import socketserver
+import struct
+import sys
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from datetime import datetime
+from typing import Dict, List, Any, Optional, Tuple, Iterable, Iterator
+
+if __name__ == "__main__":
+    # Trong daemon, db/crop_db toàn cục của database phải truy cập kho dữ
+    # liệu trực tiếp thay vì kết nối tới chính daemon
+    os.environ["TERRASYNC_DB_DAEMON"] = "0"
+
+import database  # noqa: E402
+from database import (StorageBackend, TerraSyncMixin,  # noqa: E402
+                      CorruptTableError, daemon_socket_path,
+                      freeze, get_serializer)
+
+PROTOCOL_VERSION = 1
+# Tiêu đề khung: mã lệnh (1 byte) + độ dài thân (4 byte, big-endian)
+_HEADER = struct.Struct("!BI")
+OP_HELLO, OP_CALL, OP_OK, OP_ERROR = 1, 2, 3, 4
+MAX_FRAME = 1 << 30
+DEFAULT_SOCKET = "terrasync_db.sock"
+# Windows không có Unix socket: lớp thay thế chỉ để nạp được module,
+# main() không chạy daemon ở đó
+_UnixStreamServer = getattr(socketserver, "UnixStreamServer",
+                            socketserver.TCPServer)
+
+# Phương thức khách được gọi trên daemon. Các phương thức đọc không đổi
+# trạng thái nên được gửi lại một lần khi mất kết nối (vd. daemon khởi động
+# lại); lần ghi thì không, vì có thể đã được áp dụng trước khi mất kết nối.
+_READ_METHODS = frozenset({
+    "get", "query", "count", "latest", "range", "tail", "tables",
+    "version", "versions", "location", "stats",
+})
+_WRITE_METHODS = frozenset({
+    "add_many", "update", "delete", "overwrite_table", "ensure_table",
+    "create_index", "compact", "backup", "expire", "begin", "end",
+    "reset_stats",
+})
+_METHODS = _READ_METHODS | _WRITE_METHODS
+# Lỗi được dựng lại đúng kiểu phía khách; kiểu khác thành RuntimeError
+_ERRORS = {cls.__name__: cls for cls in (
+    ValueError, KeyError, TypeError, NotImplementedError, FileNotFoundError,
+    PermissionError, CorruptTableError)}
+
+
+def _send(sock: socket.socket, op: int, body: bytes):
+    sock.sendall(_HEADER.pack(op, len(body)) + body)
+
+
+def _recv_exact(sock: socket.socket, size: int) -> bytearray:
+    buf = bytearray(size)
+    view = memoryview(buf)
+    while view:
+        n = sock.recv_into(view)
+        if not n:
+            raise ConnectionResetError("Kết nối tới daemon dữ liệu bị đóng")
+        view = view[n:]
+    return buf
+
+
+def _recv(sock: socket.socket) -> Tuple[int, bytes]:
+    op, size = _HEADER.unpack(_recv_exact(sock, _HEADER.size))
+    if size > MAX_FRAME:
+        raise ConnectionResetError(f"Khung quá lớn ({size} byte)")
+    return op, bytes(_recv_exact(sock, size))
+
+
+class _Aborted(Exception):
+    """Hủy giao dịch phía daemon (khách rollback hoặc mất kết nối)."""
+
+
+class _Handler(socketserver.BaseRequestHandler):
+    """
+    Phục vụ một kết nối trên một luồng riêng của daemon. Giao dịch của
+    backend gắn với luồng, nên giao dịch của khách (một kết nối cho mỗi
+    luồng khách) nằm trọn trong luồng này.
+    """
+
+    def setup(self):
+        self.db: Optional[StorageBackend] = None
+        self.tx = None
+
+    def handle(self):
+        serializer = self.server.serializer
+        while True:
+            try:
+                op, body = _recv(self.request)
+            except OSError:
+                return
+            try:
+                request = serializer.loads(body)
+                if op == OP_HELLO:
+                    result = self._hello(request)
+                elif op == OP_CALL:
+                    result = self._call(*request)
+                else:
+                    raise ValueError(f"Mã lệnh không hợp lệ: {op}")
+                reply = OP_OK, serializer.dumps(result)
+            except Exception as e:
+                reply = OP_ERROR, serializer.dumps(
+                    [type(e).__name__, str(e)])
+            try:
+                _send(self.request, *reply)
+            except OSError:
+                return
+
+    def finish(self):
+        # Khách mất kết nối giữa giao dịch: hủy để nhả khóa ghi
+        self._end(False)
+
+    def _hello(self, request: Dict[str, Any]) -> Dict[str, Any]:
+        if request.get("protocol") != PROTOCOL_VERSION:
+            raise ValueError(
+                f"Phiên bản giao thức không khớp: {request.get('protocol')}"
+                f" (daemon: {PROTOCOL_VERSION})")
+        self.db = self.server.open_db(request["db_file"],
+                                      request.get("indexes") or {})
+        return {"location": self.db.location}
+
+    def _call(self, method: str, args: List[Any],
+              kwargs: Dict[str, Any]) -> Any:
+        if self.db is None:
+            raise ValueError("Chưa gửi HELLO")
+        if method not in _METHODS:
+            raise ValueError(f"Phương thức không được phép: {method!r}")
+        if method == "begin":
+            return self._begin(*args)
+        if method == "end":
+            return self._end(*args)
+        if method == "location":
+            return self.db.location
+        if method == "expire":
+            return self.db._expire(*args, **kwargs)
+        result = getattr(self.db, method)(*args, **kwargs)
+        return list(result) if method == "query" else result
+
+    def _begin(self, tables: List[str]):
+        if self.tx is not None:
+            raise ValueError("Kết nối đã có giao dịch đang mở")
+        tx = self.db.transaction(*tables)
+        tx.__enter__()
+        self.tx = tx
+
+    def _end(self, commit: bool):
+        tx, self.tx = self.tx, None
+        if tx is None:
+            return
+        if commit:
+            tx.__exit__(None, None, None)
+            return
+        try:
+            tx.__exit__(_Aborted, _Aborted(), None)
+        except _Aborted:
+            pass
+
+
+class DataDaemon(socketserver.ThreadingMixIn, _UnixStreamServer):
+    """
+    Máy chủ Unix socket giữ các CSDL đã mở, mỗi ``db_file`` một đối tượng
+    backend dùng chung cho mọi kết nối, nên bảng chỉ được tải và lập chỉ
+    mục một lần cho cả hệ thống. Khách chỉ mở được các CSDL đã cấu hình
+    (``dbs``, mặc định ``database.db`` và ``database.crop_db``), không
+    phải một đường dẫn tùy ý.
+    """
+    daemon_threads = True
+
+    def __init__(self, socket_path: str,
+                 dbs: Optional[Iterable[StorageBackend]] = None):
+        self.socket_path = socket_path
+        self.serializer = get_serializer()
+        if dbs is None:
+            # Dùng lại các CSDL toàn cục đã mở khi nạp module database
+            dbs = (database.db, database.crop_db)
+        self._dbs: Dict[str, StorageBackend] = {
+            os.path.abspath(db.db_file): db
+            for db in dbs if not isinstance(db, RemoteDB)}
+        self._remove_stale_socket()
+        # Tạo socket với quyền 0600 ngay từ bind(): chmod sau đó để hở một
+        # khoảng mà người dùng khác kết nối được
+        umask = os.umask(0o177)
+        try:
+            super().__init__(socket_path, _Handler)
+        finally:
+            os.umask(umask)
+
+    def _remove_stale_socket(self):
+        """Xóa tệp socket của daemon cũ đã chết; báo lỗi nếu nó còn chạy."""
+        if not os.path.exists(self.socket_path):
+            return
+        probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            probe.connect(self.socket_path)
+        except OSError:
+            os.remove(self.socket_path)
+        else:
+            raise RuntimeError(
+                f"Daemon dữ liệu đã chạy tại {self.socket_path}")
+        finally:
+            probe.close()
+
+    def open_db(self, db_file: str,
+                indexes: Dict[str, List[str]]) -> StorageBackend:
+        """
+        CSDL đã cấu hình của ``db_file``; ``db_file`` khác bị từ chối để
+        khách không tạo/đọc được tệp tùy ý dưới quyền của daemon. Chỉ mục
+        băm khách khai báo thêm được tạo bổ sung; chỉ mục có thứ tự theo
+        cấu hình của daemon.
+        """
+        db = self._dbs.get(db_file)
+        if db is None:
+            raise PermissionError(
+                f"Daemon dữ liệu không phục vụ {db_file} (chỉ: "
+                f"{', '.join(sorted(self._dbs))})")
+        for table, fields in indexes.items():
+            for field in fields:
+                if field not in db.indexes.get(table, ()):
+                    db.create_index(table, field)
+        return db
+
+    def server_close(self):
+        super().server_close()
+        try:
+            os.remove(self.socket_path)
+        except FileNotFoundError:
+            pass
+
+
+class RemoteDB(StorageBackend):
+    """
+    Backend khách của ``DataDaemon`` với cùng API như ``JsonDB``: mọi thao
+    tác được gửi tới daemon, bản ghi trả về là ``FrozenDict`` như các
+    backend khác.
+
+    Mỗi luồng dùng một kết nối riêng (giao dịch gắn với kết nối). Lần kết
+    nối đầu chờ tới ``CONNECT_TIMEOUT`` giây để daemon kịp khởi động cùng
+    các tiến trình khác. ``wait_for_changes``/``subscribe``/``expire_step``
+    của ``StorageBackend`` chạy phía khách trên ``versions()``/``_expire()``
+    từ xa.
+    """
+    CONNECT_TIMEOUT = 30.0
+
+    def __init__(self, db_file: str,
+                 indexes: Optional[Dict[str, Iterable[str]]] = None,
+                 ordered_indexes: Optional[Dict[str, Tuple[str, str]]] = None,
+                 serializer=None, durability: Optional[str] = None,
+                 ttl: Optional[Dict[str, int]] = None,
+                 socket_path: Optional[str] = None,
+                 connect_timeout: Optional[float] = None):
+        super().__init__(db_file, indexes, ordered_indexes, serializer,
+                         durability, ttl)
+        self.socket_path = (socket_path or daemon_socket_path()
+                            or DEFAULT_SOCKET)
+        self.connect_timeout = (self.CONNECT_TIMEOUT if connect_timeout
+                                is None else connect_timeout)
+        self._local = threading.local()
+        self._location: Optional[str] = None
+
+    @property
+    def location(self) -> str:
+        if self._location is None:
+            self._location = self._call("location")
+        return self._location
+
+    def _connect(self) -> socket.socket:
+        deadline = time.monotonic() + self.connect_timeout
+        while True:
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                sock.connect(self.socket_path)
+                break
+            except OSError as e:
+                sock.close()
+                if time.monotonic() >= deadline:
+                    raise ConnectionError(
+                        f"Không kết nối được daemon dữ liệu tại "
+                        f"{self.socket_path}: {e}") from e
+                time.sleep(0.2)
+        _send(sock, OP_HELLO, self.serializer.dumps({
+            "protocol": PROTOCOL_VERSION,
+            "db_file": os.path.abspath(self.db_file),
+            "indexes": self.indexes,
+            "ordered_indexes": self.ordered_indexes,
+        }))
+        self._check_reply(*_recv(sock))
+        return sock
+
+    def _connection(self) -> socket.socket:
+        sock = getattr(self._local, "sock", None)
+        # Tiến trình con (fork) kế thừa kết nối của cha: dùng chung sẽ lẫn
+        # phản hồi của nhau, nên mở kết nối mới
+        if sock is None or self._local.pid != os.getpid():
+            sock = self._local.sock = self._connect()
+            self._local.pid = os.getpid()
+        return sock
+
+    def _disconnect(self):
+        sock = getattr(self._local, "sock", None)
+        self._local.sock = None
+        if sock is not None:
+            sock.close()
+
+    def _check_reply(self, op: int, body: bytes) -> Any:
+        value = self.serializer.loads(body)
+        if op == OP_ERROR:
+            name, message = value
+            error = _ERRORS.get(name)
+            if error is None:
+                raise RuntimeError(f"{name}: {message}")
+            raise error(message)
+        return value
+
+    def _call(self, method: str, *args, **kwargs) -> Any:
+        """Gọi ``method`` trên daemon và trả về kết quả."""
+        retry = (method in _READ_METHODS
+                 and getattr(self._tx_local, "tables", None) is None)
+        while True:
+            sock = self._connection()
+            try:
+                _send(sock, OP_CALL,
+                      self.serializer.dumps([method, args, kwargs]))
+                reply = _recv(sock)
+            except OSError as e:
+                self._disconnect()
+                if not retry:
+                    raise ConnectionError(
+                        f"Mất kết nối tới daemon dữ liệu: {e}") from e
+                retry = False
+                continue
+            return self._check_reply(*reply)
+
+    # --- Giao dịch ---
+
+    @contextmanager
+    def transaction(self, *tables: str):
+        """Giao dịch của backend phía daemon, trên kết nối của luồng này."""
+        current = getattr(self._tx_local, "tables", None)
+        if current is not None:
+            # Giao dịch lồng nhau nhập vào giao dịch ngoài cùng
+            missing = set(tables) - current
+            if missing:
+                raise ValueError(
+                    f"Giao dịch lồng nhau dùng bảng chưa khai báo: {missing}")
+            yield self
+            return
+
+        self._call("begin", sorted(set(tables)))
+        self._tx_local.tables = set(tables)
+        try:
+            yield self
+        except BaseException:
+            self._tx_local.tables = None
+            try:
+                self._call("end", False)
+            except ConnectionError:
+                pass  # Daemon đã tự hủy giao dịch khi mất kết nối
+            raise
+        self._tx_local.tables = None
+        self._call("end", True)
+
+    # --- Chuyển tiếp tới daemon ---
+
+    def ensure_table(self, table: str):
+        self._check_table_name(table)
+        self._call("ensure_table", table)
+
+    def create_index(self, table: str, field: str):
+        fields = self.indexes.setdefault(table, [])
+        if field not in fields:
+            fields.append(field)
+        self._call("create_index", table, field)
+
+    def compact(self, table: Optional[str] = None):
+        self._call("compact", table)
+
+    def tables(self) -> List[str]:
+        return self._call("tables")
+
+    def backup(self, dest: str) -> Dict[str, int]:
+        return self._call("backup", os.path.abspath(dest))
+
+    def add_many(self, table: str, records: List[Dict[str, Any]]) -> int:
+        # Gán id/created_at phía khách như các backend khác, để người gọi
+        # thấy được id của bản ghi vừa thêm
+        now = datetime.now().isoformat()
+        for data in records:
+            if "id" not in data:
+                data["id"] = str(uuid.uuid4())
+            if "created_at" not in data:
+                data["created_at"] = now
+        return self._call("add_many", table, records)
+
+    def get(self, table: str,
+            filter_dict: Optional[Dict[str, Any]] = None
+            ) -> List[Dict[str, Any]]:
+        return [freeze(rec) for rec in self._call("get", table, filter_dict)]
+
+    def query(self, table: str,
+              filter_dict: Optional[Dict[str, Any]] = None,
+              fields: Optional[Iterable[str]] = None,
+              order_by: Optional[str] = None,
+              limit: Optional[int] = None, offset: int = 0,
+              after: Any = None) -> Iterator[Dict[str, Any]]:
+        rows = self._call("query", table, filter_dict,
+                          None if fields is None else list(fields),
+                          order_by, limit, offset, after)
+        self.metrics.note(returned=len(rows))
+        return map(freeze, rows)
+
+    def scan(self, table: str, batch_size: int = 1000,
+             after: Optional[str] = None) -> Iterator[List[Dict[str, Any]]]:
+        """
+        Duyệt theo trang ``after``/``limit`` trên id, mỗi trang một lượt
+        gọi; chỉ các bản ghi cũ thiếu id (đứng đầu) mới phân trang bằng
+        ``offset``.
+        """
+        offset = 0
+        while True:
+            batch = list(self.query(table, order_by="id", limit=batch_size,
+                                    offset=offset, after=after))
+            if not batch:
+                return
+            last = batch[-1].get("id")
+            if last is None:
+                offset += len(batch)
+            else:
+                after, offset = last, 0
+            yield batch
+
+    def count(self, table: str,
+              filter_dict: Optional[Dict[str, Any]] = None) -> int:
+        return self._call("count", table, filter_dict)
+
+    def latest(self, table: str,
+               key: Any = None) -> Optional[Dict[str, Any]]:
+        rec = self._call("latest", table, key)
+        return None if rec is None else freeze(rec)
+
+    def range(self, table: str, key: Any, since: Any = None,
+              until: Any = None) -> List[Dict[str, Any]]:
+        return [freeze(rec) for rec
+                in self._call("range", table, key, since, until)]
+
+    def tail(self, table: str, key: Any, n: int) -> List[Dict[str, Any]]:
+        return [freeze(rec) for rec in self._call("tail", table, key, n)]
+
+    def update(self, table: str, filter_dict: Dict[str, Any],
+               update_data: Dict[str, Any]) -> int:
+        return self._call("update", table, filter_dict, update_data)
+
+    def delete(self, table: str,
+               filter_dict: Optional[Dict[str, Any]] = None) -> int:
+        return self._call("delete", table, filter_dict)
+
+    def overwrite_table(self, table: str, data: List[Dict[str, Any]]):
+        self._call("overwrite_table", table, data)
+
+    def version(self, table: str) -> int:
+        return self._call("version", table)
+
+    def stats(self) -> Dict[str, Any]:
+        """
+        Số liệu phía khách (thời gian mỗi lượt gọi, gồm cả truyền qua
+        socket) kèm ``"daemon"``: số liệu của chính backend trong daemon.
+        """
+        return {**super().stats(), "daemon": self._call("stats")}
+
+    def reset_stats(self):
+        super().reset_stats()
+        self._call("reset_stats")
+
+    def versions(self, *tables: str) -> Dict[str, int]:
+        """Một lượt gọi cho mọi bảng (dùng khi chờ thay đổi)."""
+        return self._call("versions", *tables)
+
+    def _expire(self, table: str, field: str, cutoff: str,
+                limit: int) -> int:
+        return self._call("expire", table, field, cutoff, limit)
+
+
+class TerraSyncRemoteDB(TerraSyncMixin, RemoteDB):
+    """Cơ sở dữ liệu TerraSync qua daemon dữ liệu."""
+
+
+def main():
+    """
+    Chạy daemon tại ``daemon_socket``. Không khởi chạy mặc định: thêm
+    ``"data_daemon": ["python", "-m", "database_remote"]`` vào
+    ``multiprocess.json`` sau khi đặt ``daemon_socket``.
+    """
+    socket_path = daemon_socket_path()
+    if socket_path is None or not hasattr(socket, "AF_UNIX"):
+        if socket_path is None:
+            print("Chưa cấu hình daemon_socket; daemon dữ liệu không chạy "
+                  "(các tiến trình tự truy cập kho dữ liệu)")
+        else:
+            print("Hệ điều hành không hỗ trợ Unix socket; daemon dữ liệu "
+                  "không chạy (các tiến trình tự truy cập kho dữ liệu)")
+        # Chờ thay vì thoát để ProcessManager không khởi động lại liên tục
+        threading.Event().wait()
+        return
+    server = DataDaemon(socket_path)
+    # SIGTERM của ProcessManager: thoát qua finally để xóa tệp socket
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+    print(f"Daemon dữ liệu đang chạy tại {socket_path}")
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+
+
+if __name__ == "__main__":
+    main()
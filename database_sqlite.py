@@ -0,0 +1,699 @@
+"""
+TerraSync SQLite Backend
+Backend lưu trữ SQLite cho ``database.StorageBackend``: toàn bộ CSDL nằm
+trong một tệp ở chế độ WAL, nên nhiều tiến trình đọc đồng thời không chặn
+nhau (và không bị lần ghi chặn), truy vấn đi qua chỉ mục và mỗi lần ghi chỉ
+chạm tới các dòng liên quan thay vì ghi lại cả bảng.
+
+Mỗi bảng logic là một bảng SQL ``(seq INTEGER PRIMARY KEY, doc TEXT)``:
+``seq`` giữ thứ tự chèn, ``doc`` là bản ghi dạng JSON. Các trường trong
+``INDEXES``/``ORDERED_INDEXES`` (vd. ``hub_id``, ``user_email``,
+``timestamp``) có chỉ mục biểu thức trên ``json_extract(doc, ...)``.
+
+Chọn backend này bằng ``backend = "sqlite"`` trong mục ``[database]`` của
+appcfg.toml (hoặc ``TERRASYNC_DB_BACKEND=sqlite``); xem ``database.create_db``.
+"""
+import os
+import re
+import sqlite3
+import threading
+import uuid
+from contextlib import contextmanager
+from datetime import datetime
+from typing import Dict, List, Any, Optional, Tuple, Iterable, Iterator
+from filelock import FileLock
+
+from database import (StorageBackend, TerraSyncMixin, JsonDB, freeze,
+                      _fsync_dir, _check_operators, _is_operator, _operand,
+                      _expiry)
+
+# Mức độ bền vững (xem database.DURABILITY_LEVELS) -> PRAGMA synchronous.
+# Ở chế độ WAL, NORMAL vẫn nhất quán khi mất điện nhưng có thể mất các
+# giao dịch cuối, giống cách backend JSON chỉ fsync nhật ký ở mức "full".
+_SYNCHRONOUS = {"fast": "OFF", "safe": "NORMAL", "full": "FULL"}
+_PLAIN_FIELD_RE = re.compile(r"^[A-Za-z_][A-Za-z0-9_]*$")
+_COMPARISONS = {"$gt": ">", "$gte": ">=", "$lt": "<", "$lte": "<="}
+# Bảng phiên bản cho luồng thay đổi; tên có dấu chấm nên không trùng được
+# với bảng dữ liệu (xem StorageBackend._TABLE_NAME_RE)
+_VERSIONS_NAME = "_meta.versions"
+_VERSIONS = f'"{_VERSIONS_NAME}"'
+
+
+def _json_path(field: str) -> str:
+    """Đường dẫn JSON (dạng literal SQL) tới trường cấp cao nhất ``field``."""
+    if _PLAIN_FIELD_RE.match(field):
+        return f"'$.{field}'"
+    if '"' in field:
+        raise ValueError(f"Tên trường không hỗ trợ: {field!r}")
+    return "'$.\"%s\"'" % field.replace("'", "''")
+
+
+def _field_sql(field: str) -> str:
+    """
+    Biểu thức đọc ``field`` từ cột ``doc``. Phải giống hệt biểu thức của
+    chỉ mục thì SQLite mới dùng chỉ mục đó.
+    """
+    return f"json_extract(doc, {_json_path(field)})"
+
+
+def _index_name(table: str, *fields: str) -> str:
+    return '"ix_%s__%s"' % (
+        table, "__".join(re.sub(r"\W", "_", f) for f in fields))
+
+
+class SQLiteDB(StorageBackend):
+    """
+    Backend SQLite (WAL) với cùng API như ``JsonDB``.
+
+    Tệp CSDL mặc định là ``<db_file không đuôi>.sqlite3``. Nếu tệp chưa tồn
+    tại mà có dữ liệu của backend JSON (``db_file`` một-khối hoặc thư mục
+    bảng), dữ liệu đó được chuyển sang một lần duy nhất ở lần mở đầu tiên;
+    dữ liệu JSON được giữ nguyên làm bản sao lưu.
+
+    Mỗi luồng dùng một kết nối riêng. ``transaction()`` là một giao dịch
+    SQLite nên nguyên tử trên mọi bảng đã khai báo, kể cả khi mất điện.
+    Phiên bản của các bảng nằm trong bảng ``_meta.versions`` và được tăng
+    trong cùng giao dịch với lần ghi.
+    """
+
+    def __init__(self, db_file: str,
+                 indexes: Optional[Dict[str, Iterable[str]]] = None,
+                 ordered_indexes: Optional[Dict[str, Tuple[str, str]]] = None,
+                 serializer=None, durability: Optional[str] = None,
+                 ttl: Optional[Dict[str, int]] = None,
+                 path: Optional[str] = None):
+        super().__init__(db_file, indexes, ordered_indexes, serializer,
+                         durability, ttl)
+        base, ext = os.path.splitext(db_file)
+        self.path = path or f"{base if ext else db_file}.sqlite3"
+        self._local = threading.local()
+        self._ready: set = set()
+        self._migrate_from_json()
+
+    @property
+    def location(self) -> str:
+        return self.path
+
+    # --- Kết nối và lược đồ ---
+
+    def _conn(self) -> sqlite3.Connection:
+        """Kết nối của luồng hiện tại (mở lại sau khi fork)."""
+        conn = getattr(self._local, "conn", None)
+        if conn is None or self._local.pid != os.getpid():
+            directory = os.path.dirname(os.path.abspath(self.path))
+            os.makedirs(directory, exist_ok=True)
+            # isolation_level=None: tự quản lý BEGIN/COMMIT
+            conn = sqlite3.connect(self.path, timeout=30,
+                                   isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(
+                f"PRAGMA synchronous={_SYNCHRONOUS[self.durability]}")
+            conn.execute(f"CREATE TABLE IF NOT EXISTS {_VERSIONS} "
+                         "(name TEXT PRIMARY KEY, version INTEGER NOT NULL)")
+            self._local.conn, self._local.pid = conn, os.getpid()
+        return conn
+
+    def _create_table_unsafe(self, conn: sqlite3.Connection, table: str):
+        """Tạo bảng và các chỉ mục đã khai báo (bỏ qua nếu đã có)."""
+        name = f'"{table}"'
+        conn.execute(f"CREATE TABLE IF NOT EXISTS {name} "
+                     "(seq INTEGER PRIMARY KEY, doc TEXT NOT NULL)")
+        fields = ["id"] + [f for f in self.indexes.get(table, ())
+                           if f != "id"]
+        for field in fields:
+            conn.execute(f"CREATE INDEX IF NOT EXISTS "
+                         f"{_index_name(table, field)} "
+                         f"ON {name}({_field_sql(field)})")
+        ordered = self.ordered_indexes.get(table)
+        if ordered:
+            part_field, order_field = ordered
+            conn.execute(f"CREATE INDEX IF NOT EXISTS "
+                         f"{_index_name(table, part_field, order_field)} "
+                         f"ON {name}({_field_sql(part_field)}, "
+                         f"{_field_sql(order_field)})")
+            conn.execute(f"CREATE INDEX IF NOT EXISTS "
+                         f"{_index_name(table, order_field)} "
+                         f"ON {name}({_field_sql(order_field)})")
+
+    def _table(self, table: str, create: bool = False) -> Optional[str]:
+        """
+        Tên SQL (đã đặt trong ngoặc kép) của bảng; None nếu bảng chưa tồn
+        tại và ``create`` là False. Chỉ mục được đảm bảo ở lần dùng đầu tiên
+        của mỗi tiến trình.
+        """
+        if table in self._ready:
+            return f'"{table}"'
+        self._check_table_name(table)
+        conn = self._conn()
+        exists = conn.execute(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?",
+            (table,)).fetchone()
+        if not exists and not create:
+            return None
+        with self._writing() as conn:
+            self._create_table_unsafe(conn, table)
+        self._ready.add(table)
+        return f'"{table}"'
+
+    def _migrate_from_json(self):
+        """Chuyển dữ liệu của backend JSON sang SQLite (chỉ chạy một lần)."""
+        if os.path.exists(self.path):
+            return
+        if not (os.path.isfile(self.db_file) or os.path.isdir(self.data_dir)):
+            return
+        with FileLock(f"{self.path}.lock"):
+            if os.path.exists(self.path):
+                return  # Tiến trình khác đã chuyển đổi xong
+            source = JsonDB(self.db_file, serializer=self.serializer,
+                            durability=self.durability)
+            tmp_path = f"{self.path}.tmp"
+            for leftover in (tmp_path, f"{tmp_path}-journal"):
+                if os.path.exists(leftover):
+                    os.remove(leftover)
+            tables = source.tables()
+            conn = sqlite3.connect(tmp_path, isolation_level=None)
+            try:
+                conn.execute("BEGIN")
+                for table in tables:
+                    self._check_table_name(table)
+                    self._create_table_unsafe(conn, table)
+                    conn.executemany(
+                        f'INSERT INTO "{table}" (doc) VALUES (?)',
+                        ((self._dumps(rec),) for rec in source.get(table)))
+                conn.execute("COMMIT")
+            finally:
+                conn.close()
+            os.replace(tmp_path, self.path)
+            _fsync_dir(os.path.dirname(os.path.abspath(self.path)))
+            print(f"Đã chuyển {len(tables)} bảng từ {source.location}/ "
+                  f"sang {self.path}")
+
+    def _dumps(self, record: Dict[str, Any]) -> str:
+        return self.serializer.dumps(record).decode("utf-8")
+
+    def _param(self, value: Any) -> Any:
+        """Giá trị so sánh: dict/list so với văn bản JSON mà SQLite trả về."""
+        if isinstance(value, (dict, list)):
+            return self._dumps(value)
+        if isinstance(value, datetime):
+            return value.isoformat()
+        return value
+
+    # --- Giao dịch ---
+
+    @contextmanager
+    def _writing(self):
+        """Giao dịch ghi ngắn, hoặc nhập vào giao dịch đang mở của luồng."""
+        conn = self._conn()
+        if conn.in_transaction:
+            yield conn
+            return
+        conn.execute("BEGIN IMMEDIATE")
+        self._local.bumped = set()
+        try:
+            yield conn
+            conn.execute("COMMIT")
+        except BaseException:
+            if conn.in_transaction:
+                conn.execute("ROLLBACK")
+            raise
+        self._notify_change()
+
+    def _bump_version(self, conn: sqlite3.Connection, table: str):
+        """
+        Tăng phiên bản của bảng trong giao dịch ghi đang mở (một lần cho
+        mỗi giao dịch, như backend JSON).
+        """
+        if table in self._local.bumped:
+            return
+        self._local.bumped.add(table)
+        conn.execute(f"INSERT INTO {_VERSIONS} (name, version) VALUES (?, 1) "
+                     "ON CONFLICT(name) DO UPDATE SET version = version + 1",
+                     (table,))
+
+    @contextmanager
+    def transaction(self, *tables: str):
+        """
+        Mở một giao dịch SQLite trên các bảng ``tables`` (cùng cách dùng
+        như ``JsonDB.transaction``). Các thao tác của luồng hiện tại thấy
+        được thay đổi của nhau; người đọc ở luồng/tiến trình khác vẫn đọc
+        bản đã xác nhận mà không bị chặn. Thoát bình thường thì xác nhận,
+        có ngoại lệ thì hủy toàn bộ. Truy cập bảng chưa khai báo sẽ báo
+        ``ValueError``.
+        """
+        current = getattr(self._tx_local, "tables", None)
+        if current is not None:
+            # Giao dịch lồng nhau nhập vào giao dịch ngoài cùng
+            missing = set(tables) - current
+            if missing:
+                raise ValueError(
+                    f"Giao dịch lồng nhau dùng bảng chưa khai báo: {missing}")
+            yield self
+            return
+
+        for table in tables:
+            self._table(table, create=True)
+        with self._writing():
+            self._tx_local.tables = set(tables)
+            try:
+                yield self
+            finally:
+                self._tx_local.tables = None
+
+    def _active_tx(self, table: str) -> Optional[set]:
+        """Các bảng của giao dịch đang mở (nếu có) của luồng hiện tại."""
+        tables = getattr(self._tx_local, "tables", None)
+        if tables is not None and table not in tables:
+            raise ValueError(
+                f"Bảng {table!r} chưa được khai báo trong giao dịch")
+        return tables
+
+    # --- Dịch bộ lọc sang SQL ---
+
+    def _where(self, filter_dict: Optional[Dict[str, Any]]
+               ) -> Tuple[List[str], List[Any]]:
+        """Các điều kiện SQL (nối bằng AND) và tham số của bộ lọc."""
+        clauses: List[str] = []
+        params: List[Any] = []
+        for field, cond in (filter_dict or {}).items():
+            expr = _field_sql(field)
+            if not _is_operator(cond):
+                if cond is None:
+                    clauses.append(f"{expr} IS NULL")
+                else:
+                    clauses.append(f"{expr} = ?")
+                    params.append(self._param(cond))
+                continue
+            _check_operators(cond)
+            for op, operand in cond.items():
+                clause, args = self._operator_sql(field, expr, op,
+                                                  _operand(operand))
+                clauses.append(clause)
+                params += args
+        return clauses, params
+
+    def _operator_sql(self, field: str, expr: str, op: str,
+                      operand: Any) -> Tuple[str, List[Any]]:
+        """
+        Một toán tử lọc dưới dạng SQL, giữ ngữ nghĩa của backend JSON:
+        so sánh khác kiểu không khớp, trường thiếu được coi là None.
+        """
+        if op in _COMPARISONS:
+            if isinstance(operand, str):
+                types = "('text')"
+            elif isinstance(operand, (bool, int, float)):
+                types = "('integer', 'real', 'true', 'false')"
+            else:
+                return "0", []
+            return (f"(json_type(doc, {_json_path(field)}) IN {types} "
+                    f"AND {expr} {_COMPARISONS[op]} ?)", [operand])
+        if op == "$ne":
+            return f"{expr} IS NOT ?", [self._param(operand)]
+
+        values = operand if isinstance(operand, list) else [operand]
+        present = [self._param(v) for v in values if v is not None]
+        has_null = len(present) != len(values)
+        marks = ", ".join("?" * len(present))
+        if op == "$in":
+            parts = [f"{expr} IN ({marks})"] if present else []
+            if has_null:
+                parts.append(f"{expr} IS NULL")
+            return (f"({' OR '.join(parts)})" if parts else "0"), present
+        # $nin
+        if not present:
+            return (f"{expr} IS NOT NULL" if has_null else "1"), []
+        if has_null:
+            return f"({expr} IS NOT NULL AND {expr} NOT IN ({marks}))", present
+        return f"({expr} IS NULL OR {expr} NOT IN ({marks}))", present
+
+    @staticmethod
+    def _sql(base: str, clauses: List[str]) -> str:
+        return f"{base} WHERE {' AND '.join(clauses)}" if clauses else base
+
+    # --- Đọc ---
+
+    def _decode(self, doc: str) -> Dict[str, Any]:
+        """Giải mã một dòng thành bản ghi chỉ đọc (như các backend khác)."""
+        return freeze(self.serializer.loads(doc))
+
+    def get(self, table: str,
+            filter_dict: Optional[Dict[str, Any]] = None
+            ) -> List[Dict[str, Any]]:
+        """Lấy các bản ghi khớp bộ lọc, theo thứ tự chèn."""
+        return list(self.query(table, filter_dict))
+
+    def query(self, table: str,
+              filter_dict: Optional[Dict[str, Any]] = None,
+              fields: Optional[Iterable[str]] = None,
+              order_by: Optional[str] = None,
+              limit: Optional[int] = None, offset: int = 0,
+              after: Any = None) -> Iterator[Dict[str, Any]]:
+        """
+        Truy vấn một bảng (cùng tham số như ``JsonDB.query``). Lọc, sắp xếp
+        và phân trang chạy trong SQLite (qua chỉ mục nếu có); bản ghi chỉ
+        được giải mã JSON dần khi duyệt iterator.
+        """
+        fields = list(fields) if fields is not None else None
+        if offset < 0 or (limit is not None and limit < 0):
+            raise ValueError("offset và limit không được âm")
+        desc = bool(order_by) and order_by.startswith("-")
+        order_field = order_by[1:] if desc else order_by
+        if after is not None and not order_field:
+            raise ValueError("after chỉ dùng được cùng order_by")
+        self._active_tx(table)
+        name = self._table(table)
+        if name is None:
+            return iter(())
+
+        clauses, params = self._where(filter_dict)
+        if order_field:
+            expr = _field_sql(order_field)
+            if after is not None:
+                clause, args = self._after_sql(name, expr, after, desc)
+                clauses.append(clause)
+                params += args
+            direction = "DESC" if desc else "ASC"
+            order = f" ORDER BY {expr} {direction}, seq {direction}"
+        else:
+            order = " ORDER BY seq"
+        sql = self._sql(f"SELECT doc FROM {name}", clauses) + order
+        if limit is not None or offset:
+            sql += " LIMIT ? OFFSET ?"
+            params += [-1 if limit is None else limit, offset]
+        docs = self._conn().execute(sql, params).fetchall()
+        self.metrics.note(returned=len(docs))
+
+        if fields is None:
+            decode = self._decode
+            return (decode(doc) for doc, in docs)
+        loads = self.serializer.loads
+        return (freeze({f: rec[f] for f in fields if f in rec})
+                for rec in (loads(doc) for doc, in docs))
+
+    def _after_sql(self, name: str, expr: str, after: Any,
+                   desc: bool) -> Tuple[str, List[Any]]:
+        """
+        Điều kiện "đứng sau ``after``" cho phân trang theo khóa: cặp
+        ``(giá trị, id)`` trỏ đúng bản ghi đó; nếu chỉ có giá trị (hoặc bản
+        ghi đã bị xóa) thì bỏ qua mọi bản ghi mang giá trị đó.
+        """
+        record_id = None
+        if isinstance(after, (list, tuple)) and len(after) == 2:
+            after, record_id = after
+        value = self._param(_operand(after))
+        seq = None
+        if record_id:
+            row = self._conn().execute(
+                f"SELECT seq FROM {name} WHERE {_field_sql('id')} = ? "
+                "LIMIT 1", (record_id,)).fetchone()
+            seq = row[0] if row else None
+        op = "<" if desc else ">"
+        if value is None:
+            # None đứng đầu thứ tự tăng dần
+            strict, args = ("0" if desc else f"{expr} IS NOT NULL"), []
+        elif desc:
+            strict, args = f"({expr} < ? OR {expr} IS NULL)", [value]
+        else:
+            strict, args = f"{expr} > ?", [value]
+        if seq is None:
+            return strict, args
+        return (f"({strict} OR ({expr} IS ? AND seq {op} ?))",
+                args + [value, seq])
+
+    def scan(self, table: str, batch_size: int = 1000,
+             after: Optional[str] = None) -> Iterator[List[Dict[str, Any]]]:
+        """
+        Duyệt cả bảng thành từng lô theo khóa ``(id, seq)`` (xem
+        ``StorageBackend.scan``): mỗi lô là một truy vấn ngắn trên chỉ mục
+        id, không giữ giao dịch đọc suốt lần duyệt và không phải bỏ qua lại
+        các dòng đã đọc.
+        """
+        self._active_tx(table)
+        name = self._table(table)
+        if name is None:
+            return
+        conn = self._conn()
+        expr = _field_sql("id")
+        select = f"SELECT seq, {expr}, doc FROM {name} WHERE "
+        if after is None:
+            # Bản ghi cũ thiếu id đứng đầu thứ tự, duyệt theo seq
+            sql = select + f"{expr} IS NULL AND seq > ? ORDER BY seq LIMIT ?"
+            rows = conn.execute(sql, (0, batch_size)).fetchall()
+            while rows:
+                yield [self._decode(doc) for _, _, doc in rows]
+                rows = conn.execute(sql, (rows[-1][0], batch_size)).fetchall()
+            start, args = f"{expr} IS NOT NULL", []
+        else:
+            start, args = f"{expr} > ?", [after]
+        order = f" ORDER BY {expr}, seq LIMIT ?"
+        rows = conn.execute(select + start + order,
+                            args + [batch_size]).fetchall()
+        while rows:
+            yield [self._decode(doc) for _, _, doc in rows]
+            seq, last, _ = rows[-1]
+            rows = conn.execute(select + f"({expr}, seq) > (?, ?)" + order,
+                                (last, seq, batch_size)).fetchall()
+
+    def count(self, table: str,
+              filter_dict: Optional[Dict[str, Any]] = None) -> int:
+        """Đếm số bản ghi khớp bộ lọc mà không giải mã bản ghi nào."""
+        self._active_tx(table)
+        name = self._table(table)
+        if name is None:
+            return 0
+        clauses, params = self._where(filter_dict)
+        sql = self._sql(f"SELECT COUNT(*) FROM {name}", clauses)
+        return self._conn().execute(sql, params).fetchone()[0]
+
+    def _ordered_sql(self, table: str
+                     ) -> Tuple[Optional[str], str, str]:
+        """Tên bảng và biểu thức (nhóm, thời gian) của chỉ mục có thứ tự."""
+        ordered = self.ordered_indexes.get(table)
+        if not ordered:
+            raise ValueError(f"Bảng {table!r} không có chỉ mục có thứ tự")
+        self._active_tx(table)
+        part_field, order_field = ordered
+        return (self._table(table), _field_sql(part_field),
+                _field_sql(order_field))
+
+    def _key_clause(self, part: str, key: Any) -> Tuple[str, List[Any]]:
+        if key is None:
+            return f"{part} IS NULL", []
+        return f"{part} = ?", [self._param(key)]
+
+    def latest(self, table: str,
+               key: Any = None) -> Optional[Dict[str, Any]]:
+        """
+        Bản ghi mới nhất của nhóm ``key`` theo chỉ mục có thứ tự của bảng.
+        ``key=None``: mới nhất toàn bảng.
+        """
+        name, part, order = self._ordered_sql(table)
+        if name is None:
+            return None
+        clauses, params = [], []
+        if key is not None:
+            clauses, params = [f"{part} = ?"], [self._param(key)]
+        sql = self._sql(f"SELECT doc FROM {name}", clauses)
+        row = self._conn().execute(
+            f"{sql} ORDER BY {order} DESC, seq DESC LIMIT 1",
+            params).fetchone()
+        return self._decode(row[0]) if row else None
+
+    def range(self, table: str, key: Any, since: Any = None,
+              until: Any = None) -> List[Dict[str, Any]]:
+        """
+        Các bản ghi của nhóm ``key`` có ``since <= thời gian < until``
+        (chuỗi ISO 8601 hoặc datetime), theo thứ tự thời gian tăng dần.
+        """
+        name, part, order = self._ordered_sql(table)
+        if name is None:
+            return []
+        clause, params = self._key_clause(part, key)
+        clauses = [clause]
+        if since is not None:
+            clauses.append(f"{order} >= ?")
+            params.append(self._param(since))
+        if until is not None:
+            clauses.append(f"{order} < ?")
+            params.append(self._param(until))
+        sql = self._sql(f"SELECT doc FROM {name}", clauses)
+        decode = self._decode
+        return [decode(doc) for doc, in self._conn().execute(
+            f"{sql} ORDER BY {order}, seq", params)]
+
+    def tail(self, table: str, key: Any, n: int) -> List[Dict[str, Any]]:
+        """N bản ghi mới nhất của nhóm ``key``, theo thứ tự thời gian tăng dần."""
+        name, part, order = self._ordered_sql(table)
+        if name is None or n <= 0:
+            return []
+        clause, params = self._key_clause(part, key)
+        rows = self._conn().execute(
+            f"SELECT doc FROM {name} WHERE {clause} "
+            f"ORDER BY {order} DESC, seq DESC LIMIT ?",
+            params + [n]).fetchall()
+        decode = self._decode
+        return [decode(doc) for doc, in reversed(rows)]
+
+    # --- Ghi ---
+
+    def add_many(self, table: str, records: List[Dict[str, Any]]) -> int:
+        """
+        Thêm nhiều bản ghi trong một giao dịch (cả lô được áp dụng nguyên
+        tử). Trả về số bản ghi đã thêm.
+        """
+        self._active_tx(table)
+        name = self._table(table, create=True)
+        now = datetime.now().isoformat()
+        for data in records:
+            if "id" not in data:
+                data["id"] = str(uuid.uuid4())
+            if "created_at" not in data:
+                data["created_at"] = now
+        with self._writing() as conn:
+            conn.executemany(f"INSERT INTO {name} (doc) VALUES (?)",
+                             [(self._dumps(data),) for data in records])
+            if records:
+                self._bump_version(conn, table)
+        return len(records)
+
+    def update(self, table: str, filter_dict: Dict[str, Any],
+               update_data: Dict[str, Any]) -> int:
+        """Cập nhật các bản ghi khớp bộ lọc; chỉ ghi lại các dòng đó."""
+        self._active_tx(table)
+        name = self._table(table)
+        if name is None:
+            return 0
+        clauses, params = self._where(filter_dict)
+        loads = self.serializer.loads
+        with self._writing() as conn:
+            rows = conn.execute(
+                self._sql(f"SELECT seq, doc FROM {name}", clauses),
+                params).fetchall()
+            changes = []
+            for seq, doc in rows:
+                rec = loads(doc)
+                rec.update(update_data)
+                rec["updated_at"] = datetime.now().isoformat()
+                changes.append((self._dumps(rec), seq))
+            conn.executemany(f"UPDATE {name} SET doc = ? WHERE seq = ?",
+                             changes)
+            if rows:
+                self._bump_version(conn, table)
+        return len(rows)
+
+    def delete(self, table: str,
+               filter_dict: Optional[Dict[str, Any]] = None) -> int:
+        """Xóa các bản ghi khớp bộ lọc. Trả về số bản ghi đã xóa."""
+        self._active_tx(table)
+        name = self._table(table)
+        if name is None:
+            return 0
+        clauses, params = self._where(filter_dict)
+        with self._writing() as conn:
+            deleted = conn.execute(self._sql(f"DELETE FROM {name}", clauses),
+                                   params).rowcount
+            if deleted:
+                self._bump_version(conn, table)
+        return deleted
+
+    def overwrite_table(self, table: str, data: List[Dict[str, Any]]):
+        """Ghi đè toàn bộ dữ liệu của một bảng trong một giao dịch."""
+        self._active_tx(table)
+        name = self._table(table, create=True)
+        with self._writing() as conn:
+            conn.execute(f"DELETE FROM {name}")
+            conn.executemany(f"INSERT INTO {name} (doc) VALUES (?)",
+                             [(self._dumps(rec),) for rec in data])
+            self._bump_version(conn, table)
+
+    def _expire(self, table: str, field: str, cutoff: str,
+                limit: int) -> int:
+        """
+        Xóa một lô bản ghi hết hạn trong một giao dịch ngắn, tìm qua chỉ mục
+        của trường thời gian (nếu có) thay vì quét bảng. Thời điểm được so
+        sánh sau khi quy về UTC (giờ không múi giờ là giờ địa phương, như
+        ``JsonDB``).
+        """
+        self._active_tx(table)
+        name = self._table(table)
+        if name is None:
+            return 0
+        expr = _field_sql(field)
+        _, bound = _expiry(cutoff)
+        instant = (f"CASE WHEN substr({expr}, 20) GLOB '*[+Z-]*' "
+                   f"THEN julianday({expr}) ELSE julianday({expr}, 'utc') END")
+        with self._writing() as conn:
+            deleted = conn.execute(
+                f"DELETE FROM {name} WHERE seq IN (SELECT seq FROM {name} "
+                f"WHERE {expr} < ? AND json_type(doc, {_json_path(field)}) "
+                f"= 'text' AND {instant} < julianday(?) "
+                f"ORDER BY {expr} LIMIT ?)",
+                (bound, cutoff, limit)).rowcount
+            if deleted:
+                self._bump_version(conn, table)
+        return deleted
+
+    def version(self, table: str) -> int:
+        """Phiên bản của bảng (đọc bản đã xác nhận mới nhất)."""
+        row = self._conn().execute(
+            f"SELECT version FROM {_VERSIONS} WHERE name = ?",
+            (table,)).fetchone()
+        return row[0] if row else 0
+
+    # --- Quản trị ---
+
+    def ensure_table(self, table: str):
+        """Tạo bảng rỗng (cùng các chỉ mục) nếu chưa tồn tại."""
+        self._table(table, create=True)
+
+    def create_index(self, table: str, field: str):
+        """Khai báo thêm một chỉ mục cho ``table.field``."""
+        fields = self.indexes.setdefault(table, [])
+        if field not in fields:
+            fields.append(field)
+        self._ready.discard(table)
+        self._table(table)
+
+    def compact(self, table: Optional[str] = None):
+        """
+        Gộp WAL vào tệp chính; khi không chỉ định bảng thì VACUUM cả tệp để
+        thu hồi dung lượng của các dòng đã xóa.
+        """
+        if table is not None:
+            self._check_table_name(table)
+        conn = self._conn()
+        if table is None:
+            conn.execute("VACUUM")
+        conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+
+    def backup(self, dest: str) -> Dict[str, int]:
+        """
+        Sao lưu tệp CSDL vào ``dest`` (tệp, hoặc thư mục chứa tệp cùng
+        tên) bằng ``VACUUM INTO``: SQLite đọc trong một giao dịch nên bản
+        sao nhất quán tại một thời điểm dù người khác vẫn ghi, đồng thời đã
+        được gộp WAL và thu gọn. Ghi qua tệp tạm rồi thay nguyên tử.
+        """
+        if os.path.isdir(dest):
+            dest = os.path.join(dest, os.path.basename(self.path))
+        if os.path.abspath(dest) == os.path.abspath(self.path):
+            raise ValueError("Tệp sao lưu trùng với tệp dữ liệu")
+        tmp_path = f"{dest}.tmp"
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        self._conn().execute("VACUUM INTO ?", (tmp_path,))
+        with open(tmp_path, "rb") as f:
+            os.fsync(f.fileno())
+        os.replace(tmp_path, dest)
+        _fsync_dir(os.path.dirname(os.path.abspath(dest)))
+        return {os.path.basename(dest): os.path.getsize(dest)}
+
+    def tables(self) -> List[str]:
+        """Lấy danh sách các bảng."""
+        rows = self._conn().execute(
+            "SELECT name FROM sqlite_master WHERE type = 'table' "
+            "AND name NOT LIKE 'sqlite\\_%' ESCAPE '\\' ORDER BY name")
+        return [name for name, in rows if name != _VERSIONS_NAME]
+
+
+class TerraSyncSQLiteDB(TerraSyncMixin, SQLiteDB):
+    """Cơ sở dữ liệu TerraSync trên backend SQLite."""
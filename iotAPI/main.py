@@ -1,12 +1,23 @@
 from datetime import datetime, timezone, timedelta
-from typing import Any, Dict, List, Optional
+from typing import Any, Dict, List, Optional, Tuple
 import os
 import sys
+import asyncio
+import base64
+import json
+import math
+import queue
+import threading
+import time
 import logging
+import contextlib
+from collections import OrderedDict
+from concurrent.futures import Future
 
-from fastapi import FastAPI, HTTPException, status, BackgroundTasks
+from fastapi import FastAPI, HTTPException, status, Body, Query
 from fastapi.middleware.cors import CORSMiddleware
-from pydantic import BaseModel, Field, field_validator
+from fastapi.concurrency import run_in_threadpool
+from pydantic import BaseModel, Field, ValidationError, field_validator
 # Cần cài đặt: pip install fastapi-utils
 from fastapi_utils.tasks import repeat_every
 
@@ -32,8 +43,49 @@ except ImportError:
 
         def overwrite_table(self, *args):
             logger.warning("DB: Chế độ giả lập, không lưu overwrite.")
+
+        def latest(self, *args):
+            logger.warning("DB: Chế độ giả lập, trả về None")
+            return None
+
+        def tail(self, *args):
+            return []
+
+        def add_many(self, *args):
+            logger.warning("DB: Chế độ giả lập, không lưu add_many.")
+            return 0
+
+        def transaction(self, *args):
+            return contextlib.nullcontext(self)
+
+        def query(self, *args, **kwargs):
+            logger.warning("DB: Chế độ giả lập, trả về []")
+            return iter([])
+
+        def count(self, *args):
+            return 0
+
+        EXPIRE_BATCH = 1000
+
+        def set_ttl(self, *args):
+            pass
+
+        def expire_step(self, *args):
+            return 0
+
+        def stats(self):
+            return {}
+
+        def reset_stats(self):
+            pass
     db = MockDB()
 
+try:
+    from telemetry_store import telemetry_store
+except ImportError:
+    logger.warning("Không tải được kho telemetry dạng cột, bỏ qua.")
+    telemetry_store = None
+
 
 # --- Pydantic Models (Không thay đổi) ---
 class SoilSensors(BaseModel):
@@ -77,6 +129,10 @@ class TelemetryData(BaseModel):
 class TelemetryPayload(BaseModel):
     hub_id: str = Field(..., description="Unique hub identifier")
     timestamp: datetime = Field(..., description="Timestamp of data collection")
+    seq: Optional[int] = Field(
+        None, ge=0,
+        description="Optional per-hub sequence number, increasing "
+        "monotonically; used instead of timestamp to detect retries")
     location: Optional[Dict[str, float]] = Field(
         None, description="Optional location coordinates")
     data: TelemetryData = Field(..., description="Sensor data")
@@ -150,81 +206,65 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-# --- Cấu hình dọn dẹp tự động (Không thay đổi) ---
+# --- Cấu hình dọn dẹp tự động ---
 ALERT_RETENTION_DAYS = 30
 TELEMETRY_RETENTION_DAYS = 90  # Thêm hằng số mới cho dọn dẹp Telemetry
+# Số bản tin tối đa trong một yêu cầu /api/v1/data/ingest/batch
+MAX_BATCH_ITEMS = 1000
 
+# --- Cấu hình hàng đợi ghi telemetry ---
+INGEST_QUEUE_SIZE = 10000  # Số bản tin tối đa đang chờ ghi
+INGEST_GROUP_MAX = 500  # Số bản tin tối đa mỗi lần ghi gộp
+INGEST_GROUP_WAIT_MS = 50  # Thời gian tối đa chờ gom thêm bản tin
 
-@app.on_event("startup")
-@repeat_every(seconds=60 * 60 * 24)  # Chạy mỗi 24 giờ
-async def cleanup_old_data():
-    """Tự động dọn dẹp các cảnh báo VÀ telemetry cũ"""
+# --- Cấu hình lọc bản tin trùng (hub gửi lại khi hết thời gian chờ) ---
+DEDUPE_CACHE_SIZE = 50000  # Số khóa (hub, thời gian/seq) gần đây giữ lại
+DEDUPE_WARM_RECORDS = 100  # Số bản ghi gần nhất nạp khi gặp một hub mới
 
-    # 1. Dọn dẹp Alerts
-    logger.info("Đang chạy tác vụ dọn dẹp Alert...")
-    try:
-        all_alerts = db.get("alerts")
-        if not all_alerts:
-            logger.info("Không có Alert nào để dọn dẹp.")
-        else:
-            cutoff_date = datetime.now(
-                timezone.utc) - timedelta(days=ALERT_RETENTION_DAYS)
-            fresh_alerts = []
-            for alert in all_alerts:
-                created_at_str = alert.get("created_at")
-                if isinstance(created_at_str, str):
-                    try:
-                        alert_time = datetime.fromisoformat(created_at_str)
-                        if alert_time > cutoff_date:
-                            fresh_alerts.append(alert)
-                    except ValueError:
-                        fresh_alerts.append(alert)  # Giữ lại nếu không thể parse
-                else:
-                    fresh_alerts.append(alert)  # Giữ lại nếu định dạng lạ
+# Hub đã đăng ký nhưng chưa có telemetry được đọc lại DB sau chừng này giây
+# (dữ liệu có thể được ghi bởi tiến trình khác, vd. db_admin import)
+LATEST_MISS_TTL = 30
 
-            if len(fresh_alerts) < len(all_alerts):
-                db.overwrite_table("alerts", fresh_alerts)
-                logger.info(
-                    f"Đã dọn dẹp {len(all_alerts) - len(fresh_alerts)} "
-                    "alert cũ.")
-            else:
-                logger.info("Không có alert cũ nào cần dọn dẹp.")
-    except Exception as e:
-        logger.error(f"Lỗi khi dọn dẹp alert: {e}")
+# Storage engine tự xóa dần bản ghi quá hạn (xem db.expire_step)
+db.set_ttl("alerts", ALERT_RETENTION_DAYS * 24 * 3600)
+db.set_ttl("telemetry", TELEMETRY_RETENTION_DAYS * 24 * 3600)
 
-    # 2. Dọn dẹp Telemetry
-    logger.info("Đang chạy tác vụ dọn dẹp Telemetry...")
+
+@app.on_event("startup")
+@repeat_every(seconds=60)  # Chạy mỗi phút, mỗi lần vài lô nhỏ
+async def expire_old_data():
+    """Xóa dần các cảnh báo và telemetry đã quá hạn, từng lô nhỏ."""
+    removed = 0
     try:
-        all_telemetry = db.get("telemetry")
-        if not all_telemetry:
-            logger.info("Không có Telemetry nào để dọn dẹp.")
-            return
-
-        cutoff_date = datetime.now(
-            timezone.utc) - timedelta(days=TELEMETRY_RETENTION_DAYS)
-        fresh_telemetry = []
-        for record in all_telemetry:
-            timestamp_str = record.get("timestamp")
-            if isinstance(timestamp_str, str):
-                try:
-                    record_time = datetime.fromisoformat(timestamp_str)
-                    if record_time > cutoff_date:
-                        fresh_telemetry.append(record)
-                except ValueError:
-                    fresh_telemetry.append(record)  # Giữ lại nếu không thể parse
-            else:
-                fresh_telemetry.append(record)  # Giữ lại nếu định dạng lạ
+        while True:
+            # Mỗi lô chạy trong threadpool và nhả khóa ghi ngay sau đó, nên
+            # việc nhận dữ liệu mới không bị chặn
+            batch = await run_in_threadpool(db.expire_step)
+            removed += batch
+            if batch < db.EXPIRE_BATCH:
+                break
+    except Exception as e:
+        logger.error(f"Lỗi khi dọn dẹp dữ liệu quá hạn: {e}")
+    if removed:
+        latest_cache.drop_before((datetime.now(timezone.utc) - timedelta(
+            days=TELEMETRY_RETENTION_DAYS)).isoformat())
+        logger.info(f"Đã dọn dẹp {removed} bản ghi alert/telemetry quá hạn.")
 
-        if len(fresh_telemetry) < len(all_telemetry):
-            db.overwrite_table("telemetry", fresh_telemetry)
-            logger.info(
-                f"Đã dọn dẹp {len(all_telemetry) - len(fresh_telemetry)} "
-                "bản ghi telemetry cũ.")
-        else:
-            logger.info("Không có telemetry cũ nào cần dọn dẹp.")
 
+@app.on_event("startup")
+@repeat_every(seconds=60 * 60 * 24)  # Chạy mỗi 24 giờ
+async def prune_telemetry_store():
+    """Cắt bỏ phần quá hạn của kho telemetry dạng cột."""
+    if telemetry_store is None:
+        return
+    cutoff_date = datetime.now(
+        timezone.utc) - timedelta(days=TELEMETRY_RETENTION_DAYS)
+    try:
+        removed = await run_in_threadpool(telemetry_store.prune, cutoff_date)
+        if removed:
+            logger.info(f"Đã cắt {removed} dòng cũ khỏi kho telemetry.")
     except Exception as e:
-        logger.error(f"Lỗi khi dọn dẹp telemetry: {e}")
+        logger.error(f"Lỗi khi dọn dẹp kho telemetry: {e}")
 
 
 # --- Logic nghiệp vụ (Tách riêng) ---
@@ -387,54 +427,533 @@ def evaluate_alerts(payload: TelemetryPayload) -> List[AlertRecord]:
 # --- KẾT THÚC SỬA 1 ---
 
 
-def store_alert(alert: AlertRecord) -> None:
-    """Lưu alert vào database"""
-    db.add(
-        "alerts",
-        {
-            "hub_id": alert.hub_id,
-            "node_id": alert.node_id,
-            "message": alert.message,
-            "level": alert.level,
-            "created_at": alert.created_at.isoformat(),
-        },
-    )
+def serialize_alert(alert: AlertRecord) -> Dict[str, Any]:
+    """Chuẩn bị alert để lưu vào DB"""
+    return {
+        "hub_id": alert.hub_id,
+        "node_id": alert.node_id,
+        "message": alert.message,
+        "level": alert.level,
+        "created_at": alert.created_at.isoformat(),
+    }
+
+
+def serialize_timestamp(payload: TelemetryPayload) -> str:
+    """Thời gian của bản tin đúng như khi lưu vào DB"""
+    return payload.timestamp.replace(tzinfo=timezone.utc).isoformat()
 
 
 def serialize_payload(payload: TelemetryPayload) -> Dict[str, Any]:
     """Chuẩn bị payload để lưu vào DB"""
     body = payload.dict()
-    body["timestamp"] = payload.timestamp.replace(
-        tzinfo=timezone.utc).isoformat()
+    body["timestamp"] = serialize_timestamp(payload)
+    if body.get("seq") is None:
+        body.pop("seq", None)
     return body
 
 
-# --- ĐÃ SỬA: Bỏ giới hạn, chỉ thêm telemetry mới ---
-def process_telemetry(payload: TelemetryPayload):
+def store_telemetry(payloads: List[TelemetryPayload]) -> List[int]:
     """
-    Hàm này được chạy trong background task.
-    (ĐÃ SỬA: Bỏ giới hạn, chỉ thêm telemetry mới)
+    Lưu các bản tin telemetry cùng alerts suy ra từ chúng trong một giao
+    dịch: mỗi bảng chỉ khóa và ghi log một lần cho cả lô. Trả về số alerts
+    đã lưu của từng bản tin; lỗi được báo lại cho người gọi và khi đó không
+    bản ghi nào của lô được lưu.
     """
-    try:
-        # 1. Chuẩn bị bản ghi mới
-        new_record = serialize_payload(payload)
+    # 1. Chuẩn bị bản ghi mới và phân tích alerts trước khi ghi
+    records = [serialize_payload(payload) for payload in payloads]
+    alerts: List[Dict[str, Any]] = []
+    alert_counts: List[int] = []
+    for payload in payloads:
+        found = evaluate_alerts(payload)
+        alerts += [serialize_alert(alert) for alert in found]
+        alert_counts.append(len(found))
+
+    # 2. Ghi telemetry và alerts trong một giao dịch
+    with db.transaction("telemetry", "alerts"):
+        db.add_many("telemetry", records)
+        if alerts:
+            db.add_many("alerts", alerts)
+    latest_cache.update(records)
+
+    # 3. Ghi thêm vào kho dạng cột (phục vụ biểu đồ/phân tích);
+    # lỗi ở đây không ảnh hưởng bản ghi đã lưu
+    if telemetry_store is not None:
+        for record in records:
+            try:
+                telemetry_store.append(record)
+            except Exception as e:
+                logger.error(
+                    f"Lỗi khi ghi kho cột cho hub {record['hub_id']}: {e}")
+    return alert_counts
+
+
+class LatestCache:
+    """
+    Bản ghi telemetry mới nhất của mỗi hub và giá trị cảm biến mới nhất của
+    mỗi node, giữ trong bộ nhớ để ``/data/latest`` và ``/hub/status`` trả
+    lời trong O(1) mà không đọc bảng telemetry.
+
+    ``warm()`` nạp khi khởi động (mỗi hub một lần ``db.latest`` qua chỉ mục
+    có thứ tự); sau đó đường ghi gọi ``update()`` với các bản ghi vừa lưu.
+    ``latest()``/``nodes()`` chỉ đọc bộ nhớ; hub chưa có trong bộ nhớ
+    (``missing()``) được đọc từ DB bằng ``load()``, chạy trong threadpool
+    (xem ``load_latest``). Chỉ hub đã đăng ký mới được nhớ là "chưa có dữ
+    liệu", và chỉ trong ``LATEST_MISS_TTL`` giây, nên hub_id tùy ý trong
+    truy vấn không làm bộ nhớ đệm phình ra. Bản tin đến trễ (thời gian cũ
+    hơn) không thay bản ghi mới hơn.
+    """
+
+    def __init__(self, miss_ttl: float = LATEST_MISS_TTL):
+        self.miss_ttl = miss_ttl
+        self._lock = threading.Lock()
+        # {hub_id: bản ghi mới nhất}
+        self._records: Dict[str, Dict[str, Any]] = {}
+        # {hub_id: time.monotonic() lúc thấy hub đã đăng ký chưa có dữ liệu}
+        self._misses: Dict[str, float] = {}
+        # {hub_id: {node_id: {"timestamp": ..., "sensors": {...}}}}
+        self._nodes: Dict[str, Dict[str, Dict[str, Any]]] = {}
+
+    def warm(self) -> int:
+        """Nạp bản ghi mới nhất của các hub đã biết. Trả về số hub."""
+        hubs = {hub.get("hub_id") for hub in db.get("iot_hubs")}
+        hubs.discard(None)
+        self.load(hubs, registered=True)
+        newest = db.latest("telemetry")
+        if newest:
+            # Hub có dữ liệu mới nhất, để câu hỏi "mới nhất mọi hub" đúng
+            # cả khi hub đó chưa đăng ký
+            self.update([newest])
+        return len(hubs)
+
+    def latest(self, hub_id: Optional[str] = None
+               ) -> Optional[Dict[str, Any]]:
+        """Bản ghi mới nhất trong bộ nhớ của hub (hoặc của mọi hub)."""
+        with self._lock:
+            if hub_id is not None:
+                return self._records.get(hub_id)
+            records = list(self._records.values())
+        if not records:
+            return None
+        return max(records, key=lambda rec: rec["timestamp"])
+
+    def nodes(self, hub_id: str) -> Dict[str, Dict[str, Any]]:
+        """Giá trị mới nhất trong bộ nhớ của từng node của hub."""
+        with self._lock:
+            return dict(self._nodes.get(hub_id, {}))
+
+    def missing(self, hub_ids: List[str]) -> List[str]:
+        """Các hub cần ``load()`` trước khi đọc bộ nhớ."""
+        now = time.monotonic()
+        with self._lock:
+            return [hub_id for hub_id in hub_ids
+                    if hub_id not in self._records
+                    and now - self._misses.get(hub_id, -math.inf)
+                    >= self.miss_ttl]
+
+    def load(self, hub_ids: List[str], registered: bool = False):
+        """
+        Đọc bản ghi mới nhất của các hub từ DB (I/O đồng bộ, gọi trong
+        threadpool). Hub không có dữ liệu chỉ được nhớ nếu đã đăng ký
+        (``registered`` nếu người gọi đã biết chắc).
+        """
+        for hub_id in hub_ids:
+            record = db.latest("telemetry", hub_id)
+            if record is None and not registered:
+                registered_hub = db.count("iot_hubs", {"hub_id": hub_id}) > 0
+            else:
+                registered_hub = registered
+            with self._lock:
+                if record:
+                    self._misses.pop(hub_id, None)
+                    self._apply(record)
+                elif registered_hub and hub_id not in self._records:
+                    self._misses[hub_id] = time.monotonic()
+
+    def update(self, records: List[Dict[str, Any]]):
+        """Cập nhật theo các bản ghi vừa lưu vào DB."""
+        with self._lock:
+            for record in records:
+                self._apply(record)
+
+    def drop_before(self, cutoff: str):
+        """Bỏ các bản ghi đã bị xóa khỏi DB vì quá hạn (``< cutoff``)."""
+        with self._lock:
+            for hub_id, record in list(self._records.items()):
+                if record["timestamp"] < cutoff:
+                    del self._records[hub_id]
+                    self._nodes.pop(hub_id, None)
+
+    def _apply(self, record: Dict[str, Any]):
+        hub_id = record["hub_id"]
+        timestamp = record["timestamp"]
+        current = self._records.get(hub_id)
+        if current is None or current["timestamp"] <= timestamp:
+            self._records[hub_id] = record
+        nodes = self._nodes.setdefault(hub_id, {})
+        data = record.get("data") or {}
+        for node in (data.get("soil_nodes") or []) + [
+                data.get("atmospheric_node") or {}]:
+            node_id = node.get("node_id")
+            if node_id is None:
+                continue
+            seen = nodes.get(node_id)
+            if seen is None or seen["timestamp"] <= timestamp:
+                nodes[node_id] = {"timestamp": timestamp,
+                                  "sensors": node.get("sensors")}
+
+
+class DuplicateFilter:
+    """
+    Nhận diện bản tin trùng (hub gửi lại khi hết thời gian chờ) theo khóa
+    ``(hub_id, seq)`` nếu hub gửi ``seq``, nếu không thì ``(hub_id,
+    timestamp)``, để bản tin trùng không được lưu và không sinh alert lần
+    nữa.
+
+    Các khóa gần đây nằm trong một LRU có giới hạn. Với mỗi (hub, loại
+    khóa), ``_floors`` ghi ngưỡng mà mọi khóa lớn hơn nó đã có trong LRU
+    (nạp từ ``DEDUPE_WARM_RECORDS`` bản ghi cuối của hub ở lần đầu gặp
+    hub, sau đó nâng dần khi khóa cũ bị đẩy ra). Nhờ vậy bản tin mới chỉ
+    tốn O(1); chỉ bản tin cũ hơn ngưỡng (vd. dữ liệu đệm lâu ngày) mới được
+    kiểm tra lại trong DB qua chỉ mục.
+
+    ``claim()`` đánh dấu khóa ngay khi nhận để bản tin trùng đang chờ ghi
+    cũng bị loại; nếu việc ghi thất bại, ``forget()`` bỏ đánh dấu để hub
+    gửi lại được.
+    """
+
+    def __init__(self, maxsize: int = DEDUPE_CACHE_SIZE,
+                 warm_records: int = DEDUPE_WARM_RECORDS):
+        self.maxsize = maxsize
+        self.warm_records = warm_records
+        self._keys: "OrderedDict[Tuple[str, str, Any], None]" = OrderedDict()
+        # {(hub, loại khóa): ngưỡng}; None: LRU có mọi khóa của hub
+        self._floors: Dict[Tuple[str, str], Any] = {}
+        self._warmed: set = set()
+        self._lock = threading.Lock()
+        self._stats = {"duplicates": 0, "storage_checks": 0, "warmed": 0}
+
+    @staticmethod
+    def key(payload: TelemetryPayload) -> Tuple[str, str, Any]:
+        if payload.seq is not None:
+            return (payload.hub_id, "seq", payload.seq)
+        return (payload.hub_id, "ts", serialize_timestamp(payload))
+
+    def claim(self, payload: TelemetryPayload,
+              load: bool = True) -> Optional[bool]:
+        """
+        True nếu bản tin mới (khóa được đánh dấu), False nếu trùng. Với
+        ``load=False`` không truy cập DB mà trả về None khi cần đọc DB (hub
+        chưa nạp hoặc bản tin cũ hơn ngưỡng), để gọi lại trong threadpool.
+        """
+        key = self.key(payload)
+        hub, kind, value = key
+        with self._lock:
+            decided = self._check_cached(key)
+        if decided is None:
+            if not load:
+                return None
+            if hub not in self._warmed:
+                self._warm(hub)
+            with self._lock:
+                decided = self._check_cached(key)
+            if decided is None:
+                with self._lock:
+                    self._stats["storage_checks"] += 1
+                decided = not self._stored(hub, kind, value)
+        with self._lock:
+            if decided and key in self._keys:
+                # Một luồng khác vừa nhận cùng bản tin trong lúc đọc DB
+                decided = False
+            if decided:
+                self._remember(key)
+            else:
+                self._stats["duplicates"] += 1
+        return decided
+
+    def forget(self, payloads: List[TelemetryPayload]):
+        """Bỏ đánh dấu các bản tin chưa được lưu (ghi thất bại)."""
+        with self._lock:
+            for payload in payloads:
+                self._keys.pop(self.key(payload), None)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {**self._stats, "size": len(self._keys),
+                    "capacity": self.maxsize}
+
+    def _check_cached(self, key: Tuple[str, str, Any]) -> Optional[bool]:
+        if key in self._keys:
+            self._keys.move_to_end(key)
+            return False
+        hub, kind, value = key
+        if hub not in self._warmed:
+            return None
+        floor = self._floors.get((hub, kind))
+        if floor is not None and value <= floor:
+            return None
+        return True
+
+    def _remember(self, key: Tuple[str, str, Any]):
+        self._keys[key] = None
+        while len(self._keys) > self.maxsize:
+            (hub, kind, value), _ = self._keys.popitem(last=False)
+            floor = self._floors.get((hub, kind))
+            if floor is None or value > floor:
+                self._floors[(hub, kind)] = value
+
+    def _warm(self, hub: str):
+        """Nạp các bản ghi gần nhất của hub vào LRU (qua chỉ mục có thứ tự)."""
+        records = db.tail("telemetry", hub, self.warm_records)
+        with self._lock:
+            if hub in self._warmed:
+                return
+            seqs = [rec["seq"] for rec in records
+                    if isinstance(rec.get("seq"), int)]
+            if len(records) >= self.warm_records:
+                # Có thể còn bản ghi cũ hơn chưa nạp: bản tin từ ngưỡng trở
+                # xuống phải kiểm tra trong DB
+                self._floors[(hub, "ts")] = records[0].get("timestamp")
+                self._floors[(hub, "seq")] = min(seqs) if seqs else None
+            for rec in records:
+                if isinstance(rec.get("timestamp"), str):
+                    self._remember((hub, "ts", rec["timestamp"]))
+            for seq in seqs:
+                self._remember((hub, "seq", seq))
+            self._warmed.add(hub)
+            self._stats["warmed"] += 1
+
+    def _stored(self, hub: str, kind: str, value: Any) -> bool:
+        """
+        Khóa đã có trong DB chưa: thời gian tra qua chỉ mục có thứ tự
+        (hub_id, timestamp); ``seq`` chỉ có chỉ mục theo hub_id (tránh thêm
+        một mục chỉ mục cho mọi bản ghi) nên chỉ tra khi cũ hơn ngưỡng.
+        """
+        if kind == "seq":
+            return db.count("telemetry", {"hub_id": hub, "seq": value}) > 0
+        matches = db.query(
+            "telemetry", {"hub_id": hub,
+                          "timestamp": {"$gte": value, "$lte": value}},
+            fields=[], order_by="timestamp", limit=1)
+        return next(iter(matches), None) is not None
+
+
+class IngestQueue:
+    """
+    Hàng đợi có giới hạn cho các bản tin telemetry đã kiểm tra, được một
+    luồng ghi riêng lấy ra và lưu theo nhóm: mỗi lần ghi gộp mọi bản tin
+    đang chờ (tối đa khoảng ``group_max`` bản tin, chờ gom thêm tối đa
+    ``group_wait`` giây) qua ``store_telemetry`` trong một giao dịch.
+
+    Mỗi lần ``put()`` là một mục của hàng đợi: một bản tin (``/ingest``)
+    hoặc cả một lô (``/ingest/batch``), luôn được ghi trọn trong cùng một
+    nhóm; sức chứa ``maxsize`` tính theo số bản tin. ``put()`` trả về False
+    khi không đủ chỗ để API báo cho hub gửi lại sau (429 kèm Retry-After)
+    thay vì dồn việc và bộ nhớ không giới hạn. Sau ``stop()`` hàng đợi đóng
+    (``closed``, API trả về 503) cho tới lần ``start()`` sau.
+    """
+
+    def __init__(self, maxsize: int = INGEST_QUEUE_SIZE,
+                 group_max: int = INGEST_GROUP_MAX,
+                 group_wait: float = INGEST_GROUP_WAIT_MS / 1000):
+        self.maxsize = maxsize
+        self.group_max = group_max
+        self.group_wait = group_wait
+        # Mục: (các bản tin, Future nhận kết quả ghi hoặc None); None là
+        # tín hiệu dừng của stop()
+        self._queue: "queue.Queue[Optional[Tuple[list, Optional[Future]]]]" \
+            = queue.Queue()
+        self._depth = 0  # Số bản tin đang chờ trong hàng đợi
+        self._thread: Optional[threading.Thread] = None
+        self.closed = False
+        self._start_lock = threading.Lock()
+        self._stats_lock = threading.Lock()
+        self._stats = {
+            "enqueued": 0, "rejected": 0, "batches": 0, "groups": 0,
+            "stored": 0, "failed": 0, "alerts_created": 0,
+            "group_size_max": 0, "commit_time_total": 0.0,
+            "commit_time_max": 0.0, "commit_time_last": 0.0}
+
+    @property
+    def running(self) -> bool:
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self):
+        """Mở hàng đợi và khởi động luồng ghi (nếu chưa chạy)."""
+        with self._start_lock:
+            self.closed = False
+            if not self.running:
+                self._thread = threading.Thread(
+                    target=self._run, name="telemetry-writer", daemon=True)
+                self._thread.start()
+
+    def stop(self, timeout: Optional[float] = None):
+        """Đóng hàng đợi, ghi nốt các bản tin đang chờ rồi dừng luồng ghi."""
+        with self._start_lock:
+            self.closed = True
+        if self.running:
+            self._queue.put(None)
+            self._thread.join(timeout)
+
+    def put(self, payloads: List[TelemetryPayload],
+            done: Optional[Future] = None) -> bool:
+        """
+        Đưa các bản tin vào hàng đợi để ghi trong cùng một nhóm; False nếu
+        hàng đợi đã đóng hoặc không đủ chỗ (lô lớn hơn cả sức chứa vẫn được
+        nhận khi hàng đợi trống). ``done`` (nếu có) nhận số alerts của từng
+        bản tin sau khi ghi, hoặc lỗi ghi.
+        """
+        if not self.running and not self.closed:
+            # Luồng ghi chưa được startup khởi động (vd. khi chạy kiểm thử)
+            self.start()
+        with self._start_lock:
+            # Giữ khóa để stop() không chen tín hiệu dừng vào trước mục này
+            full = (self._depth > 0
+                    and self._depth + len(payloads) > self.maxsize)
+            if not self.closed and not full:
+                self._depth += len(payloads)
+                self._queue.put((payloads, done))
+                accepted = True
+            else:
+                accepted = False
+        with self._stats_lock:
+            if accepted:
+                self._stats["enqueued"] += len(payloads)
+                self._stats["batches"] += done is not None
+            else:
+                self._stats["rejected"] += len(payloads)
+        return accepted
+
+    def flush(self):
+        """Chờ tới khi mọi bản tin đã đưa vào được ghi xong."""
+        if self.running:
+            self._queue.join()
+
+    def retry_after(self) -> int:
+        """Số giây ước lượng để luồng ghi xử lý hết hàng đợi hiện tại."""
+        with self._stats_lock:
+            stored, total = (self._stats["stored"],
+                             self._stats["commit_time_total"])
+        per_item = total / stored if stored else 0.001
+        return max(1, math.ceil(self._depth * per_item))
+
+    def stats(self) -> Dict[str, Any]:
+        """Độ sâu hàng đợi, kích thước nhóm và thời gian ghi (giây)."""
+        with self._stats_lock:
+            stats = dict(self._stats)
+        groups = stats["groups"]
+        stats.update(
+            depth=self._depth, capacity=self.maxsize,
+            running=self.running,
+            group_size_avg=stats["stored"] / groups if groups else 0.0,
+            commit_time_avg=(stats["commit_time_total"] / groups
+                             if groups else 0.0))
+        return stats
+
+    def _take(self, item) -> int:
+        """Số bản tin của một mục vừa lấy khỏi hàng đợi."""
+        if item is None:
+            return 0
+        with self._start_lock:
+            self._depth -= len(item[0])
+        return len(item[0])
+
+    def _run(self):
+        while True:
+            first = self._queue.get()
+            group = [first]
+            size = self._take(first)
+            deadline = time.monotonic() + self.group_wait
+            while first is not None and size < self.group_max:
+                try:
+                    item = self._queue.get(
+                        timeout=max(0.0, deadline - time.monotonic()))
+                except queue.Empty:
+                    break
+                group.append(item)
+                size += self._take(item)
+                if item is None:
+                    break
+            entries = [item for item in group if item is not None]
+            if entries:
+                self._commit(entries)
+            for _ in group:
+                self._queue.task_done()
+            if len(entries) < len(group):
+                return
+
+    def _commit(self, entries: List[Tuple[List[TelemetryPayload],
+                                          Optional[Future]]]):
+        payloads = [payload for batch, _ in entries for payload in batch]
+        # Người gửi đã hủy chờ (vd. mất kết nối) thì vẫn ghi lô nhưng không
+        # báo kết quả; sau bước này Future không còn hủy được
+        waiting = [done is not None and done.set_running_or_notify_cancel()
+                   for _, done in entries]
+        started = time.perf_counter()
+        try:
+            alert_counts = store_telemetry(payloads)
+            error = None
+        except Exception as e:
+            logger.error(
+                f"Lỗi khi ghi nhóm {len(payloads)} bản tin telemetry: {e}")
+            duplicate_filter.forget(payloads)
+            alert_counts, error = [], e
+        elapsed = time.perf_counter() - started
+        with self._stats_lock:
+            stats = self._stats
+            stats["groups"] += 1
+            stats["stored"] += len(alert_counts)
+            stats["failed"] += len(payloads) - len(alert_counts)
+            stats["alerts_created"] += sum(alert_counts)
+            stats["group_size_max"] = max(stats["group_size_max"],
+                                          len(payloads))
+            stats["commit_time_total"] += elapsed
+            stats["commit_time_max"] = max(stats["commit_time_max"], elapsed)
+            stats["commit_time_last"] = elapsed
+        offset = 0
+        for (batch, done), notify in zip(entries, waiting):
+            if notify:
+                if error is not None:
+                    done.set_exception(error)
+                else:
+                    done.set_result(
+                        alert_counts[offset:offset + len(batch)])
+            offset += len(batch)
+
+
+latest_cache = LatestCache()
+duplicate_filter = DuplicateFilter()
+ingest_queue = IngestQueue()
+
+
+async def load_latest(hub_ids: List[str], registered: bool = False):
+    """Nạp các hub chưa có vào LatestCache, đọc DB trong threadpool."""
+    missing = latest_cache.missing(hub_ids)
+    if missing:
+        await run_in_threadpool(latest_cache.load, missing, registered)
+
 
-        # 2. Thêm thẳng bản ghi mới vào DB
-        # Không cần get_all, không cần overwrite_table để giới hạn
-        db.add("telemetry", new_record)
+async def claim_payload(payload: TelemetryPayload) -> bool:
+    """True nếu bản tin chưa từng nhận (xem DuplicateFilter.claim)."""
+    new = duplicate_filter.claim(payload, load=False)
+    if new is None:
+        new = await run_in_threadpool(duplicate_filter.claim, payload)
+    return new
 
-        # 3. Phân tích và lưu trữ alerts (như cũ)
-        alerts = evaluate_alerts(payload)
-        for alert in alerts:
-            store_alert(alert)
 
-        logger.info(
-            f"Đã xử lý xong telemetry cho hub {payload.hub_id} "
-            f"(thêm mới). Tạo {len(alerts)} alerts.")
+@app.on_event("startup")
+async def start_ingest_writer():
+    try:
+        hubs = await run_in_threadpool(latest_cache.warm)
+        logger.info(f"Đã nạp dữ liệu mới nhất của {hubs} hub vào bộ nhớ.")
     except Exception as e:
-        logger.error(
-            f"Lỗi background task khi xử lý hub {payload.hub_id}: {e}")
-# --- KẾT THÚC SỬA 2 ---
+        logger.error(f"Lỗi khi nạp dữ liệu mới nhất của các hub: {e}")
+    ingest_queue.start()
+
+
+@app.on_event("shutdown")
+async def stop_ingest_writer():
+    """Ghi nốt các bản tin đang chờ trước khi tắt."""
+    await run_in_threadpool(ingest_queue.stop, 30)
 
 
 # --- API Endpoints (Không thay đổi) ---
@@ -449,66 +968,189 @@ async def root():
             "version": "1.2.0",
             "endpoints": {
                 "data_ingest": "/api/v1/data/ingest",
+                "data_ingest_batch": "/api/v1/data/ingest/batch",
                 "data_latest": "/api/v1/data/latest",
                 "data_history": "/api/v1/data/history",
                 "alerts": "/api/v1/alerts",
                 "hub_register": "/api/v1/hub/register",
                 "sensor_register": "/api/v1/sensor/register",
-                "hub_status": "/api/v1/hub/status"
+                "hub_status": "/api/v1/hub/status",
+                "db_metrics": "/api/v1/metrics/db",
+                "ingest_metrics": "/api/v1/metrics/ingest"
             }
         }
     )
 
 
+def _queue_rejected() -> HTTPException:
+    """
+    Lỗi trả về khi hàng đợi ghi không nhận bản tin: 503 nếu máy chủ đang
+    tắt, ngược lại 429 (hàng đợi đầy); cả hai kèm Retry-After.
+    """
+    if ingest_queue.closed:
+        return HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail="Ingestion is shutting down, retry later",
+            headers={"Retry-After": "5"}
+        )
+    return HTTPException(
+        status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+        detail="Ingestion queue is full, retry later",
+        headers={"Retry-After": str(ingest_queue.retry_after())}
+    )
+
+
 @app.post("/api/v1/data/ingest", response_model=APIResponse)
 async def ingest_telemetry_data(
-    payload: TelemetryPayload,
-    background_tasks: BackgroundTasks
+    payload: TelemetryPayload
 ) -> APIResponse:
     """
     Tiếp nhận dữ liệu telemetry từ IoT hub.
-    Xử lý lưu trữ và phân tích trong nền.
+    Bản tin được đưa vào hàng đợi ghi và lưu theo nhóm trong nền; khi hàng
+    đợi đầy, trả về 429 kèm Retry-After để hub gửi lại sau.
     """
-    try:
-        # Thêm tác vụ vào hàng đợi và trả về ngay lập tức
-        background_tasks.add_task(process_telemetry, payload)
-
+    if ingest_queue.closed:
+        raise _queue_rejected()
+    if not await claim_payload(payload):
+        # Hub gửi lại bản tin đã nhận: báo thành công để hub không gửi nữa
         return APIResponse(
             status="success",
-            message="Data ingestion accepted. Processing in background.",
-            data={
-                "hub_id": payload.hub_id,
-                "received_at": datetime.now(timezone.utc).isoformat()
-            }
+            message="Duplicate reading ignored.",
+            data={"hub_id": payload.hub_id, "duplicate": True}
         )
-    except Exception as e:
-        # Lỗi này hiếm khi xảy ra, trừ khi payload không hợp lệ
+    if not ingest_queue.put([payload]):
+        duplicate_filter.forget([payload])
+        raise _queue_rejected()
+
+    return APIResponse(
+        status="success",
+        message="Data ingestion accepted. Processing in background.",
+        data={
+            "hub_id": payload.hub_id,
+            "received_at": datetime.now(timezone.utc).isoformat()
+        }
+    )
+
+
+def _validation_errors(error: ValidationError) -> List[Dict[str, Any]]:
+    """Lỗi kiểm tra dữ liệu dạng JSON được (bỏ ngữ cảnh chứa exception)."""
+    return [{"loc": list(err["loc"]), "msg": err["msg"], "type": err["type"]}
+            for err in error.errors()]
+
+
+@app.post("/api/v1/data/ingest/batch", response_model=APIResponse)
+async def ingest_telemetry_batch(
+    items: List[Any] = Body(..., description="Danh sách TelemetryPayload")
+) -> APIResponse:
+    """
+    Tiếp nhận một lô bản tin telemetry (vd. hub gửi lại dữ liệu đã đệm sau
+    khi mất kết nối). Mỗi phần tử được kiểm tra riêng; các phần tử hợp lệ
+    cùng alerts của chúng được lưu trong một lần ghi duy nhất, các phần tử
+    lỗi được báo lại theo vị trí (``index``) trong ``errors`` và các bản
+    tin đã nhận trước đó được bỏ qua (vị trí trong ``duplicates``).
+
+    Lô đi qua cùng hàng đợi ghi với ``/ingest`` (một mục, ghi trọn trong
+    một nhóm) và yêu cầu chờ tới khi lô được ghi: hàng đợi không đủ chỗ trả
+    về 429, máy chủ đang tắt trả về 503, cả hai kèm Retry-After.
+    """
+    if ingest_queue.closed:
+        raise _queue_rejected()
+    if len(items) > MAX_BATCH_ITEMS:
         raise HTTPException(
-            status_code=status.HTTP_400_BAD_REQUEST,
-            detail=f"Failed to queue data ingestion: {str(e)}"
+            status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+            detail=f"Batch too large: {len(items)} items "
+            f"(max {MAX_BATCH_ITEMS})"
+        )
+
+    valid: List[Tuple[int, TelemetryPayload]] = []
+    errors: List[Dict[str, Any]] = []
+    for index, item in enumerate(items):
+        try:
+            valid.append((index, TelemetryPayload.model_validate(item)))
+        except ValidationError as e:
+            errors.append({"index": index, "errors": _validation_errors(e)})
+
+    if not valid:
+        raise HTTPException(
+            status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
+            detail={"message": "No valid telemetry items in batch",
+                    "errors": errors}
         )
 
+    payloads: List[TelemetryPayload] = []
+    duplicates: List[int] = []
+    for index, payload in valid:
+        if await claim_payload(payload):
+            payloads.append(payload)
+        else:
+            duplicates.append(index)
+
+    alert_counts: List[int] = []
+    if payloads:
+        done: Future = Future()
+        if not ingest_queue.put(payloads, done):
+            duplicate_filter.forget(payloads)
+            raise _queue_rejected()
+        try:
+            # Luồng ghi đã bỏ đánh dấu trùng của lô nếu ghi lỗi
+            alert_counts = await asyncio.wrap_future(done)
+        except Exception as e:
+            raise HTTPException(
+                status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+                detail=f"Failed to store telemetry batch: {str(e)}"
+            )
+    stored, alert_count = len(alert_counts), sum(alert_counts)
+
+    logger.info(
+        f"Đã lưu lô {stored} bản tin telemetry ({len(errors)} lỗi, "
+        f"{len(duplicates)} trùng), tạo {alert_count} alerts.")
+    return APIResponse(
+        status="partial" if errors else "success",
+        message=f"Stored {stored} of {len(items)} telemetry items",
+        data={
+            "accepted": stored,
+            "rejected": len(errors),
+            "duplicates": duplicates,
+            "alerts_created": alert_count,
+            "errors": errors,
+            "received_at": datetime.now(timezone.utc).isoformat()
+        }
+    )
+
 
 @app.get("/api/v1/data/latest", response_model=APIResponse)
 async def get_latest_data(
-    hub_id: Optional[str] = None
+    hub_id: Optional[str] = None,
+    node_id: Optional[str] = None
 ) -> APIResponse:
-    """Lấy dữ liệu telemetry mới nhất (tối ưu hóa)"""
+    """
+    Lấy dữ liệu telemetry mới nhất từ bộ nhớ đệm (không đọc DB); với
+    ``node_id``: giá trị cảm biến mới nhất của node đó.
+    """
     try:
-        # Tối ưu: Lọc ở phía DB
-        query = {"hub_id": hub_id} if hub_id else {}
-        records = db.get("telemetry", query)
+        if hub_id:
+            await load_latest([hub_id])
+        if hub_id and node_id:
+            node = latest_cache.nodes(hub_id).get(node_id)
+            if not node:
+                raise HTTPException(
+                    status_code=status.HTTP_404_NOT_FOUND,
+                    detail="No telemetry data available for this node"
+                )
+            return APIResponse(
+                status="success",
+                message="Latest node data retrieved successfully",
+                data={"hub_id": hub_id, "node_id": node_id, **node}
+            )
 
-        if not records:
+        latest_record = latest_cache.latest(hub_id or None)
+
+        if not latest_record:
             raise HTTPException(
                 status_code=status.HTTP_404_NOT_FOUND,
                 detail="No telemetry data available for this query"
             )
 
-        # Sắp xếp bằng Python (Nên tối ưu ở DB nếu có thể)
-        records.sort(key=lambda item: item.get("timestamp", ""), reverse=True)
-        latest_record = records[0]
-
         return APIResponse(
             status="success",
             message="Latest data retrieved successfully",
@@ -523,31 +1165,98 @@ async def get_latest_data(
         )
 
 
+def _stored_time(value: datetime) -> str:
+    """Thời điểm ở dạng chuỗi ISO UTC như khi lưu vào DB (để so sánh)."""
+    if value.tzinfo is not None:
+        value = value.astimezone(timezone.utc)
+    return value.replace(tzinfo=timezone.utc).isoformat()
+
+
+def _encode_cursor(record: Dict[str, Any], field: str) -> str:
+    """Con trỏ trang sau: vị trí (thời gian, id) của bản ghi cuối trang."""
+    raw = json.dumps([record.get(field), record.get("id")])
+    return base64.urlsafe_b64encode(raw.encode("utf-8")).decode("ascii")
+
+
+def _decode_cursor(cursor: str) -> Tuple[Optional[str], str]:
+    """Vị trí (thời gian, id) trong con trỏ; sai định dạng thì trả 400."""
+    try:
+        value, record_id = json.loads(base64.urlsafe_b64decode(
+            cursor.encode("ascii")))
+        # Con trỏ do client gửi lên: chỉ nhận đúng kiểu _encode_cursor tạo ra
+        if not (isinstance(value, (str, type(None)))
+                and isinstance(record_id, str)):
+            raise TypeError("cursor fields must be strings")
+    except (ValueError, TypeError, UnicodeError) as exc:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="Invalid cursor"
+        ) from exc
+    return value, record_id
+
+
+def query_page(table: str, filter_dict: Dict[str, Any], time_field: str,
+               limit: int, since: Optional[datetime],
+               until: Optional[datetime], cursor: Optional[str],
+               count: bool) -> Dict[str, Any]:
+    """
+    Một trang bản ghi mới nhất trước theo ``time_field``, trong khoảng
+    ``since <= thời gian < until``, bắt đầu sau ``cursor``. Truy vấn đi qua
+    chỉ mục có thứ tự (hub_id, thời gian) nên chi phí tỉ lệ với cỡ trang
+    chứ không với lượng lịch sử; ``count=False`` bỏ qua việc đếm tổng.
+    """
+    query = dict(filter_dict)
+    bounds = {}
+    if since is not None:
+        bounds["$gte"] = _stored_time(since)
+    if until is not None:
+        bounds["$lt"] = _stored_time(until)
+    if bounds:
+        query[time_field] = bounds
+    after = _decode_cursor(cursor) if cursor else None
+
+    # Lấy thêm một bản ghi để biết còn trang sau hay không
+    records = list(db.query(table, query, order_by=f"-{time_field}",
+                            limit=limit + 1, after=after))
+    items = records[:limit]
+    data = {
+        "items": items,
+        "returned_count": len(items),
+        "next_cursor": (_encode_cursor(items[-1], time_field)
+                        if len(records) > limit else None)
+    }
+    if count:
+        data["total_count"] = db.count(table, query)
+    return data
+
+
 @app.get("/api/v1/data/history", response_model=APIResponse)
 async def get_data_history(
     hub_id: Optional[str] = None,
-    limit: int = 50
+    limit: int = Query(50, ge=1, le=1000),
+    since: Optional[datetime] = None,
+    until: Optional[datetime] = None,
+    cursor: Optional[str] = None,
+    count: bool = True
 ) -> APIResponse:
-    """Lấy lịch sử telemetry (tối ưu hóa)"""
+    """
+    Lấy lịch sử telemetry, mới nhất trước. ``since``/``until`` giới hạn
+    khoảng thời gian; trang sau lấy bằng ``cursor=next_cursor`` của trang
+    trước; ``count=false`` bỏ ``total_count``.
+    """
     try:
-        # Tối ưu: Lọc ở phía DB
         query = {"hub_id": hub_id} if hub_id else {}
-        records = db.get("telemetry", query)
-
-        # Sắp xếp và giới hạn (Nên tối ưu ở DB nếu có thể)
-        records.sort(key=lambda item: item.get("timestamp", ""), reverse=True)
-        total_count = len(records)
-        limited_records = records[:limit]
+        data = await run_in_threadpool(
+            query_page, "telemetry", query, "timestamp", limit, since,
+            until, cursor, count)
 
         return APIResponse(
             status="success",
-            message=f"Retrieved {len(limited_records)} historical records",
-            data={
-                "items": limited_records,
-                "total_count": total_count,
-                "returned_count": len(limited_records)
-            }
+            message=f"Retrieved {data['returned_count']} historical records",
+            data=data
         )
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
@@ -558,34 +1267,34 @@ async def get_data_history(
 @app.get("/api/v1/alerts", response_model=APIResponse)
 async def get_alerts(
     hub_id: Optional[str] = None,
-    limit: int = 50,
-    level: Optional[str] = None
+    limit: int = Query(50, ge=1, le=1000),
+    level: Optional[str] = None,
+    since: Optional[datetime] = None,
+    until: Optional[datetime] = None,
+    cursor: Optional[str] = None,
+    count: bool = True
 ) -> APIResponse:
-    """Lấy alerts (tối ưu hóa)"""
+    """
+    Lấy alerts, mới nhất trước (cùng tham số phân trang như
+    ``/data/history``, theo ``created_at``).
+    """
     try:
-        # Tối ưu: Xây dựng bộ lọc và truy vấn 1 lần
         query = {}
         if hub_id:
             query["hub_id"] = hub_id
         if level:
             query["level"] = level
-
-        records = db.get("alerts", query)
-
-        # Sắp xếp và giới hạn (Nên tối ưu ở DB nếu có thể)
-        records.sort(key=lambda item: item.get("created_at", ""), reverse=True)
-        total_count = len(records)
-        limited_records = records[:limit]
+        data = await run_in_threadpool(
+            query_page, "alerts", query, "created_at", limit, since,
+            until, cursor, count)
 
         return APIResponse(
             status="success",
-            message=f"Retrieved {len(limited_records)} alerts",
-            data={
-                "items": limited_records,
-                "total_count": total_count,
-                "returned_count": len(limited_records)
-            }
+            message=f"Retrieved {data['returned_count']} alerts",
+            data=data
         )
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
@@ -681,35 +1390,33 @@ async def get_hub_status(
         # Lọc trước khi lấy
         hub_query = {"hub_id": hub_id} if hub_id else {}
         sensor_query = {"hub_id": hub_id} if hub_id else {}
-        telemetry_query = {"hub_id": hub_id} if hub_id else {}
 
         hubs = db.get("iot_hubs", hub_query)
         sensors = db.get("sensors", sensor_query)
-        telemetry = db.get("telemetry", telemetry_query)
 
         # Nhóm theo hub_id để tăng tốc
         sensors_by_hub = {}
         for s in sensors:
             sensors_by_hub.setdefault(s.get("hub_id"), []).append(s)
 
-        latest_telemetry_by_hub = {}
-        telemetry.sort(key=lambda x: x.get("timestamp", ""), reverse=True)
-        for t in telemetry:
-            h_id = t.get("hub_id")
-            if h_id not in latest_telemetry_by_hub:
-                latest_telemetry_by_hub[h_id] = t
+        # Hub chưa có trong bộ nhớ đệm được đọc DB trong threadpool
+        await load_latest([hub.get("hub_id") for hub in hubs
+                           if hub.get("hub_id") is not None],
+                          registered=True)
 
         hub_status = []
         for hub in hubs:
             hub_id_key = hub.get("hub_id")
             hub_sensors = sensors_by_hub.get(hub_id_key, [])
-            latest_telemetry = latest_telemetry_by_hub.get(hub_id_key)
+            # Bản ghi mới nhất lấy từ bộ nhớ đệm, không đọc bảng telemetry
+            latest_telemetry = latest_cache.latest(hub_id_key)
 
             hub_status.append({
                 "hub": hub,
                 "sensors": hub_sensors,
                 "sensor_count": len(hub_sensors),
                 "latest_telemetry": latest_telemetry,
+                "latest_nodes": latest_cache.nodes(hub_id_key),
                 "last_data_time": latest_telemetry.get("timestamp")
                 if latest_telemetry else None
             })
@@ -725,6 +1432,45 @@ async def get_hub_status(
             detail=f"Failed to retrieve hub status: {str(e)}"
         )
 
+
+@app.get("/api/v1/metrics/db", response_model=APIResponse)
+async def get_db_metrics():
+    """
+    Số liệu đo CSDL của tiến trình API: thời gian/số lần/số bản ghi duyệt
+    theo bảng và thao tác, I/O theo bảng và thời gian chờ khóa.
+    """
+    try:
+        return APIResponse(
+            status="success",
+            message="Database metrics since start or last reset",
+            data=await run_in_threadpool(db.stats)
+        )
+    except Exception as e:
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail=f"Failed to retrieve database metrics: {str(e)}"
+        )
+
+
+@app.get("/api/v1/metrics/ingest", response_model=APIResponse)
+async def get_ingest_metrics():
+    """
+    Số liệu của hàng đợi ghi telemetry: độ sâu hiện tại, số bản tin nhận/
+    từ chối/đã lưu, kích thước nhóm và thời gian mỗi lần ghi gộp (giây).
+    """
+    return APIResponse(
+        status="success",
+        message="Ingestion queue metrics",
+        data={**ingest_queue.stats(), "dedupe": duplicate_filter.stats()}
+    )
+
+
+@app.post("/api/v1/metrics/db/reset", response_model=APIResponse)
+async def reset_db_metrics():
+    """Xóa số liệu đo CSDL của tiến trình API."""
+    await run_in_threadpool(db.reset_stats)
+    return APIResponse(status="success", message="Database metrics reset")
+
 # Health check endpoint
 
 
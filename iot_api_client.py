@@ -90,13 +90,31 @@ class ApiClient:
             return response_data.get("data")
         return None
 
+    @staticmethod
+    def _page_params(params: Dict[str, Any], since: Optional[str],
+                     until: Optional[str], cursor: Optional[str],
+                     count: bool) -> Dict[str, Any]:
+        """Thêm tham số khoảng thời gian/phân trang (chỉ khi có)."""
+        extra = {"since": since, "until": until, "cursor": cursor}
+        params.update({k: v for k, v in extra.items() if v is not None})
+        if not count:
+            params["count"] = "false"
+        return params
+
     def get_data_history(
             self,
             hub_id: str,
-            limit: int = 50) -> Optional[Dict[str,
-                                              Any]]:
-        """Lấy lịch sử telemetry."""
-        params = {"hub_id": hub_id, "limit": limit}
+            limit: int = 50,
+            since: Optional[str] = None,
+            until: Optional[str] = None,
+            cursor: Optional[str] = None,
+            count: bool = True) -> Optional[Dict[str, Any]]:
+        """
+        Lấy lịch sử telemetry, mới nhất trước. Trang sau: truyền
+        ``cursor=data["next_cursor"]`` của trang trước.
+        """
+        params = self._page_params({"hub_id": hub_id, "limit": limit},
+                                   since, until, cursor, count)
         response_data = self._get("/api/v1/data/history", params=params)
         if response_data and response_data.get("status") == "success":
             return response_data.get("data")
@@ -105,15 +123,39 @@ class ApiClient:
     def get_alerts(
             self,
             hub_id: str,
-            limit: int = 50) -> Optional[Dict[str,
-                                              Any]]:
-        """Lấy các cảnh báo."""
-        params = {"hub_id": hub_id, "limit": limit}
+            limit: int = 50,
+            since: Optional[str] = None,
+            until: Optional[str] = None,
+            cursor: Optional[str] = None,
+            count: bool = True) -> Optional[Dict[str, Any]]:
+        """Lấy các cảnh báo (phân trang như ``get_data_history``)."""
+        params = self._page_params({"hub_id": hub_id, "limit": limit},
+                                   since, until, cursor, count)
         response_data = self._get("/api/v1/alerts", params=params)
         if response_data and response_data.get("status") == "success":
             return response_data.get("data")
         return None
 
+    def get_db_metrics(self) -> Optional[Dict[str, Any]]:
+        """Lấy số liệu đo CSDL của tiến trình API."""
+        response_data = self._get("/api/v1/metrics/db")
+        if response_data and response_data.get("status") == "success":
+            return response_data.get("data")
+        return None
+
+    def get_ingest_metrics(self) -> Optional[Dict[str, Any]]:
+        """Lấy số liệu hàng đợi ghi telemetry của API."""
+        response_data = self._get("/api/v1/metrics/ingest")
+        if response_data and response_data.get("status") == "success":
+            return response_data.get("data")
+        return None
+
+    def reset_db_metrics(self) -> bool:
+        """Xóa số liệu đo CSDL của tiến trình API."""
+        response_data = self._post("/api/v1/metrics/db/reset", data={})
+        return bool(response_data) and response_data.get(
+            "status") == "success"
+
 
 _client_instance: Optional[ApiClient] = None
 
@@ -25,20 +25,11 @@ def get_latest_telemetry_stats(
         logger.warning(f"Không tìm thấy hub cho field {field_id}")
         return None
 
-    telemetry_data = db.get("telemetry", {"hub_id": hub_id})
-    if not telemetry_data:
+    latest_entry = db.latest("telemetry", hub_id)
+    if not latest_entry:
         logger.warning(f"Không tìm thấy telemetry cho hub {hub_id}")
         return None
 
-    try:
-        latest_entry = sorted(
-            telemetry_data,
-            key=lambda x: x.get('timestamp', '1970-01-01T00:00:00+00:00'),
-            reverse=True
-        )[0]
-    except IndexError:
-        return None
-
     data = latest_entry.get("data", {})
     stats = {
         "avg_moisture": None,
@@ -172,9 +163,7 @@ def render_chat():
     if "messages" not in st.session_state:
         st.session_state.messages = []
 
-    user_fields = db.get(
-        "fields", {
-            "user_email": st.user.email}) if hasattr(
+    user_fields = db.fields_by_user(st.user.email) if hasattr(
         st, 'user') and st.user.email else []
     fields = user_fields if user_fields else st.session_state.get(
         'fields', [])
@@ -6,6 +6,7 @@ import pandas as pd
 import altair as alt
 import logging
 from database import db
+from telemetry_store import telemetry_store
 from utils import check_warnings, calculate_days_to_harvest, get_latest_telemetry_stats
 from datetime import datetime
 import toml
@@ -36,23 +37,48 @@ def load_dashboard_data(user_email: str):
     try:
         user_hubs = db.get("iot_hubs", {"user_email": user_email})
         user_hub_ids = [h['hub_id'] for h in user_hubs]
-        user_fields = db.get("fields", {"user_email": user_email})
-        all_telemetry = db.get("telemetry")
-        all_alerts = db.get("alerts")
-
-        user_history = sorted(
-            [t for t in all_telemetry if t.get('hub_id') in user_hub_ids],
-            key=lambda x: x.get('timestamp', '1970-01-01T00:00:00+00:00')
-        )
-
-        user_alerts = [a for a in all_alerts if a.get(
-            'hub_id') in user_hub_ids]
+        user_fields = db.fields_by_user(user_email)
+
+        # Chỉ đọc telemetry/alert của các hub thuộc user, đã sắp theo thời
+        # gian bởi chỉ mục của DB, và chỉ lấy các trường dashboard dùng tới.
+        # Hai bản tin mới nhất đủ cho chỉ số hiện tại và độ thay đổi.
+        hub_filter = {"hub_id": {"$in": user_hub_ids}}
+        user_history = list(db.query(
+            "telemetry", hub_filter,
+            fields=["hub_id", "timestamp", "data"],
+            order_by="-timestamp", limit=2))[::-1]
+
+        user_alerts = list(db.query(
+            "alerts", hub_filter,
+            fields=["created_at", "level", "message", "hub_id", "node_id"],
+            order_by="created_at"))
         latest_telemetry = user_history[-1] if user_history else {}
+        trend_df = load_trend_frame(user_hub_ids)
 
-        return latest_telemetry, user_history, user_alerts, user_fields
+        return (latest_telemetry, user_history, trend_df, user_alerts,
+                user_fields)
     except Exception as e:
         logger.error(f"Lỗi khi tải dữ liệu dashboard: {e}")
-        return {}, [], [], []
+        return {}, [], pd.DataFrame(), [], []
+
+
+def load_trend_frame(hub_ids):
+    """
+    Dữ liệu xu hướng môi trường (dạng dài: timestamp, Sensor, Value) của các
+    hub, đọc thẳng từ kho telemetry dạng cột.
+    """
+    frames = [telemetry_store.frame(hub_id, {
+        "Nhiệt độ không khí": "atmospheric.air_temperature",
+        "Độ ẩm không khí": "atmospheric.air_humidity",
+        "Độ ẩm đất (TB)": "soil.*.soil_moisture",
+    }) for hub_id in hub_ids]
+    frames = [df for df in frames if not df.empty]
+    if not frames:
+        return pd.DataFrame()
+    return (pd.concat(frames, ignore_index=True)
+            .melt(id_vars="timestamp", var_name="Sensor", value_name="Value")
+            .dropna(subset=["Value"])
+            .astype({"Value": "float64"}))
 
 
 def average_soil(entry):
@@ -82,7 +108,8 @@ def render_dashboard():
         st.warning("⚠️ Vui lòng đăng nhập để xem Dashboard.")
         return
 
-    telemetry, history, alerts, fields = load_dashboard_data(st.user.email)
+    telemetry, history, trend_df, alerts, fields = load_dashboard_data(
+        st.user.email)
 
     if not fields and not history:
         st.info(
@@ -438,38 +465,9 @@ def render_dashboard():
 
     with st.container(border=True):
         st.subheader("📈 Xu hướng môi trường")
-        history_records = []
-
-        for entry in history:
-            timestamp = entry.get("timestamp")
-            if entry.get(
-                "data",
-                {}).get(
-                "atmospheric_node",
-                {}).get(
-                "sensors",
-                    {}):
-                atm_sensors = entry["data"]["atmospheric_node"]["sensors"]
-                history_records.append({"timestamp": timestamp,
-                                        "Sensor": "Nhiệt độ không khí",
-                                        "Value": atm_sensors.get("air_temperature")})
-                history_records.append({"timestamp": timestamp,
-                                        "Sensor": "Độ ẩm không khí",
-                                        "Value": atm_sensors.get("air_humidity")})
-
-            avg_moisture = average_soil(entry)
-            if avg_moisture is not None:
-                history_records.append(
-                    {"timestamp": timestamp,
-                     "Sensor": "Độ ẩm đất (TB)",
-                     "Value": avg_moisture})
-
-        if history_records:
-            history_df = pd.DataFrame(history_records).dropna()
-            history_df["timestamp"] = pd.to_datetime(history_df["timestamp"])
-
+        if not trend_df.empty:
             line_chart = (
-                alt.Chart(history_df)
+                alt.Chart(trend_df)
                 .mark_line(point=True)
                 .encode(
                     x="timestamp:T",
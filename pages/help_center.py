@@ -37,9 +37,7 @@ def render_ai_assistant():
         "Hỏi tôi bất cứ điều gì về TerraSync IoT, nông nghiệp hoặc các câu "
         "hỏi kỹ thuật!")
 
-    user_fields = db.get(
-        "fields", {
-            "user_email": st.user.email}) if hasattr(
+    user_fields = db.fields_by_user(st.user.email) if hasattr(
         st, 'user') and st.user.is_logged_in else []
     user_hubs = db.get(
         "iot_hubs", {
@@ -419,7 +417,7 @@ def render_troubleshooting():
                 st.warning("⚠️ API Gemini: Chưa được định cấu hình")
 
             if hasattr(st, 'user') and st.user.is_logged_in:
-                user_fields = db.get("fields", {"user_email": st.user.email})
+                user_fields = db.fields_by_user(st.user.email)
                 st.success(
                     f"✅ Dữ liệu người dùng: Tìm thấy {len(user_fields)} vườn")
             else:
@@ -4,6 +4,7 @@ import random
 from datetime import datetime, timedelta, timezone
 from typing import Dict, List, Any, Optional
 from database import db
+from telemetry_store import telemetry_store
 from iot_api_client import get_iot_client, test_iot_connection
 
 try:
@@ -71,7 +72,7 @@ def edit_hub_dialog(hub_id: str):
     description_edit = st.text_area("Mô tả", value=current_hub.get('description', ''), height=100)
     
     try:
-        user_fields = db.get("fields", {"user_email": st.user.email})
+        user_fields = db.fields_by_user(st.user.email)
         field_options = {field['id']: field['name'] for field in user_fields if 'id' in field and 'name' in field}
         if not field_options:
             st.warning("Không có vườn nào. Vui lòng tạo vườn trước.")
@@ -173,7 +174,7 @@ def render_hub_management():
         hub_name = st.text_input("Tên Hub (Tùy chọn)", placeholder="ví dụ: Hub chính")
 
         try:
-            user_fields = db.get("fields", {"user_email": st.user.email})
+            user_fields = db.fields_by_user(st.user.email)
             if not user_fields:
                 st.warning("Bạn cần tạo một vườn trước khi thêm hub.")
                 return
@@ -321,15 +322,13 @@ def render_sensor_management():
             
             atm_node = telemetry_data.get('atmospheric_node')
             if isinstance(atm_node, dict):
-                atm_node['sensor_type'] = 'atmospheric'
-                sensors_from_telemetry.append(atm_node)
+                sensors_from_telemetry.append({**atm_node, 'sensor_type': 'atmospheric'})
                 
             soil_nodes = telemetry_data.get('soil_nodes', [])
             if isinstance(soil_nodes, list):
                 for node in soil_nodes:
                     if isinstance(node, dict):
-                        node['sensor_type'] = 'soil'
-                        sensors_from_telemetry.append(node)
+                        sensors_from_telemetry.append({**node, 'sensor_type': 'soil'})
         
         total_sensors = len(sensors_from_telemetry)
         
@@ -380,18 +379,21 @@ def render_sensor_management():
                     st.markdown("🟢 **Online**")
                     st.caption(f"Lần cuối thấy: {last_seen_time}")
 
+@st.fragment(run_every=2)
+def watch_realtime_changes():
+    """Chạy lại trang ngay khi có telemetry mới (chỉ so phiên bản bảng, không đọc dữ liệu)."""
+    versions = db.versions("telemetry")
+    if st.session_state.setdefault("realtime_versions", versions) != versions:
+        st.session_state.realtime_versions = versions
+        st.rerun()
+
 def render_realtime_data():
     st.subheader("📊 Dữ liệu IoT thời gian thực")
     
-    auto_refresh = st.checkbox("🔄 Tự động làm mới (30s)", value=True)
+    auto_refresh = st.checkbox("🔄 Tự động làm mới khi có dữ liệu mới", value=True)
     
     if auto_refresh:
-        if "last_refresh" not in st.session_state:
-            st.session_state.last_refresh = datetime.now()
-        
-        if (datetime.now() - st.session_state.last_refresh).total_seconds() > 30:
-            st.session_state.last_refresh = datetime.now()
-            st.rerun()
+        watch_realtime_changes()
     
     user_hubs_data = get_user_hub_data(st.user.email)
     if not user_hubs_data:
@@ -463,44 +465,15 @@ def render_realtime_data():
                     st.info("Không có dữ liệu cảm biến khí quyển.")
 
             st.subheader("📈 Xu hướng dữ liệu")
-            history_data = client.get_data_history(selected_hub_id, limit=24) 
-
-            if history_data and history_data.get('items') and isinstance(history_data['items'], list):
-                
-                df = pd.DataFrame(history_data['items'])
-                if 'timestamp' in df.columns:
-                    df['timestamp'] = pd.to_datetime(df['timestamp'], errors='coerce')
-                
-                def extract_soil_moisture(d):
-                    if isinstance(d, dict) and 'soil_nodes' in d and d['soil_nodes']:
-                        nodes = d['soil_nodes']
-                        if isinstance(nodes, list) and len(nodes) > 0:
-                            first_node = nodes[0]
-                            if isinstance(first_node, dict) and 'sensors' in first_node:
-                                return first_node['sensors'].get('soil_moisture')
-                    return None
-                
-                def extract_atm_temp(d):
-                    if isinstance(d, dict) and 'atmospheric_node' in d:
-                        atm = d['atmospheric_node']
-                        if isinstance(atm, dict) and 'sensors' in atm:
-                            return atm['sensors'].get('air_temperature')
-                    return None
-                
-                def extract_atm_hum(d):
-                    if isinstance(d, dict) and 'atmospheric_node' in d:
-                        atm = d['atmospheric_node']
-                        if isinstance(atm, dict) and 'sensors' in atm:
-                            return atm['sensors'].get('air_humidity')
-                    return None
-                
-                df['soil_moisture'] = df['data'].apply(extract_soil_moisture)
-                df['air_temperature'] = df['data'].apply(extract_atm_temp)
-                df['air_humidity'] = df['data'].apply(extract_atm_hum)
-                
-                df = df.dropna(subset=['timestamp']).sort_values('timestamp')
+            # 24 bản tin gần nhất, đọc thẳng từ kho telemetry dạng cột
+            df = telemetry_store.frame(selected_hub_id, {
+                'soil_moisture': 'soil.*.soil_moisture',
+                'air_temperature': 'atmospheric.air_temperature',
+                'air_humidity': 'atmospheric.air_humidity',
+            }, last=24)
 
-                if len(df) > 0:
+            if not df.empty:
+                if len(df.columns) > 1:
                     fig = make_subplots(rows=3, cols=1, subplot_titles=('Độ ẩm đất (%)', 'Nhiệt độ không khí (°C)', 'Độ ẩm không khí (%)'), vertical_spacing=0.1, shared_xaxes=True)
                     
                     if 'soil_moisture' in df and not df['soil_moisture'].isna().all():
@@ -18,15 +18,11 @@ def get_nodes_from_telemetry(hub_id):
     Trả về dict: { 'node_id': {'type': '...', 'variables': [...]} }
     """
     try:
-        # Lấy telemetry của hub
-        telemetry_list = db.get("telemetry", {"hub_id": hub_id})
+        # Lấy bản ghi mới nhất của hub từ chỉ mục (hub_id, timestamp)
+        latest = db.latest("telemetry", hub_id)
         
-        if not telemetry_list:
+        if not latest:
             return {}
-            
-        # Sắp xếp lấy bản ghi mới nhất
-        # Giả sử format timestamp chuẩn ISO, sort string OK
-        latest = sorted(telemetry_list, key=lambda x: x.get('timestamp', ''), reverse=True)[0]
         
         data = latest.get('data', {})
         nodes = {}
@@ -49,7 +49,7 @@ def render_progress(value):
 
 
 def get_field_data(user_email: str):
-    user_fields = db.get("fields", {"user_email": user_email})
+    user_fields = db.fields_by_user(user_email)
     fields = user_fields if user_fields else []
 
     hydration_jobs = {'completed': 0, 'active': 0, 'remaining': 0}
@@ -75,7 +75,7 @@ def get_available_crops() -> list[str]:
 
 
 def run_field_update(user_email: str):
-    fields = db.get("fields", {"user_email": user_email})
+    fields = db.fields_by_user(user_email)
     if not fields:
         return 0
 
@@ -253,7 +253,7 @@ def render_fields():
     fields, hydration_jobs = get_field_data(st.user.email)
     all_crops = get_available_crops()
 
-    st.session_state.fields = fields
+    st.session_state.fields = [dict(field) for field in fields]
 
     with st.container(border=True):
         st.markdown("### 💧 Tiến độ tưới")
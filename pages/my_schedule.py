@@ -2,6 +2,7 @@ import streamlit as st
 import plotly.express as px
 import pandas as pd
 from database import db
+from telemetry_store import telemetry_store
 from datetime import datetime, timedelta
 import logging
 import toml
@@ -178,37 +179,19 @@ def get_field_telemetry_history(
     if not hub_id:
         return pd.DataFrame()
 
-    telemetry_data = db.get("telemetry", {"hub_id": hub_id[0].get('hub_id')})
-    if not telemetry_data:
+    # Đọc thẳng các cột từ kho telemetry dạng cột (không duyệt dict)
+    wide_df = telemetry_store.frame(hub_id[0].get('hub_id'), {
+        "Độ ẩm đất (TB)": "soil.*.soil_moisture",
+        "Nhiệt độ không khí": "atmospheric.air_temperature",
+    })
+    if wide_df.empty or len(wide_df.columns) < 2:
         return pd.DataFrame()
 
-    records = []
-    for entry in telemetry_data:
-        timestamp = entry.get("timestamp")
-        data = entry.get("data", {})
-
-        nodes = data.get("soil_nodes", [])
-        if nodes:
-            values = [n['sensors']['soil_moisture'] for n in nodes if n.get(
-                'sensors') and 'soil_moisture' in n['sensors']]
-            if values:
-                avg_moisture = sum(values) / len(values)
-                records.append(
-                    {"timestamp": timestamp, "Metric": "Độ ẩm đất (TB)", "Value": avg_moisture})
-
-        atm_node = data.get("atmospheric_node", {})
-        if atm_node.get(
-                'sensors') and 'air_temperature' in atm_node['sensors']:
-            records.append({"timestamp": timestamp,
-                            "Metric": "Nhiệt độ không khí",
-                            "Value": atm_node['sensors']['air_temperature']})
-
-    if not records:
+    df = wide_df.melt(id_vars="timestamp", var_name="Metric",
+                      value_name="Value").dropna(subset=["Value"])
+    if df.empty:
         return pd.DataFrame()
-
-    df = pd.DataFrame(records)
-    df["timestamp"] = pd.to_datetime(df["timestamp"])
-    return df.sort_values(by="timestamp")
+    return df.sort_values(by="timestamp", kind="stable")
 
 
 def update_field_from_telemetry(field):
@@ -278,7 +261,7 @@ def render_schedule():
         st.error("Vui lòng đăng nhập để xem.")
         return
 
-    user_fields = db.get("fields", {"user_email": st.user.email})
+    user_fields = db.fields_by_user(st.user.email)
 
     if not user_fields:
         st.warning("Không tìm thấy vườn. Vui lòng thêm vườn trước.")
@@ -298,10 +281,8 @@ def render_schedule():
                     hubs = db.get("iot_hubs", {"field_id": field.get('id'), "user_email": st.user.email})
                     if hubs:
                         hub_id = hubs[0].get('hub_id')
-                        telemetry_data = db.get("telemetry", {"hub_id": hub_id})
-                        if telemetry_data:
-                             # Get the latest one
-                             telemetry = sorted(telemetry_data, key=lambda x: x.get('timestamp', ''), reverse=True)[0]
+                        # Get the latest one
+                        telemetry = db.latest("telemetry", hub_id)
                     
                     water_needs = predict_water_needs(field, telemetry)
 
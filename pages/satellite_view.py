@@ -203,7 +203,7 @@ def render_satellite_map():
     st.subheader("🗺️ Vị trí & Thu thập dữ liệu")
 
     if hasattr(st, 'user') and st.user.is_logged_in:
-        user_fields = db.get("fields", {"user_email": st.user.email})
+        user_fields = db.fields_by_user(st.user.email)
     else:
         # Mock data để test nếu chưa login
         user_fields = []
@@ -426,7 +426,7 @@ def render_weather_overlay():
         st.warning("⚠️ Vui lòng đăng nhập để sử dụng tính năng này.")
         return
         
-    user_fields = db.get("fields", {"user_email": st.user.email})
+    user_fields = db.fields_by_user(st.user.email)
 
     if not user_fields:
         st.warning("Vui lòng thêm một vườn trong phần Quản lý Vườn trước.")
@@ -1,6 +1,8 @@
 import streamlit as st
+import pandas as pd
 from database import db, crop_db
 from datetime import datetime
+from iot_api_client import get_iot_client
 import json
 
 
@@ -34,13 +36,96 @@ def render_admin_panel():
         "Chào mừng đến với bảng điều khiển quản trị. "
         "Tại đây bạn có thể quản lý người dùng và các loại cây trồng.")
 
-    admin_tab1, admin_tab2 = st.tabs(
-        ["👤 Quản lý người dùng", "🌱 Quản lý cây trồng"])
+    admin_tab1, admin_tab2, admin_tab3 = st.tabs(
+        ["👤 Quản lý người dùng", "🌱 Quản lý cây trồng",
+         "📈 Hiệu năng CSDL"])
 
     with admin_tab1:
         render_user_management()
     with admin_tab2:
         render_crop_management()
+    with admin_tab3:
+        render_db_metrics()
+
+
+def _operations_frame(stats):
+    """Bảng thao tác (bảng, thao tác) sắp theo tổng thời gian giảm dần."""
+    rows = []
+    for table, ops in stats.get("operations", {}).items():
+        for op, s in ops.items():
+            rows.append({
+                "Bảng": table, "Thao tác": op, "Số lần": s["count"],
+                "Lỗi": s["errors"], "Tổng (ms)": s["total"] * 1000,
+                "TB (ms)": s["avg"] * 1000, "p95 (ms)": s["p95"] * 1000,
+                "p99 (ms)": s["p99"] * 1000, "Max (ms)": s["max"] * 1000,
+                "Chờ khóa (ms)": s["lock_wait"] * 1000,
+                "Duyệt": s["scanned"], "Trả về": s["returned"],
+                # Duyệt nhiều hơn hẳn trả về: truy vấn không dùng chỉ mục
+                "Duyệt/trả về": (s["scanned"] / s["returned"]
+                                 if s["returned"] else None),
+            })
+    if not rows:
+        return pd.DataFrame()
+    return pd.DataFrame(rows).sort_values("Tổng (ms)", ascending=False)
+
+
+def _render_stats(stats):
+    operations = _operations_frame(stats)
+    if operations.empty:
+        st.info("Chưa có thao tác nào được đo.")
+        return
+    st.dataframe(operations.round(3), use_container_width=True,
+                 hide_index=True)
+    io = stats.get("io", {})
+    if io:
+        st.caption("Đọc/ghi tệp theo bảng (thời gian tính bằng giây)")
+        st.dataframe(pd.DataFrame.from_dict(io, orient="index").round(4),
+                     use_container_width=True)
+    locks = {(table, mode): s
+             for table, modes in stats.get("locks", {}).items()
+             for mode, s in modes.items() if s["count"]}
+    if locks:
+        st.caption("Chờ khóa theo bảng (giây)")
+        st.dataframe(pd.DataFrame.from_dict(locks, orient="index").round(4),
+                     use_container_width=True)
+
+
+def render_db_metrics():
+    st.subheader("Hiệu năng cơ sở dữ liệu")
+    st.caption("Số liệu tính từ lúc tiến trình khởi động hoặc lần xóa gần "
+               "nhất. Cột Duyệt/trả về lớn cho biết truy vấn đang quét cả "
+               "bảng thay vì dùng chỉ mục.")
+
+    st.markdown("**Ứng dụng (tiến trình này)**")
+    app_stats = db.stats()
+    _render_stats(app_stats)
+    if "daemon" in app_stats:
+        st.markdown("**Daemon dữ liệu (dùng chung mọi tiến trình)**")
+        _render_stats(app_stats["daemon"])
+    if st.button("Xóa số liệu ứng dụng", key="reset_app_db_metrics"):
+        db.reset_stats()
+        st.rerun()
+
+    st.markdown("**IoT API**")
+    client = get_iot_client()
+    api_stats = client.get_db_metrics()
+    if api_stats is None:
+        st.warning("Không lấy được số liệu từ IoT API "
+                   f"({client.base_url}).")
+        return
+    ingest = client.get_ingest_metrics()
+    if ingest:
+        st.caption("Hàng đợi ghi telemetry")
+        col1, col2, col3, col4 = st.columns(4)
+        col1.metric("Đang chờ", f"{ingest['depth']}/{ingest['capacity']}")
+        col2.metric("Bị từ chối (429/503)", ingest["rejected"])
+        col3.metric("Cỡ nhóm TB", f"{ingest['group_size_avg']:.1f}")
+        col4.metric("Ghi nhóm TB (ms)",
+                    f"{ingest['commit_time_avg'] * 1000:.1f}")
+    _render_stats(api_stats)
+    if st.button("Xóa số liệu IoT API", key="reset_api_db_metrics"):
+        client.reset_db_metrics()
+        st.rerun()
 
 
 def render_user_management():
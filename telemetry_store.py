@@ -0,0 +1,450 @@
+"""
+TerraSync Telemetry Column Store
+Kho lưu trữ dạng cột (memory-mapped) cho dữ liệu telemetry, phục vụ vẽ
+biểu đồ và phân tích chuỗi thời gian mà không phải duyệt các dict lồng nhau.
+
+Bố cục trên đĩa (mỗi hub một thư mục)::
+
+    <root>/<hub_id>/ts.i64                          thời gian (ns từ epoch, UTC)
+    <root>/<hub_id>/atmospheric/<metric>.f32        cảm biến khí quyển
+    <root>/<hub_id>/soil/<node_id>/<metric>.f32     cảm biến đất của từng node
+    <root>/<hub_id>/meta.json                       thông tin backfill và
+                                                    danh sách các chuỗi
+
+Mọi cột của một hub có cùng số dòng với ``ts.i64`` (giá trị thiếu là NaN).
+Khi thêm một bản tin, các cột giá trị được ghi trước và ``ts.i64`` ghi sau
+cùng, nên số dòng hợp lệ luôn là số dòng của ``ts.i64``; phần thừa của lần
+ghi bị ngắt sẽ được cắt ở lần ghi sau. Người đọc không cần khóa.
+"""
+import os
+import json
+from datetime import datetime, timezone, timedelta
+from typing import Dict, List, Any, Optional, Tuple, Iterable, Union
+from urllib.parse import quote, unquote
+
+import numpy as np
+from filelock import FileLock
+
+from database import db, StorageBackend
+
+_EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+_NS_PER_US = 1000
+TimeBound = Union[None, str, datetime, int]
+
+
+def to_epoch_ns(value: Union[str, datetime, int]) -> int:
+    """Chuyển chuỗi ISO 8601 / datetime (không múi giờ: UTC) sang ns."""
+    if isinstance(value, (int, np.integer)):
+        return int(value)
+    if isinstance(value, str):
+        value = datetime.fromisoformat(value)
+    if value.tzinfo is None:
+        value = value.replace(tzinfo=timezone.utc)
+    return (value - _EPOCH) // timedelta(microseconds=1) * _NS_PER_US
+
+
+def _safe_name(name: str) -> str:
+    """Tên hub/node/chỉ số dùng làm tên tệp (không chứa '/' hay '..')."""
+    encoded = quote(str(name), safe="")
+    if encoded.startswith("."):
+        encoded = "%2E" + encoded[1:]
+    return encoded
+
+
+def _series_path(series: str) -> str:
+    """``"soil.N1.soil_moisture"`` -> ``soil/N1/soil_moisture.f32``."""
+    group, _, rest = series.partition(".")
+    if group == "soil":
+        node, _, metric = rest.rpartition(".")
+        return os.path.join("soil", _safe_name(node), f"{_safe_name(metric)}.f32")
+    return os.path.join(_safe_name(group), f"{_safe_name(rest)}.f32")
+
+
+def flatten_record(record: Dict[str, Any]) -> Dict[str, float]:
+    """
+    Tách một bản tin telemetry thành ``{tên chuỗi: giá trị}``, vd.
+    ``"atmospheric.air_temperature"`` hoặc ``"soil.N1.soil_moisture"``.
+    Giá trị không phải số bị bỏ qua.
+    """
+    data = record.get("data") or {}
+    values: Dict[str, float] = {}
+
+    def put(prefix: str, sensors: Any):
+        if not isinstance(sensors, dict):
+            return
+        for metric, value in sensors.items():
+            if isinstance(value, (int, float)) and not isinstance(value, bool):
+                values[f"{prefix}.{metric}"] = float(value)
+
+    for node in data.get("soil_nodes") or []:
+        if isinstance(node, dict) and node.get("node_id") is not None:
+            put(f"soil.{node['node_id']}", node.get("sensors"))
+    atm = data.get("atmospheric_node")
+    if isinstance(atm, dict):
+        put("atmospheric", atm.get("sensors"))
+    return values
+
+
+class ColumnarTelemetryStore:
+    """
+    Kho telemetry dạng cột: mỗi chuỗi (hub, node, chỉ số) là một mảng
+    float32 kèm cột thời gian int64 chung của hub, đọc qua ``np.memmap``.
+
+    - ``append(record)``: thêm một bản tin (gọi khi tiếp nhận telemetry).
+    - ``read(hub_id, series, since, until, last)``: các lát cắt NumPy
+      (không sao chép khi dữ liệu đã theo thứ tự thời gian).
+    - ``frame(...)``: như ``read`` nhưng trả về ``pandas.DataFrame``.
+
+    Lần đầu một hub được đọc hoặc ghi, dữ liệu cũ của hub đó trong bảng
+    ``telemetry`` của ``source`` được nạp lại vào kho (backfill).
+    """
+    TS_FILE = "ts.i64"
+    META_FILE = "meta.json"
+    # Số dòng cuối được kiểm tra để bỏ qua bản tin trùng thời gian
+    DEDUPE_WINDOW = 64
+
+    def __init__(self, root: str, source: Optional[StorageBackend] = None,
+                 table: str = "telemetry"):
+        self.root = root
+        self.source = source
+        self.table = table
+        # Tên các chuỗi theo hub cùng dấu của meta.json lúc đọc (xem series)
+        self._series_cache: Dict[str, Tuple[Tuple[int, int, int],
+                                            List[str], bool]] = {}
+
+    # --- Đường dẫn ---
+
+    def _hub_dir(self, hub_id: str) -> str:
+        return os.path.join(self.root, _safe_name(hub_id))
+
+    def _lock(self, hub_id: str) -> FileLock:
+        hub_dir = self._hub_dir(hub_id)
+        os.makedirs(hub_dir, exist_ok=True)
+        return FileLock(os.path.join(hub_dir, ".lock"))
+
+    def hubs(self) -> List[str]:
+        """Các hub đã có dữ liệu trong kho."""
+        if not os.path.isdir(self.root):
+            return []
+        return sorted(unquote(name) for name in os.listdir(self.root)
+                      if os.path.isfile(os.path.join(self.root, name,
+                                                     self.META_FILE)))
+
+    def series(self, hub_id: str) -> List[str]:
+        """Tên các chuỗi của một hub, vd. ``["atmospheric.air_humidity", ...]``."""
+        return list(self._series_entry(hub_id)[0])
+
+    def _series_entry(self, hub_id: str) -> Tuple[List[str], bool]:
+        """
+        ``(tên các chuỗi, đã có danh sách trong meta.json)``. Danh sách được
+        nhớ theo hub và chỉ đọc lại khi meta.json bị thay (tiến trình khác
+        thêm cột), nên mỗi lần gọi chỉ tốn một lần ``stat``. Thư mục chỉ
+        được duyệt khi hub chưa backfill hoặc kho cũ chưa có danh sách.
+        """
+        hub_dir = self._hub_dir(hub_id)
+        try:
+            st = os.stat(os.path.join(hub_dir, self.META_FILE))
+        except FileNotFoundError:
+            self._series_cache.pop(hub_id, None)
+            return self._walk_series(hub_dir), False
+        stamp = (st.st_ino, st.st_mtime_ns, st.st_size)
+        cached = self._series_cache.get(hub_id)
+        if cached is None or cached[0] != stamp:
+            names = self._read_meta(hub_dir).get("series")
+            listed = names is not None
+            if not listed:
+                names = self._walk_series(hub_dir)
+            cached = (stamp, sorted(names), listed)
+            self._series_cache[hub_id] = cached
+        return cached[1], cached[2]
+
+    def _read_meta(self, hub_dir: str) -> Dict[str, Any]:
+        try:
+            with open(os.path.join(hub_dir, self.META_FILE)) as f:
+                return json.load(f)
+        except (FileNotFoundError, ValueError):
+            return {}
+
+    def _write_meta_unsafe(self, hub_id: str, meta: Dict[str, Any]):
+        """Ghi đè meta.json một cách nguyên tử (cần giữ khóa hub)."""
+        path = os.path.join(self._hub_dir(hub_id), self.META_FILE)
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(meta, f)
+        os.replace(tmp_path, path)
+        self._series_cache.pop(hub_id, None)
+
+    @staticmethod
+    def _walk_series(hub_dir: str) -> List[str]:
+        names = []
+        for dirpath, _, filenames in os.walk(hub_dir):
+            rel = os.path.relpath(dirpath, hub_dir)
+            parts = [] if rel == "." else [unquote(p) for p in rel.split(os.sep)]
+            for filename in filenames:
+                if filename.endswith(".f32"):
+                    names.append(".".join(parts + [unquote(filename[:-4])]))
+        return sorted(names)
+
+    # --- Ghi ---
+
+    def append(self, record: Dict[str, Any]) -> bool:
+        """
+        Thêm một bản tin telemetry (``hub_id``, ``timestamp``, ``data``).
+        Trả về False nếu bản tin bị bỏ qua (thiếu thông tin hoặc trùng thời
+        gian với một bản tin gần đây của cùng hub).
+        """
+        hub_id = record.get("hub_id")
+        timestamp = record.get("timestamp")
+        if hub_id is None or timestamp is None:
+            return False
+        ts = to_epoch_ns(timestamp)
+        with self._lock(hub_id):
+            if not self._is_ready(hub_id):
+                # Backfill đọc từ DB, đã gồm cả bản tin này
+                self._backfill_unsafe(hub_id)
+                return True
+            hub_dir = self._hub_dir(hub_id)
+            n = self._repair_unsafe(hub_id)
+            if ts in self._read_ts_tail(hub_dir, n, self.DEDUPE_WINDOW):
+                return False
+
+            values = flatten_record(record)
+            known, listed = self._series_entry(hub_id)
+            new = values.keys() - set(known)
+            for name in new:
+                # Tệp chưa có trong danh sách là phần dở của lần ghi bị
+                # ngắt (nếu có): tạo lại cho đủ n dòng NaN
+                path = os.path.join(hub_dir, _series_path(name))
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                _write_array(path, np.full(n, np.nan, dtype=np.float32))
+            if new or not listed:
+                # Ghi danh sách sau khi tạo tệp: người đọc không khóa chỉ
+                # thấy các cột đã tồn tại
+                meta = self._read_meta(hub_dir)
+                meta["series"] = sorted(new.union(known))
+                self._write_meta_unsafe(hub_id, meta)
+            for name in new.union(known):
+                path = os.path.join(hub_dir, _series_path(name))
+                _append_array(path, np.array([values.get(name, np.nan)],
+                                             dtype=np.float32))
+            # Ghi cột thời gian sau cùng: dòng mới chỉ hợp lệ từ lúc này
+            _append_array(os.path.join(hub_dir, self.TS_FILE),
+                          np.array([ts], dtype=np.int64))
+        return True
+
+    def _repair_unsafe(self, hub_id: str) -> int:
+        """Cắt phần thừa của lần ghi bị ngắt; trả về số dòng hợp lệ."""
+        hub_dir = self._hub_dir(hub_id)
+        n = self._row_count(hub_dir)
+        ts_path = os.path.join(hub_dir, self.TS_FILE)
+        if os.path.exists(ts_path) and os.path.getsize(ts_path) != n * 8:
+            os.truncate(ts_path, n * 8)
+        for name in self.series(hub_id):
+            path = os.path.join(hub_dir, _series_path(name))
+            size = os.path.getsize(path)
+            if size > n * 4:
+                os.truncate(path, n * 4)
+            elif size < n * 4:
+                os.truncate(path, size // 4 * 4)
+                _append_array(path, np.full(n - size // 4, np.nan,
+                                            dtype=np.float32))
+        return n
+
+    def _is_ready(self, hub_id: str) -> bool:
+        return os.path.exists(os.path.join(self._hub_dir(hub_id),
+                                           self.META_FILE))
+
+    def ensure(self, hub_id: str):
+        """Nạp dữ liệu cũ của hub từ DB vào kho nếu chưa làm."""
+        if self._is_ready(hub_id):
+            return
+        with self._lock(hub_id):
+            if not self._is_ready(hub_id):
+                self._backfill_unsafe(hub_id)
+
+    def _backfill_unsafe(self, hub_id: str):
+        """Dựng lại toàn bộ cột của hub từ bảng telemetry (cần giữ khóa hub)."""
+        timestamps: List[int] = []
+        columns: Dict[str, List[float]] = {}
+        if self.source is not None:
+            rows = self.source.query(self.table, {"hub_id": hub_id},
+                                     fields=["timestamp", "data"],
+                                     order_by="timestamp")
+            for row in rows:
+                try:
+                    ts = to_epoch_ns(row["timestamp"])
+                except (KeyError, TypeError, ValueError):
+                    continue
+                values = flatten_record(row)
+                n = len(timestamps)
+                for name in values.keys() - columns.keys():
+                    columns[name] = [np.nan] * n
+                for name, column in columns.items():
+                    column.append(values.get(name, np.nan))
+                timestamps.append(ts)
+
+        hub_dir = self._hub_dir(hub_id)
+        for name in self.series(hub_id):
+            os.remove(os.path.join(hub_dir, _series_path(name)))
+        for name, column in columns.items():
+            path = os.path.join(hub_dir, _series_path(name))
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            _write_array(path, np.array(column, dtype=np.float32))
+        _write_array(os.path.join(hub_dir, self.TS_FILE),
+                     np.array(timestamps, dtype=np.int64))
+        self._write_meta_unsafe(hub_id, {
+            "backfilled_at": datetime.now(timezone.utc).isoformat(),
+            "rows": len(timestamps),
+            "series": sorted(columns)})
+
+    def prune(self, before: Union[str, datetime, int],
+              hub_id: Optional[str] = None) -> int:
+        """Xóa các dòng có thời gian < ``before``; trả về số dòng đã xóa."""
+        cutoff = to_epoch_ns(before)
+        removed = 0
+        for hub in ([hub_id] if hub_id else self.hubs()):
+            with self._lock(hub):
+                hub_dir = self._hub_dir(hub)
+                n = self._repair_unsafe(hub)
+                ts = self._read_ts(hub_dir, n)
+                keep = ts >= cutoff
+                if keep.all():
+                    continue
+                removed += int(n - keep.sum())
+                for name in self.series(hub):
+                    path = os.path.join(hub_dir, _series_path(name))
+                    _write_array(path, _map(path, np.float32, n)[keep])
+                _write_array(os.path.join(hub_dir, self.TS_FILE), ts[keep])
+        return removed
+
+    # --- Đọc ---
+
+    def _row_count(self, hub_dir: str) -> int:
+        try:
+            return os.path.getsize(os.path.join(hub_dir, self.TS_FILE)) // 8
+        except FileNotFoundError:
+            return 0
+
+    def _read_ts(self, hub_dir: str, n: int) -> np.ndarray:
+        return _map(os.path.join(hub_dir, self.TS_FILE), np.int64, n)
+
+    def _read_ts_tail(self, hub_dir: str, n: int, k: int) -> np.ndarray:
+        """K thời gian cuối trong n dòng hợp lệ, đọc thẳng phần đuôi tệp."""
+        start = max(0, n - k)
+        if n == start:
+            return np.empty(0, dtype=np.int64)
+        with open(os.path.join(hub_dir, self.TS_FILE), "rb") as f:
+            f.seek(start * 8)
+            return np.frombuffer(f.read((n - start) * 8), dtype=np.int64)
+
+    def read(self, hub_id: str, series: Optional[Iterable[str]] = None,
+             since: TimeBound = None, until: TimeBound = None,
+             last: Optional[int] = None
+             ) -> Tuple[np.ndarray, Dict[str, np.ndarray]]:
+        """
+        Đọc các chuỗi của một hub trong khoảng ``since <= t < until``,
+        theo thứ tự thời gian; ``last`` giới hạn ở N dòng cuối.
+
+        Trả về ``(ts, {tên: mảng})`` với ``ts`` là int64 ns (UTC). Tên dạng
+        ``"soil.*.<chỉ số>"`` cho giá trị trung bình của mọi node đất. Các
+        mảng là lát cắt trực tiếp của tệp (chỉ đọc) khi dữ liệu đã được ghi
+        theo thứ tự thời gian.
+        """
+        self.ensure(hub_id)
+        hub_dir = self._hub_dir(hub_id)
+        n = self._row_count(hub_dir)
+        ts = self._read_ts(hub_dir, n)
+        available = self.series(hub_id)
+        wanted = available if series is None else list(series)
+
+        # Chọn dòng: lát cắt liên tục nếu đã sắp xếp, ngược lại dùng chỉ số
+        if n < 2 or bool(np.all(ts[1:] >= ts[:-1])):
+            lo = 0 if since is None else int(
+                np.searchsorted(ts, to_epoch_ns(since), "left"))
+            hi = n if until is None else int(
+                np.searchsorted(ts, to_epoch_ns(until), "left"))
+            if last is not None:
+                lo = max(lo, hi - last)
+            rows: Union[slice, np.ndarray] = slice(lo, max(lo, hi))
+        else:
+            mask = np.ones(n, dtype=bool)
+            if since is not None:
+                mask &= ts >= to_epoch_ns(since)
+            if until is not None:
+                mask &= ts < to_epoch_ns(until)
+            idx = np.flatnonzero(mask)
+            rows = idx[np.argsort(ts[idx], kind="stable")]
+            if last is not None:
+                rows = rows[max(0, len(rows) - last):]
+
+        def column(name: str) -> Optional[np.ndarray]:
+            path = os.path.join(hub_dir, _series_path(name))
+            if name not in available or os.path.getsize(path) < n * 4:
+                return None
+            return _map(path, np.float32, n)[rows]
+
+        values: Dict[str, np.ndarray] = {}
+        for name in wanted:
+            if name.startswith("soil.*."):
+                metric = name[len("soil.*."):]
+                nodes = [column(s) for s in available
+                         if s.startswith("soil.") and s.endswith(f".{metric}")]
+                nodes = [c for c in nodes if c is not None]
+                if nodes:
+                    # Trung bình bỏ qua NaN; dòng toàn NaN cho ra NaN
+                    stacked = np.vstack(nodes)
+                    counts = np.sum(~np.isnan(stacked), axis=0)
+                    values[name] = np.where(
+                        counts > 0,
+                        np.nansum(stacked, axis=0) / np.maximum(counts, 1),
+                        np.nan).astype(np.float32)
+            else:
+                col = column(name)
+                if col is not None:
+                    values[name] = col
+        return ts[rows], values
+
+    def frame(self, hub_id: str,
+              series: Union[None, Iterable[str], Dict[str, str]] = None,
+              since: TimeBound = None, until: TimeBound = None,
+              last: Optional[int] = None):
+        """
+        Như ``read()`` nhưng trả về ``pandas.DataFrame`` gồm cột
+        ``timestamp`` (UTC) và một cột cho mỗi chuỗi. ``series`` có thể là
+        dict ``{nhãn cột: tên chuỗi}`` để đặt tên cột hiển thị.
+        """
+        import pandas as pd
+
+        labels = dict(series) if isinstance(series, dict) else None
+        ts, values = self.read(hub_id, labels.values() if labels else series,
+                               since, until, last)
+        df = pd.DataFrame({"timestamp": pd.to_datetime(ts, utc=True)})
+        for label, name in (labels or {n: n for n in values}).items():
+            if name in values:
+                df[label] = values[name]
+        return df
+
+
+def _map(path: str, dtype, n: int) -> np.ndarray:
+    """Ánh xạ n phần tử đầu của tệp vào bộ nhớ (chỉ đọc)."""
+    if n == 0:
+        return np.empty(0, dtype=dtype)
+    return np.memmap(path, dtype=dtype, mode="r", shape=(n,))
+
+
+def _append_array(path: str, array: np.ndarray):
+    with open(path, "ab") as f:
+        f.write(array.tobytes())
+
+
+def _write_array(path: str, array: np.ndarray):
+    """Ghi đè cả tệp một cách nguyên tử (tệp tạm + đổi tên)."""
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(np.ascontiguousarray(array).tobytes())
+    os.replace(tmp_path, path)
+
+
+# Kho cột dùng chung, nằm cạnh các bảng của database chính
+telemetry_store = ColumnarTelemetryStore(
+    os.path.join(db.data_dir, "telemetry.columns"), db)
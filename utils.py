@@ -21,7 +21,9 @@ def get_fields_from_db() -> Optional[List[Dict[str, Any]]]:
             if user_email:
                 user_fields = db.get_fields_by_user(user_email)
                 if user_fields:
-                    return user_fields
+                    # Bản sao sửa được: giao diện gắn thêm trạng thái hiển
+                    # thị (vd. từ telemetry) vào st.session_state.fields
+                    return [dict(field) for field in user_fields]
     except Exception as e:
         print(f"Lỗi khi lấy dữ liệu từ database: {e}")
     return None
@@ -80,14 +82,9 @@ def get_latest_telemetry_stats(user_email: str, field_id: str) -> Dict[str, Any]
         return {}
     
     hub_id = hubs[0].get("hub_id")
-    all_telemetry = db.get("telemetry", {"hub_id": hub_id})
+    latest_entry = db.latest("telemetry", hub_id)
     
-    if not all_telemetry:
-        return {}
-        
-    try:
-        latest_entry = sorted(all_telemetry, key=lambda x: x.get('timestamp', ''), reverse=True)[0]
-    except (IndexError, ValueError):
+    if not latest_entry:
         return {}
 
     avg_moisture = _aggregate_soil_moisture(latest_entry)
@@ -1,9 +1,10 @@
 from pathlib import Path
 import toml
 from database import db
-import time
 import sys
 import os
+import time
+from contextlib import contextmanager
 from datetime import datetime, timezone
 
 from utils_lib.mail_sender import send_email
@@ -33,8 +34,14 @@ config = load_config()
 job_cfg = config.get('background_job', {})
 irr_cfg = config.get('irrigation', {})
 
-CHECK_INTERVAL_SECONDS = job_cfg.get('check_interval_seconds', 60)
-DB_FILE_PATH = os.path.abspath('terrasync_db.json')
+CHECK_INTERVAL_SECONDS = job_cfg.get('check_interval_seconds', 300)
+# Các bảng mà process_alerts/calculate_auto_irrigation đọc: chu kỳ mới chạy
+# ngay khi một trong số chúng thay đổi
+WATCHED_TABLES = ('alerts', 'telemetry', 'fields', 'iot_hubs')
+# Khoảng cách tối thiểu giữa hai chu kỳ: telemetry được ghi liên tục nên
+# các lần đánh thức dồn lại thành nhiều nhất một chu kỳ mỗi khoảng này
+MIN_CYCLE_SECONDS = job_cfg.get('min_cycle_seconds', 30)
+DB_FILE_PATH = os.path.abspath(db.location)
 print("DB:", str(DB_FILE_PATH))
 
 # --- Các hằng số cho logic tưới tiêu ---
@@ -45,6 +52,25 @@ HIGH_MOISTURE_THRESHOLD = irr_cfg.get(
 RAIN_INTENSITY_THRESHOLD = irr_cfg.get('rain_threshold_mmh', 1.0)
 
 
+# Phiên bản các bảng WATCHED_TABLES mà job đã xử lý (xem main)
+_seen = {}
+
+
+@contextmanager
+def own_write(table: str):
+    """
+    Bọc một lần ghi của chính job lên ``table``: nếu chỉ lần ghi này làm
+    bảng tăng đúng một phiên bản thì ghi nhận phiên bản mới là đã thấy, để
+    job không tự đánh thức mình. Ghi từ tiến trình khác xen vào vẫn làm
+    chênh lệch phiên bản nên chu kỳ sau vẫn chạy.
+    """
+    before = db.version(table)
+    yield
+    after = db.version(table)
+    if after == before + 1 and _seen.get(table) == before:
+        _seen[table] = after
+
+
 # =====================================================================
 # --- HÀM XỬ LÝ ALERTS (ĐÃ SỬA) ---
 # =====================================================================
@@ -129,10 +155,13 @@ def process_alerts():
                     print(
                         f"Successfully sent email notification (ID: "
                         f"{result.get('id', 'sent')})")
-                    # Đánh dấu là đã gửi
-                    alert['notification_sent'] = True
-                    alert['notification_sent_at'] = datetime.now(
-                        timezone.utc).isoformat()
+                    # Đánh dấu là đã gửi (bản ghi đọc ra là chỉ đọc, nên
+                    # chỉ ghi các trường thay đổi qua db.update)
+                    sent_changes = {
+                        'notification_sent': True,
+                        'notification_sent_at': datetime.now(
+                            timezone.utc).isoformat(),
+                    }
                     notifications_sent += 1
 
                     # Cập nhật lại vào DB (dùng index)
@@ -141,7 +170,9 @@ def process_alerts():
                     # Chúng ta nên update bằng ID của alert
                     alert_id = alert.get('id')
                     if alert_id:
-                        db.update('alerts', {'id': alert_id}, alert)
+                        with own_write('alerts'):
+                            db.update(
+                                'alerts', {'id': alert_id}, sent_changes)
                     else:
                         print(
                             f"Warning: Alert {i} không có ID, "
@@ -175,18 +206,10 @@ def get_field_by_id(fields_list, field_id):
     return None, -1
 
 
-def get_latest_telemetry_for_hub(telemetry_list, hub_id):
+def get_latest_telemetry_for_hub(hub_id):
     """Helper: Lấy bản tin telemetry mới nhất cho hub."""
-    hub_telemetry = [t for t in telemetry_list if t.get('hub_id') == hub_id]
-    if not hub_telemetry:
-        return None
-    # Sắp xếp theo timestamp, mới nhất lên đầu
-    hub_telemetry.sort(
-        key=lambda x: x.get(
-            'timestamp',
-            '1970-01-01T00:00:00+00:00'),
-        reverse=True)
-    return hub_telemetry[0]
+    # Chỉ mục (hub_id, timestamp) của DB trả về bản ghi mới nhất trực tiếp
+    return db.latest('telemetry', hub_id)
 
 
 def average_soil_moisture(telemetry_data):
@@ -216,13 +239,13 @@ def calculate_auto_irrigation():
         # SỬA LỖI: db.get_all -> db.get
         all_hubs = db.get('iot_hubs')
         all_fields = db.get('fields')  # Dùng bảng 'fields' gốc
-        all_telemetry = db.get('telemetry')
 
         if not all_hubs or not all_fields:
             print("No hubs or fields found. Skipping irrigation logic.")
             return
 
         fields_updated = 0
+        pending_updates = []  # (field_id, thay đổi), ghi một lần ở cuối
 
         # 2. Lặp qua từng Hub
         for hub in all_hubs:
@@ -240,8 +263,7 @@ def calculate_auto_irrigation():
                 continue
 
             # 4. Tìm Telemetry mới nhất cho Hub này
-            latest_telemetry = get_latest_telemetry_for_hub(
-                all_telemetry, hub_id)
+            latest_telemetry = get_latest_telemetry_for_hub(hub_id)
             if not latest_telemetry:
                 print(
                     f"No telemetry found for hub {hub_id}. "
@@ -312,20 +334,27 @@ def calculate_auto_irrigation():
 
             # 7. Cập nhật thay đổi vào DB (nếu có)
             if field_changed:
-                field['status'] = new_status
-                field['progress'] = new_progress
-                field['time_needed'] = new_time_needed
-
                 # Cập nhật bằng ID, vì hàm update yêu cầu filter_dict
                 field_id_to_update = field.get('id')
                 if field_id_to_update:
-                    db.update('fields', {'id': field_id_to_update}, field)
-                    fields_updated += 1
+                    pending_updates.append((field_id_to_update, {
+                        'status': new_status,
+                        'progress': new_progress,
+                        'time_needed': new_time_needed,
+                    }))
                 else:
                     print(
                         f"Warning: Field {field_index} không có ID, "
                         "không thể cập nhật.")
 
+        # 8. Ghi tất cả thay đổi trong một lô: bảng fields chỉ được
+        # khóa và ghi lại một lần cho cả vòng lặp
+        if pending_updates:
+            with own_write('fields'), db.batch('fields'):
+                for field_id_to_update, changes in pending_updates:
+                    fields_updated += db.update(
+                        'fields', {'id': field_id_to_update}, changes)
+
         if fields_updated > 0:
             print(
                 f"Finished irrigation calculations. Updated {fields_updated} "
@@ -347,7 +376,20 @@ def calculate_auto_irrigation():
 def main():
     """Main loop for the background job."""
     print("Starting TerraSync Background Job...")
+    # Lấy phiên bản trước mỗi chu kỳ để không bỏ lỡ thay đổi xảy ra trong
+    # lúc đang xử lý; own_write cập nhật _seen sau các lần ghi của job
+    _seen.update(db.versions(*WATCHED_TABLES))
+    last_cycle = None
     while True:
+        # Dồn các lần đánh thức liên tiếp: chờ đủ MIN_CYCLE_SECONDS kể từ
+        # đầu chu kỳ trước rồi mới xử lý mọi thay đổi tích lũy trong lúc đó
+        if last_cycle is not None:
+            delay = last_cycle + MIN_CYCLE_SECONDS - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+        last_cycle = time.monotonic()
+        _seen.update(db.versions(*WATCHED_TABLES))
+
         # 1. Xử lý alerts và gửi thông báo
         process_alerts()
 
@@ -355,9 +397,11 @@ def main():
         calculate_auto_irrigation()
 
         print(
-            f"--- Cycle complete. Sleeping for {CHECK_INTERVAL_SECONDS} "
-            "seconds ---")
-        time.sleep(CHECK_INTERVAL_SECONDS)
+            "--- Cycle complete. Waiting for changes (at most "
+            f"{CHECK_INTERVAL_SECONDS} seconds) ---")
+        changed = db.wait_for_changes(_seen, timeout=CHECK_INTERVAL_SECONDS)
+        if changed:
+            print(f"Tables changed: {', '.join(sorted(changed))}")
 
 
 if __name__ == "__main__":
@@ -0,0 +1,284 @@
+"""
+Công cụ quản trị kho dữ liệu TerraSync, chạy được khi iotAPI/ứng dụng vẫn
+đang ghi:
+
+    python -m utils_lib.db_admin backup <thư mục đích>
+    python -m utils_lib.db_admin compact [--table alerts]
+    python -m utils_lib.db_admin export <thư mục> [--gzip] [--resume]
+    python -m utils_lib.db_admin --backend sqlite import <thư mục> [--resume]
+
+Các lệnh xử lý lần lượt từng bảng nên bộ nhớ dùng chỉ cỡ bảng lớn nhất
+(backend JSON) hoặc một lô bản ghi (SQLite/MongoDB). ``export``/``import``
+dùng NDJSON (mỗi dòng một bản ghi, ``<bảng>.ndjson`` hoặc
+``<bảng>.ndjson.gz``) để chuyển dữ liệu giữa các backend hoặc các máy.
+"""
+import argparse
+import gzip
+import json
+import os
+import sys
+import time
+from itertools import islice
+from typing import Dict, List, Any, Optional
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from database import (create_db, get_serializer,  # noqa: E402
+                      _write_atomic, DB_BACKENDS)
+
+EXPORT_CHECKPOINT = "export.checkpoint.json"
+IMPORT_CHECKPOINT = "import.checkpoint.json"
+NDJSON_SUFFIXES = (".ndjson", ".ndjson.gz")
+
+
+def _open_db(args):
+    return create_db(args.db, backend=args.backend)
+
+
+def run_backup(args):
+    """Sao lưu nhất quán tại một thời điểm vào ``args.dest``."""
+    db = _open_db(args)
+    started = time.monotonic()
+    copied = db.backup(args.dest)
+    for name, size in sorted(copied.items()):
+        print(f"  {name}: {size} byte")
+    print(f"Đã sao lưu {db.location} -> {args.dest}: "
+          f"{len(copied)} tệp, {sum(copied.values())} byte trong "
+          f"{time.monotonic() - started:.2f}s")
+
+
+def run_compact(args):
+    """Gộp nhật ký/thu gọn một hoặc mọi bảng."""
+    db = _open_db(args)
+    started = time.monotonic()
+    db.compact(args.table)
+    print(f"Đã thu gọn {db.location} "
+          f"({args.table or 'mọi bảng'}) trong "
+          f"{time.monotonic() - started:.2f}s")
+
+
+def _load_checkpoint(path: str, resume: bool) -> Dict[str, Any]:
+    """Trạng thái đã lưu của lần chạy trước (chỉ khi ``resume``)."""
+    if not resume or not os.path.exists(path):
+        return {}
+    with open(path, encoding="utf-8") as f:
+        return json.load(f)
+
+
+def _save_checkpoint(path: str, state: Dict[str, Any]):
+    # Dữ liệu đã fsync trước khi lưu điểm dừng, nên điểm dừng không bao
+    # giờ đi trước dữ liệu
+    _write_atomic(path, json.dumps(state, indent=2).encode("utf-8"),
+                  durable=False)
+
+
+def export_tables(db, dest: str, tables: Optional[List[str]] = None,
+                  compress: bool = False, batch_size: int = 5000,
+                  resume: bool = False) -> Dict[str, int]:
+    """
+    Xuất từng bảng ra ``dest/<bảng>.ndjson`` (``.ndjson.gz`` nếu
+    ``compress``) theo thứ tự id, mỗi lần một lô ``batch_size`` bản ghi.
+    Sau mỗi lô, tệp được fsync và vị trí (id bản ghi cuối, số byte) ghi vào
+    ``export.checkpoint.json``; ``resume`` cắt tệp về vị trí đó rồi xuất
+    tiếp sau id đó, nên bản ghi bị xóa giữa hai lần chạy (hết hạn TTL,
+    người dùng xóa) không làm bỏ sót bản ghi nào. Khi nén, mỗi lô là một
+    thành viên gzip riêng nên tệp luôn dừng ở ranh giới đọc được. Trả về
+    ``{bảng: số bản ghi}``.
+    """
+    os.makedirs(dest, exist_ok=True)
+    checkpoint_path = os.path.join(dest, EXPORT_CHECKPOINT)
+    state = _load_checkpoint(checkpoint_path, resume)
+    if state and state.get("compress") != compress:
+        raise ValueError("Điểm dừng được tạo với tùy chọn --gzip khác")
+    state = {"compress": compress, "tables": state.get("tables", {})}
+    dumps = db.serializer.dumps
+    suffix = NDJSON_SUFFIXES[1] if compress else NDJSON_SUFFIXES[0]
+    exported = {}
+    for table in tables or db.tables():
+        progress = state["tables"].get(table, {"rows": 0, "bytes": 0})
+        if progress.get("done"):
+            exported[table] = progress["rows"]
+            continue
+        path = os.path.join(dest, table + suffix)
+        with open(path, "r+b" if progress["bytes"] else "wb") as f:
+            f.truncate(progress["bytes"])
+            f.seek(progress["bytes"])
+            rows = progress["rows"]
+            for batch in db.scan(table, batch_size, progress.get("after")):
+                data = b"".join(dumps(rec) + b"\n" for rec in batch)
+                if compress:
+                    data = gzip.compress(data, compresslevel=6)
+                f.write(data)
+                f.flush()
+                os.fsync(f.fileno())
+                rows += len(batch)
+                last = batch[-1].get("id")
+                if last is None:
+                    # Bản ghi cũ thiếu id (đứng đầu thứ tự) không có khóa
+                    # để tiếp tục, nên giữ điểm dừng trước đó
+                    continue
+                progress = {"rows": rows, "bytes": f.tell(), "after": last}
+                state["tables"][table] = progress
+                _save_checkpoint(checkpoint_path, state)
+        progress = {**progress, "rows": rows, "done": True}
+        state["tables"][table] = progress
+        _save_checkpoint(checkpoint_path, state)
+        exported[table] = progress["rows"]
+        print(f"  {table}: {progress['rows']} bản ghi -> {path}")
+    return exported
+
+
+def _ndjson_files(src: str) -> Dict[str, str]:
+    """``{bảng: đường dẫn}`` của các tệp NDJSON trong ``src``."""
+    files = {}
+    for name in sorted(os.listdir(src)):
+        for suffix in NDJSON_SUFFIXES:
+            if name.endswith(suffix):
+                files[name[:-len(suffix)]] = os.path.join(src, name)
+    return files
+
+
+def _batches(path: str, batch_size: int, skip: int):
+    """Các lô bản ghi của một tệp NDJSON, bỏ qua ``skip`` bản ghi đầu."""
+    loads = get_serializer().loads
+    opener = gzip.open if path.endswith(".gz") else open
+    with opener(path, "rb") as f:
+        lines = (line for line in f if line.strip())
+        lines = islice(lines, skip, None)
+        while True:
+            batch = [loads(line) for line in islice(lines, batch_size)]
+            if not batch:
+                return
+            yield batch
+
+
+def import_tables(db, src: str, tables: Optional[List[str]] = None,
+                  batch_size: int = 5000, resume: bool = False,
+                  checkpoint_path: Optional[str] = None,
+                  compact: bool = True) -> Dict[str, int]:
+    """
+    Nhập các tệp NDJSON của ``src`` (từ ``export_tables``) qua đường ghi
+    hàng loạt ``add_many`` của backend, mỗi lô ``batch_size`` bản ghi; bản
+    ghi giữ nguyên ``id``/``created_at``. Số bản ghi đã nhập của mỗi bảng
+    được lưu sau mỗi lô vào ``checkpoint_path`` (mặc định
+    ``src/import.checkpoint.json``); với ``resume``, lô đầu tiên bỏ các
+    bản ghi đã có (lô ghi xong nhưng chưa kịp lưu điểm dừng). ``compact``
+    gộp nhật ký sau mỗi bảng. Trả về ``{bảng: số bản ghi đã nhập}``.
+    """
+    checkpoint_path = checkpoint_path or os.path.join(src,
+                                                      IMPORT_CHECKPOINT)
+    state = _load_checkpoint(checkpoint_path, resume)
+    files = _ndjson_files(src)
+    missing = set(tables or ()) - set(files)
+    if missing:
+        raise ValueError(f"Không có tệp NDJSON cho bảng: {sorted(missing)}")
+    imported = {}
+    for table in tables or sorted(files):
+        progress = state.get(table, {"rows": 0})
+        if progress.get("done"):
+            imported[table] = progress["rows"]
+            continue
+        db.ensure_table(table)
+        dedupe = resume
+        for batch in _batches(files[table], batch_size, progress["rows"]):
+            count = len(batch)
+            if dedupe:
+                ids = [rec["id"] for rec in batch if "id" in rec]
+                existing = {rec["id"] for rec in
+                            db.get(table, {"id": {"$in": ids}})}
+                batch = [rec for rec in batch
+                         if rec.get("id") not in existing]
+                dedupe = False
+            if batch:
+                db.add_many(table, batch)
+            progress = {"rows": progress["rows"] + count}
+            state[table] = progress
+            _save_checkpoint(checkpoint_path, state)
+        if compact:
+            db.compact(table)
+        progress["done"] = True
+        state[table] = progress
+        _save_checkpoint(checkpoint_path, state)
+        imported[table] = progress["rows"]
+        print(f"  {table}: {progress['rows']} bản ghi <- {files[table]}")
+    return imported
+
+
+def run_export(args):
+    """Xuất các bảng ra NDJSON."""
+    db = _open_db(args)
+    started = time.monotonic()
+    exported = export_tables(db, args.dest, args.tables, args.gzip,
+                             args.batch_size, args.resume)
+    print(f"Đã xuất {db.location} -> {args.dest}: "
+          f"{sum(exported.values())} bản ghi trong "
+          f"{time.monotonic() - started:.2f}s")
+
+
+def run_import(args):
+    """Nhập các bảng từ NDJSON."""
+    db = _open_db(args)
+    started = time.monotonic()
+    imported = import_tables(db, args.src, args.tables, args.batch_size,
+                             args.resume, args.checkpoint,
+                             not args.no_compact)
+    print(f"Đã nhập {args.src} -> {db.location}: "
+          f"{sum(imported.values())} bản ghi trong "
+          f"{time.monotonic() - started:.2f}s")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog="python -m utils_lib.db_admin",
+        description="Sao lưu trực tuyến và thu gọn kho dữ liệu TerraSync.")
+    parser.add_argument("--db", default="terrasync_db.json",
+                        help="tệp CSDL (mặc định: terrasync_db.json)")
+    parser.add_argument("--backend", choices=DB_BACKENDS,
+                        help="mặc định theo appcfg.toml/TERRASYNC_DB_BACKEND")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    backup = commands.add_parser(
+        "backup", help="sao lưu nhất quán khi vẫn có người ghi")
+    backup.add_argument("dest", help="thư mục (hoặc tệp SQLite) đích")
+    backup.set_defaults(func=run_backup)
+
+    compact = commands.add_parser(
+        "compact", help="gộp nhật ký ghi nối tiếp và thu gọn tệp")
+    compact.add_argument("--table", help="chỉ thu gọn một bảng")
+    compact.set_defaults(func=run_compact)
+
+    export = commands.add_parser(
+        "export", help="xuất từng bảng ra NDJSON (tiếp tục được)")
+    export.add_argument("dest", help="thư mục đích")
+    export.add_argument("--gzip", action="store_true",
+                        help="nén gzip (<bảng>.ndjson.gz)")
+    export.set_defaults(func=run_export)
+
+    load = commands.add_parser(
+        "import", help="nhập các tệp NDJSON qua ghi hàng loạt")
+    load.add_argument("src", help="thư mục chứa các tệp NDJSON")
+    load.add_argument("--checkpoint",
+                      help="tệp điểm dừng (mặc định: trong thư mục nguồn)")
+    load.add_argument("--no-compact", action="store_true",
+                      help="không gộp nhật ký sau mỗi bảng")
+    load.set_defaults(func=run_import)
+
+    for sub in (export, load):
+        sub.add_argument("--tables", nargs="+",
+                         help="chỉ các bảng này (mặc định: mọi bảng)")
+        sub.add_argument("--batch-size", type=int, default=5000,
+                         help="số bản ghi mỗi lô (mặc định: 5000)")
+        sub.add_argument("--resume", action="store_true",
+                         help="tiếp tục từ điểm dừng của lần chạy trước")
+
+    args = parser.parse_args(argv)
+    try:
+        args.func(args)
+    except (NotImplementedError, ValueError) as e:
+        print(f"Lỗi: {e}")
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
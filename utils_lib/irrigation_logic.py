@@ -38,20 +38,11 @@ def get_latest_telemetry_stats(user_email: str, field_id: str) -> dict | None:
         # logger.warning(f"Không tìm thấy hub cho field {field_id}")
         return None
 
-    telemetry_data = db.get("telemetry", {"hub_id": hub_id})
-    if not telemetry_data:
+    latest_entry = db.latest("telemetry", hub_id)
+    if not latest_entry:
         # logger.warning(f"Không tìm thấy telemetry cho hub {hub_id}")
         return None
 
-    try:
-        latest_entry = sorted(
-            telemetry_data,
-            key=lambda x: x.get('timestamp', '1970-01-01T00:00:00+00:00'),
-            reverse=True
-        )[0]
-    except IndexError:
-        return None
-
     data = latest_entry.get("data", {})
     stats = {
         "avg_moisture": None,